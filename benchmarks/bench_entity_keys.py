@@ -0,0 +1,87 @@
+"""Benchmark keyvalue access on entities.
+
+This generates a map with many entities, then performs the kind of lookups
+the BSP transforms do for each entity. For comparison, the same lookups are
+also done by scanning a plain dict, which is how keyvalues were previously
+stored.
+Run with "python benchmarks/bench_entity_keys.py [entity count]".
+"""
+import random
+import sys
+import timeit
+from typing import Dict, List
+
+from srctools.vmf import VMF, Entity
+
+KEYS = [
+    'targetname', 'origin', 'angles', 'spawnflags', 'rendercolor',
+    'renderamt', 'rendermode', 'model', 'skin', 'disableshadows',
+    'fademindist', 'fademaxdist', 'parentname', 'StartDisabled', 'vscripts',
+]
+# Keys looked up by transforms, including some which are usually missing.
+LOOKUPS = [
+    'classname', 'targetname', 'origin', 'angles', 'parentname',
+    'model', 'skin', 'StartDisabled', 'srctools_nopack', 'comp_key',
+]
+
+
+def make_vmf(count: int) -> VMF:
+    """Generate a map with the specified number of entities."""
+    rand = random.Random(1234)
+    vmf = VMF()
+    for i in range(count):
+        keys = {key: str(rand.randrange(256)) for key in rand.sample(KEYS, 12)}
+        keys['targetname'] = 'ent_{}'.format(i)
+        vmf.create_ent(rand.choice(['prop_dynamic', 'func_brush', 'logic_relay']), **keys)
+    return vmf
+
+
+def scan_get(keys: Dict[str, str], key: str) -> str:
+    """The previous implementation of Entity.__getitem__."""
+    key = key.casefold()
+    for k in keys:
+        if k.casefold() == key:
+            return keys[k]
+    return ''
+
+
+def scan_set(keys: Dict[str, str], key: str, value: str) -> None:
+    """The previous implementation of Entity.__setitem__."""
+    key_fold = key.casefold()
+    for k in keys:
+        if k.casefold() == key_fold:
+            keys[k] = value
+            break
+    else:
+        keys[key] = value
+
+
+def run_scan(key_dicts: List[Dict[str, str]]) -> None:
+    """Do the lookups by scanning each dict."""
+    for keys in key_dicts:
+        for key in LOOKUPS:
+            scan_get(keys, key)
+        scan_set(keys, 'renderamt', '255')
+
+
+def run_entity(ents: List[Entity]) -> None:
+    """Do the lookups with the entities."""
+    for ent in ents:
+        for key in LOOKUPS:
+            ent[key]
+        ent['renderamt'] = '255'
+
+
+def main(count: int) -> None:
+    """Time each implementation."""
+    vmf = make_vmf(count)
+    print(f'{count} entities, {len(LOOKUPS)} lookups and 1 write each:')
+    key_dicts = [dict(ent.keys.items()) for ent in vmf.entities]
+    scan_time = min(timeit.repeat(lambda: run_scan(key_dicts), number=1, repeat=5))
+    ent_time = min(timeit.repeat(lambda: run_entity(vmf.entities), number=1, repeat=5))
+    print(f'Scanning keys: {scan_time:.3f}s')
+    print(f'Indexed keys: {ent_time:.3f}s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,68 @@
+"""Benchmark the BSP entity lump parser and writer.
+
+This generates a large synthetic entity lump, then times the Python and
+(if compiled) Cython implementations.
+Run with "python benchmarks/bench_entlump.py [entity count]".
+"""
+import random
+import sys
+import timeit
+
+from srctools import bsp
+from srctools.vmf import VMF, OUTPUT_SEP
+
+
+def make_lump(count: int) -> bytes:
+    """Generate an entity lump with the specified number of entities."""
+    rand = random.Random(1234)
+    lines = ['{', '"classname" "worldspawn"', '"mapversion" "1"', '}']
+    for i in range(count):
+        lines.append('{')
+        lines.append('"classname" "{}"'.format(rand.choice([
+            'prop_dynamic', 'logic_relay', 'func_brush', 'info_target',
+        ])))
+        lines.append('"targetname" "ent_{}"'.format(i))
+        lines.append('"origin" "{} {} {}"'.format(
+            rand.randint(-4096, 4096),
+            rand.randint(-4096, 4096),
+            rand.randint(-4096, 4096),
+        ))
+        lines.append('"angles" "0 {} 0"'.format(rand.randrange(0, 360, 15)))
+        lines.append('"spawnflags" "{}"'.format(rand.randrange(256)))
+        lines.append('"rendercolor" "255 255 255"')
+        for j in range(rand.randrange(4)):
+            lines.append('"OnUser{}" "ent_{}{sep}Trigger{sep}{sep}{}{sep}-1"'.format(
+                j + 1, rand.randrange(count), rand.random(),
+                sep=OUTPUT_SEP if rand.random() > 0.5 else ',',
+            ))
+        lines.append('}')
+    lines.append('\x00')
+    return '\n'.join(lines).encode('ascii')
+
+
+def main(count: int) -> None:
+    """Time each implementation."""
+    ent_data = make_lump(count)
+    print(f'{count} entities, {len(ent_data)} bytes:')
+    impls = [('Python', bsp._py_parse_ent_data, bsp._py_build_ent_data)]
+    if bsp._cy_parse_ent_data is not bsp._py_parse_ent_data:
+        impls.append(('Cython', bsp._cy_parse_ent_data, bsp._cy_build_ent_data))
+    else:
+        print('Cython version not compiled.')
+
+    for name, parse, build in impls:
+        vmf = VMF()
+        parse(vmf, ent_data)
+        parse_time = min(timeit.repeat(
+            lambda: parse(VMF(), ent_data),
+            number=1, repeat=5,
+        ))
+        build_time = min(timeit.repeat(
+            lambda: build(vmf, None),
+            number=1, repeat=5,
+        ))
+        print(f'{name}: parse = {parse_time:.3f}s, build = {build_time:.3f}s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
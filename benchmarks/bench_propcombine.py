@@ -0,0 +1,109 @@
+"""Benchmark automatic prop grouping in propcombine.
+
+This generates synthetic layouts of identical props, then times
+group_props_auto() against the original scan of every remaining prop.
+Run with "python benchmarks/bench_propcombine.py [prop count]".
+"""
+import random
+import sys
+import time
+from typing import Dict, Iterator, List, Optional
+
+from srctools import Vec
+from srctools.bsp import StaticProp
+from srctools.compiler.propcombine import MAX_GROUP, group_props_auto
+
+
+def make_props(count: int, layout: str) -> List[StaticProp]:
+    """Generate props scattered across the map, or in dense clumps."""
+    rand = random.Random(1234)
+    props = []
+    if layout == 'uniform':
+        for _ in range(count):
+            props.append(StaticProp(
+                'models/props/tree.mdl',
+                Vec(rand.uniform(-8192, 8192), rand.uniform(-8192, 8192), rand.uniform(0, 256)),
+                Vec(), 1.0, [], 6,
+            ))
+    else:
+        clumps = [
+            Vec(rand.uniform(-8192, 8192), rand.uniform(-8192, 8192), 0)
+            for _ in range(count // 50 + 1)
+        ]
+        for _ in range(count):
+            center = rand.choice(clumps)
+            props.append(StaticProp(
+                'models/props/grass.mdl',
+                center + Vec(rand.gauss(0, 128), rand.gauss(0, 128), rand.uniform(0, 16)),
+                Vec(), 1.0, [], 6,
+            ))
+    return props
+
+
+def group_props_scan(
+    prop_groups: Dict[Optional[tuple], List[StaticProp]],
+    rejected: List[StaticProp],
+    dist: float,
+    min_cluster: int,
+) -> Iterator[List[StaticProp]]:
+    """The original implementation, checking every remaining prop for each cluster."""
+    dist_sq = dist * dist
+    large_dist_sq = 4 * dist_sq
+    for group in prop_groups.values():
+        if len(group) < 2:
+            rejected.extend(group)
+            continue
+        todo = dict.fromkeys(group)
+        while todo:
+            center = next(iter(todo))
+            del todo[center]
+            cluster = [center]
+            for prop in todo:
+                if (center.origin - prop.origin).mag_sq() <= large_dist_sq:
+                    cluster.append(prop)
+                    if len(cluster) > MAX_GROUP:
+                        break
+            if len(cluster) < min_cluster:
+                rejected.append(center)
+                continue
+            bbox_min, bbox_max = Vec.bbox(prop.origin for prop in cluster)
+            center_pos = (bbox_min + bbox_max) / 2
+            cluster_list = []
+            for prop in cluster:
+                prop_off = (center_pos - prop.origin).mag_sq()
+                if prop_off <= dist_sq:
+                    cluster_list.append((prop, prop_off))
+            cluster_list.sort(key=lambda t: t[1])
+            selected_props = [prop for prop, off in cluster_list[:MAX_GROUP]]
+            for prop in selected_props:
+                todo.pop(prop, None)
+            if len(selected_props) >= min_cluster:
+                yield selected_props
+            else:
+                rejected.extend(selected_props)
+
+
+def main(count: int) -> None:
+    """Time each implementation."""
+    for layout in ['uniform', 'clumped']:
+        props = make_props(count, layout)
+        print(f'{count} props, {layout}:')
+        impls = [('grid', group_props_auto)]
+        if count <= 20000:
+            impls.append(('scan', group_props_scan))
+        else:
+            print('Skipping full scan, too slow.')
+        results = []
+        for name, func in impls:
+            rejected = []
+            start = time.perf_counter()
+            groups = list(func({None: props}, rejected, 256.0, 2))
+            duration = time.perf_counter() - start
+            print(f'{name}: {duration:.3f}s, {len(groups)} groups, {len(rejected)} rejected')
+            results.append((groups, rejected))
+        if len(results) > 1 and results[0] != results[1]:
+            print('Results differ!')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
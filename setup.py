@@ -69,6 +69,10 @@ setup(
             sources=["srctools/_vec" + cy_ext],
             # extra_compile_args=['/FAs'],  # MS ASM dump
         ),
+        Extension(
+            "srctools._bsp_entlump",
+            sources=["srctools/_bsp_entlump" + cy_ext],
+        ),
     ]),
 
     package_data={'srctools': [
@@ -0,0 +1,179 @@
+# cython: language_level=3, embedsignature=True, auto_pickle=False
+# cython: binding=True
+"""Cython version of the BSP entity lump parser and writer.
+
+These match _py_parse_ent_data() and _py_build_ent_data() in srctools.bsp.
+"""
+cimport cython
+from libc.string cimport memchr
+
+cdef extern from *:
+    unicode PyUnicode_DecodeASCII(const char *s, Py_ssize_t size, const char *errors)
+
+cdef object Entity, Output, OUTPUT_SEP, parse_name
+from srctools.vmf import Entity, Output, OUTPUT_SEP
+parse_name = Output.parse_name
+
+__all__ = ['parse_ent_data', 'build_ent_data']
+
+
+cdef object parse_output(str key, str value, str sep):
+    """Parse an output from the entity lump."""
+    try:
+        targ, inp, param, delay, times = value.split(sep)
+    except ValueError as e:
+        raise ValueError('Bad output value: "{}"'.format(value)) from e
+
+    inst_out, out = parse_name(key)
+    inst_inp, inp = parse_name(inp)
+
+    return Output(
+        out,
+        targ,
+        inp,
+        param=param,
+        delay=float(delay),
+        times=int(times),
+        inst_out=inst_out,
+        inst_in=inst_inp,
+        comma_sep=sep == ',',
+    )
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def parse_ent_data(vmf, bytes ent_data not None) -> None:
+    """Parse the entity lump, adding the entities to the VMF."""
+    cdef const char *buf = ent_data
+    cdef Py_ssize_t size = len(ent_data)
+    cdef Py_ssize_t pos = 0, start, end, sep_pos, i
+    cdef const char *newline
+    cdef char c
+    cdef bint seen_spawn = False  # The first entity is worldspawn.
+    cdef dict cur_keys = None  # None when between brackets.
+    # Casefolded key -> the first key name used.
+    cdef dict cur_folded = None
+    cdef list cur_outputs = None
+    cdef str key, value
+
+    while pos < size:
+        # Find the end of the line, then skip over the newline for next time.
+        start = pos
+        newline = <const char *>memchr(buf + pos, b'\n', size - pos)
+        if newline == NULL:
+            end = size
+        else:
+            end = newline - buf
+        pos = end + 1
+        # Handle CRLF, or lone CRs.
+        for i in range(start, end):
+            if buf[i] == b'\r':
+                pos = i + 1
+                if i + 1 < size and buf[i + 1] == b'\n':
+                    pos += 1
+                end = i
+                break
+
+        if end - start == 1:
+            c = buf[start]
+            if c == b'{':
+                if cur_keys is not None:
+                    raise ValueError(
+                        '2 levels of nesting after {} ents'.format(
+                            len(vmf.entities)
+                        )
+                    )
+                cur_keys = {}
+                cur_folded = {}
+                cur_outputs = []
+                continue
+            elif c == b'}':
+                if cur_keys is None:
+                    raise ValueError(
+                        f'Too many closing brackets after'
+                        f' {len(vmf.entities)} ents!'
+                    )
+                if not seen_spawn:
+                    seen_spawn = True
+                    # The spawn ent is stored in the attribute, not in the
+                    # ent list.
+                    for key, value in cur_keys.items():
+                        vmf.spawn[key] = value
+                    vmf.spawn.add_out(*cur_outputs)
+                    if vmf.spawn['classname'] != 'worldspawn':
+                        raise ValueError('No worldspawn entity!')
+                else:
+                    vmf.add_ent(Entity(vmf, keys=cur_keys, outputs=cur_outputs))
+                cur_keys = None
+                continue
+            elif c == 0:  # Null byte at end of lump.
+                if cur_keys is not None:
+                    raise ValueError("Last entity didn't end!")
+                return
+        elif end == start:
+            continue
+
+        if cur_keys is None:
+            raise ValueError("Keyvalue outside brackets!")
+
+        # Line is of the form <"key" "val">. Find the separator, and check
+        # there's only one.
+        sep_pos = -1
+        i = start
+        while i + 2 < end:
+            if buf[i] == b'"' and buf[i + 1] == b' ' and buf[i + 2] == b'"':
+                if sep_pos != -1:
+                    raise ValueError('too many values to unpack (expected 2)')
+                sep_pos = i
+                i += 3
+            else:
+                i += 1
+        if sep_pos == -1:
+            raise ValueError('not enough values to unpack (expected 2, got 1)')
+
+        # Strip the quotes from either end.
+        if sep_pos - start > 1:
+            key = PyUnicode_DecodeASCII(buf + start + 1, sep_pos - start - 1, NULL)
+        else:
+            key = ''
+        if end - sep_pos > 4:
+            value = PyUnicode_DecodeASCII(buf + sep_pos + 3, end - sep_pos - 4, NULL)
+        else:
+            value = ''
+
+        # Now, we need to figure out if this is a keyvalue,
+        # or connection.
+        # If we're L4D+, this is easy - they use 0x1B as separator.
+        # Before, it's a comma which is common in keyvalues.
+        # Assume it's an output if it has exactly 4 commas, and the last two
+        # successfully parse as numbers.
+        if OUTPUT_SEP in value:
+            cur_outputs.append(parse_output(key, value, OUTPUT_SEP))
+            continue
+        elif value.count(',') == 4:
+            try:
+                cur_outputs.append(parse_output(key, value, ','))
+                continue
+            except ValueError:
+                pass
+        # Normal keyvalue. Keys are case-insensitive, keeping the first
+        # case used.
+        cur_keys[cur_folded.setdefault(key.casefold(), key)] = value
+
+
+def build_ent_data(vmf, object use_comma_sep) -> bytes:
+    """Generate the entity lump."""
+    cdef list out = []
+    cdef str key, value
+    for ent in [vmf.spawn] + vmf.entities:
+        out.append('{\n')
+        for key, value in ent.keys.items():
+            out.append(f'"{key}" "{value}"\n')
+        for output in ent.outputs:
+            if use_comma_sep is not None:
+                output.comma_sep = use_comma_sep
+            out.append(output._get_text())
+        out.append('}\n')
+    out.append('\x00')
+
+    return ''.join(out).encode('ascii')
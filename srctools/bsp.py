@@ -2,21 +2,32 @@
 
 """
 import contextlib
+import functools
+import io
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+from array import array
 
 from io import BytesIO
 from enum import Enum, Flag
 import itertools
+import operator
 
 from zipfile import ZipFile
 
 from srctools import AtomicWriter, Vec, conv_int
 from srctools.fgd import FGD, EntityDef, EntityTypes
-from srctools.vmf import VMF, Entity, Output
+from srctools.vmf import VMF, Entity, Output, OUTPUT_SEP
 from srctools.binformat import struct_read, DeferredWrites
-from srctools.property_parser import Property
+from srctools.vpk import ViewFile
 import struct
 
-from typing import List, Dict, Iterator, Union, Optional, BinaryIO, Tuple
+from typing import (
+    List, Dict, Iterator, Union, Optional, BinaryIO, Tuple, Callable,
+)
 
 
 __all__ = [
@@ -31,6 +42,9 @@ HEADER_1 = '<4si'  # Header section before the lump list.
 HEADER_LUMP = '<3i4s'  # Header section for each lump.
 HEADER_2 = '<i'  # Header section after the lumps.
 
+# When writing out lumps directly from the mapped file, copy this much at a time.
+COPY_CHUNK_SIZE = 1 << 20
+
 
 class VERSIONS(Enum):
     """The BSP version numbers for various games."""
@@ -173,6 +187,102 @@ LUMP_WRITE_ORDER.remove(BSP_LUMPS.PAKFILE)
 LUMP_WRITE_ORDER.append(BSP_LUMPS.PAKFILE)
 
 
+# Every value which may be stored for a static prop, and the default used if
+# the lump version doesn't include it.
+_STATIC_PROP_FIELDS = [
+    ('origin_x', None), ('origin_y', None), ('origin_z', None),
+    ('angle_x', None), ('angle_y', None), ('angle_z', None),
+    ('model_ind', None),
+    ('first_leaf', None), ('leaf_count', None),
+    ('solidity', None), ('flags', None),
+    ('skin', None),
+    ('min_fade', None), ('max_fade', None),
+    ('light_x', None), ('light_y', None), ('light_z', None),
+    ('fade_scale', 1.0),
+    ('min_dx_level', 0), ('max_dx_level', 0),
+    ('min_cpu_level', 0), ('max_cpu_level', 0),
+    ('min_gpu_level', 0), ('max_gpu_level', 0),
+    ('tint_r', 255), ('tint_g', 255), ('tint_b', 255),  # No tint.
+    ('renderfx', 255),
+    ('flags_sec', 0),
+    ('scaling', 1.0),
+    ('disable_on_xbox', False),
+]
+_STATIC_PROP_NAMES = [name for name, default in _STATIC_PROP_FIELDS]
+_STATIC_PROP_DEFAULTS = tuple([default for name, default in _STATIC_PROP_FIELDS])
+
+
+@functools.lru_cache(maxsize=None)
+def _static_prop_struct(version: int) -> Tuple[
+    struct.Struct,
+    Callable[[tuple], tuple],
+    Callable[[tuple], tuple],
+]:
+    """Build the structure for a single static prop, for each lump version.
+
+    This returns the struct, then two functions. The first converts the
+    unpacked tuple (concatenated with _STATIC_PROP_DEFAULTS) into the values
+    in _STATIC_PROP_FIELDS. The second does the reverse, producing values to pack.
+    """
+    fields = [
+        ('origin_x', 'f'), ('origin_y', 'f'), ('origin_z', 'f'),
+        ('angle_x', 'f'), ('angle_y', 'f'), ('angle_z', 'f'),
+        ('model_ind', 'H'),
+        ('first_leaf', 'H'), ('leaf_count', 'H'),
+        ('solidity', 'B'), ('flags', 'B'),
+        ('skin', 'i'),
+        ('min_fade', 'f'), ('max_fade', 'f'),
+        ('light_x', 'f'), ('light_y', 'f'), ('light_z', 'f'),
+    ]
+    if version >= 5:
+        fields.append(('fade_scale', 'f'))
+
+    if version in (6, 7):
+        # Replaced by GPU & CPU in later versions.
+        fields += [('min_dx_level', 'H'), ('max_dx_level', 'H')]
+
+    if version >= 8:
+        fields += [
+            ('min_cpu_level', 'B'), ('max_cpu_level', 'B'),
+            ('min_gpu_level', 'B'), ('max_gpu_level', 'B'),
+        ]
+
+    if version >= 7:
+        # Alpha isn't used.
+        fields += [
+            ('tint_r', 'B'), ('tint_g', 'B'), ('tint_b', 'B'),
+            ('renderfx', 'B'),
+        ]
+
+    fmt = '<' + ''.join([code for name, code in fields])
+    if version >= 11:
+        # Unknown data, though it's float-like. Always zero.
+        fmt += '4x'
+
+    if version >= 10:
+        # Extra flags, post-CSGO.
+        fields.append(('flags_sec', 'I'))
+        fmt += 'I'
+
+    if version >= 11:
+        # XBox support was removed. Instead this is the scaling factor.
+        fields.append(('scaling', 'f'))
+        fmt += 'f'
+    elif version >= 9:
+        # The single boolean byte also produces 3 pad bytes.
+        fields.append(('disable_on_xbox', '?'))
+        fmt += '?3x'
+
+    names = [name for name, code in fields]
+    # Missing values are taken from the defaults appended on the end.
+    read_order = operator.itemgetter(*[
+        names.index(name) if name in names else len(names) + i
+        for i, name in enumerate(_STATIC_PROP_NAMES)
+    ])
+    write_order = operator.itemgetter(*map(_STATIC_PROP_NAMES.index, names))
+    return struct.Struct(fmt), read_order, write_order
+
+
 class StaticPropFlags(Flag):
     """Bitflags specified for static props."""
     NONE = 0
@@ -202,21 +312,53 @@ class StaticPropFlags(Flag):
 
 
 class BSP:
-    """A BSP file."""
-    def __init__(self, filename: str, version: VERSIONS=None):
+    """A BSP file.
+
+    If lazy is set, the file is memory-mapped instead of read fully into memory.
+    Lumps are then only read when their data is accessed, and untouched lumps are
+    copied directly from the original file when saving. In this mode call
+    close() (or use the BSP as a context manager) to release the file.
+    """
+    def __init__(self, filename: str, version: VERSIONS=None, lazy: bool=False):
         self.filename = filename
         self.map_revision = -1  # The map's revision count
         self.lumps = {}  # type: Dict[BSP_LUMPS, Lump]
         self.game_lumps = {}  # type: Dict[bytes, GameLump]
         self.header_off = 0
         self.version = version  # type: Optional[Union[VERSIONS, int]]
+        self.lazy = lazy
+        # If lazy, the mapping for the file on disk.
+        self._mmap = None  # type: Optional[mmap.mmap]
 
         self.read()
 
+    def __enter__(self) -> 'BSP':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Release the memory-mapped file, if this BSP was opened lazily.
+
+        Lumps which have not yet been read become inaccessible.
+        """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _open_mapping(self) -> mmap.mmap:
+        """Memory-map the BSP file, for lazy mode."""
+        with open(self.filename, mode='rb') as file:
+            # The mapping remains valid after the file is closed.
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
     def read(self) -> None:
         """Load all data."""
         self.lumps.clear()
         self.game_lumps.clear()
+        self.close()
 
         with open(self.filename, mode='br') as file:
             # BSP files start with 'VBSP', then a version number.
@@ -246,17 +388,27 @@ class BSP:
 
             [self.map_revision] = struct_read(HEADER_2, file)
 
+            if self.lazy:
+                mapping = self._open_mapping()
+            else:
+                mapping = None
+
             for lump in self.lumps.values():
                 # Now read in each lump.
                 offset, length = lump_offsets[lump.type]
-                file.seek(offset)
-                lump.data = file.read(length)
+                if mapping is None:
+                    file.seek(offset)
+                    lump.data = file.read(length)
+                lump._set_location(offset, length, mapping)
 
+            # We always need the game lump directory.
+            offset, length = lump_offsets[BSP_LUMPS.GAME_LUMP]
             game_lump = self.lumps[BSP_LUMPS.GAME_LUMP]
+            game_lump_data = game_lump.data
 
             self.game_lumps.clear()
 
-            [lump_count] = struct.unpack_from('<i', game_lump.data)
+            [lump_count] = struct.unpack_from('<i', game_lump_data)
             lump_offset = 4
 
             for _ in range(lump_count):
@@ -266,89 +418,327 @@ class BSP:
                     glump_version,
                     file_off,
                     file_len,
-                ) = GameLump.ST.unpack_from(game_lump.data, lump_offset)  # type: bytes, int, int, int, int
+                ) = GameLump.ST.unpack_from(game_lump_data, lump_offset)  # type: bytes, int, int, int, int
                 lump_offset += GameLump.ST.size
 
-                file.seek(file_off)
-
                 # The lump ID is backward..
                 game_lump_id = game_lump_id[::-1]
 
-                self.game_lumps[game_lump_id] = GameLump(
+                if mapping is None:
+                    file.seek(file_off)
+                    data = file.read(file_len)
+                else:
+                    data = b''
+                self.game_lumps[game_lump_id] = sub_lump = GameLump(
                     game_lump_id,
                     flags,
                     glump_version,
-                    file.read(file_len),
+                    data,
                 )
+                sub_lump._set_location(file_off, file_len, mapping)
             # This is not valid any longer.
             game_lump.data = b''
+            game_lump._set_location(offset, length)
+            self._game_lump_header = self._game_lump_dir()
 
-    def save(self, filename=None) -> None:
-        """Write the BSP back into the given file."""
+    def _game_lump_dir(self) -> List[Tuple[bytes, int, int]]:
+        """Return the ID, flags and version of each game lump.
 
-        game_lumps = list(self.game_lumps.values())  # Lock iteration order.
+        If this changes, the game lump directory needs to be rewritten.
+        """
+        return [
+            (game_lump.id, game_lump.flags, game_lump.version)
+            for game_lump in self.game_lumps.values()
+        ]
 
-        with AtomicWriter(filename or self.filename, is_bytes=True) as file:  # type: BinaryIO
-            # Needed to allow writing out the header before we know the position
-            # data will be.
-            defer = DeferredWrites(file)
+    def _update_locations(self, locations: Dict[Union[BSP_LUMPS, bytes], Tuple[int, int]]) -> None:
+        """After saving over our own file, record where each lump is now located.
 
-            if isinstance(self.version, VERSIONS):
-                version = self.version.value
+        In lazy mode, this also remaps the file so all lumps are freshly read
+        from the new file, freeing the memory used by the modified lumps.
+        """
+        if self.lazy:
+            self.close()
+            mapping = self._open_mapping()
+        else:
+            mapping = None
+        for lump in self.lumps.values():
+            offset, length = locations[lump.type]
+            if lump.type is BSP_LUMPS.GAME_LUMP:
+                # This data is never stored.
+                lump._set_location(offset, length)
             else:
-                version = self.version
-
-            file.write(struct.pack(HEADER_1, BSP_MAGIC, version))
-
-            # Write headers.
-            for lump_name in BSP_LUMPS:
-                lump = self.lumps[lump_name]
-                defer.defer(lump_name, '<ii')
-                file.write(struct.pack(
-                    HEADER_LUMP,
-                    0,  # offset
-                    0,  # length
-                    lump.version,
-                    bytes(lump.ident),
-                ))
+                lump._set_location(offset, length, mapping)
+        for game_lump in self.game_lumps.values():
+            game_lump._set_location(*locations[game_lump.id], mapping)
+        self._game_lump_header = self._game_lump_dir()
+
+    def _remap(self) -> None:
+        """If a save failed, map the file again for any lumps not yet read."""
+        if not self.lazy or self._mmap is not None:
+            return
+        mapping = self._open_mapping()
+        for lump in itertools.chain(self.lumps.values(), self.game_lumps.values()):
+            if lump._mmap is not None:
+                lump._set_location(lump._offset, lump._length, mapping)
+
+    def _write_game_lump(
+        self,
+        file: BinaryIO,
+        locations: Dict[Union[BSP_LUMPS, bytes], Tuple[int, int]],
+    ) -> None:
+        """Write the game lump directory, followed by all the game lumps."""
+        game_lumps = list(self.game_lumps.values())  # Lock iteration order.
+        defer = DeferredWrites(file)
+        lump_start = file.tell()
+        file.write(struct.pack('<i', len(game_lumps)))
+        for game_lump in game_lumps:
+            file.write(struct.pack(
+                '<4s HH',
+                game_lump.id[::-1],
+                game_lump.flags,
+                game_lump.version,
+            ))
+            defer.defer(game_lump.id, '<i', write=True)
+            file.write(struct.pack('<i', game_lump._size()))
+
+        # Now write data.
+        for game_lump in game_lumps:
+            offset = file.tell()
+            defer.set_data(game_lump.id, offset)
+            locations[game_lump.id] = offset, game_lump._write_to(file)
+        defer.write()
+        # Length of the game lump is current - start.
+        locations[BSP_LUMPS.GAME_LUMP] = lump_start, file.tell() - lump_start
+
+    def _write_lump(
+        self,
+        file: BinaryIO,
+        lump: 'Lump',
+        locations: Dict[Union[BSP_LUMPS, bytes], Tuple[int, int]],
+    ) -> None:
+        """Write out the data for a lump at the current position."""
+        if lump.type is BSP_LUMPS.GAME_LUMP:
+            # Construct this right here.
+            self._write_game_lump(file, locations)
+        else:
+            offset = file.tell()
+            locations[lump.type] = offset, lump._write_to(file)
 
-            # After lump headers, the map revision...
-            file.write(struct.pack(HEADER_2, self.map_revision))
-
-            # Then each lump.
-            for lump_name in LUMP_WRITE_ORDER:
-                # Write out the actual data.
-                lump = self.lumps[lump_name]
-                if lump_name is BSP_LUMPS.GAME_LUMP:
-                    # Construct this right here.
-                    lump_start = file.tell()
-                    file.write(struct.pack('<i', len(game_lumps)))
-                    for game_lump in game_lumps:
-                        file.write(struct.pack(
-                            '<4s HH',
-                            game_lump.id[::-1],
-                            game_lump.flags,
-                            game_lump.version,
-                        ))
-                        defer.defer(game_lump.id, '<i', write=True)
-                        file.write(struct.pack('<i', len(game_lump.data)))
-
-                    # Now write data.
-                    for game_lump in game_lumps:
-                        defer.set_data(game_lump.id, file.tell())
-                        file.write(game_lump.data)
-                    # Length of the game lump is current - start.
-                    defer.set_data(
-                        lump_name,
-                        lump_start,
-                        file.tell() - lump_start,
-                    )
+    def _write_header(
+        self,
+        file: BinaryIO,
+        locations: Dict[Union[BSP_LUMPS, bytes], Tuple[int, int]],
+    ) -> None:
+        """Write the header, given the location of each lump."""
+        if isinstance(self.version, VERSIONS):
+            version = self.version.value
+        else:
+            version = self.version
+
+        file.write(struct.pack(HEADER_1, BSP_MAGIC, version))
+        for lump_name in BSP_LUMPS:
+            lump = self.lumps[lump_name]
+            offset, length = locations.get(lump_name, (0, 0))
+            file.write(struct.pack(
+                HEADER_LUMP,
+                offset,
+                length,
+                lump.version,
+                bytes(lump.ident),
+            ))
+        # After lump headers, the map revision...
+        file.write(struct.pack(HEADER_2, self.map_revision))
+
+    def save(self, filename=None, incremental: bool=False) -> None:
+        """Write the BSP back into the given file.
+
+        In lazy mode, lumps which have not been modified are copied directly
+        from the original file.
+
+        If incremental is set and the BSP is being saved back to its original
+        file, only modified lumps are written. These are overwritten in place
+        if they fit, otherwise the file is truncated after the last unmodified
+        lump and they are appended. The header is then patched to match.
+        Streamed lumps are first written to a temporary file, then appended.
+        Unlike a regular save this is not atomic. If the layout would waste
+        too much space, a full save is performed instead.
+        """
+        same_file = filename is None or os.path.abspath(filename) == os.path.abspath(self.filename)
+        if incremental and same_file and self._save_incremental():
+            return
+
+        # Record where each lump ends up, so we can find them again if we
+        # overwrote ourselves.
+        locations = {}  # type: Dict[Union[BSP_LUMPS, bytes], Tuple[int, int]]
+        saved = False
+
+        try:
+            with AtomicWriter(filename or self.filename, is_bytes=True) as file:  # type: BinaryIO
+                # Write a blank header, filled in once we know where the data
+                # will be.
+                self._write_header(file, locations)
+
+                # Then each lump.
+                for lump_name in LUMP_WRITE_ORDER:
+                    self._write_lump(file, self.lumps[lump_name], locations)
+
+                file.seek(0)
+                self._write_header(file, locations)
+                if same_file:
+                    # The original needs to be unmapped before it can be
+                    # replaced on Windows.
+                    self.close()
+            saved = True
+        finally:
+            if same_file:
+                if saved:
+                    self._update_locations(locations)
                 else:
-                    # Normal lump.
-                    defer.set_data(lump_name, file.tell(), len(lump.data))
-                    file.write(lump.data)
-            # Apply all the deferred writes.
-            defer.write()
+                    self._remap()
+
+    def _save_incremental(self) -> bool:
+        """Save only the modified lumps back into our original file.
+
+        If this is not possible, False is returned.
+        """
+        # Streams may read from the region we'd overwrite, so run them into
+        # temporary files first. These are then appended to the BSP.
+        with contextlib.ExitStack() as stack:
+            spooled = {}  # type: Dict[BSP_LUMPS, Tuple[BinaryIO, int]]
+            for lump in self.lumps.values():
+                if lump._stream is not None:
+                    spool = stack.enter_context(tempfile.TemporaryFile())
+                    spooled[lump.type] = spool, lump._write_to(spool)
+            return self._save_lumps_incremental(spooled)
+
+    def _save_lumps_incremental(self, spooled: Dict[BSP_LUMPS, Tuple[BinaryIO, int]]) -> bool:
+        """Write the modified lumps in place, given the data for streamed lumps."""
+        header_size = (
+            struct.calcsize(HEADER_1)
+            + LUMP_COUNT * struct.calcsize(HEADER_LUMP)
+            + struct.calcsize(HEADER_2)
+        )
+
+        dirty = {
+            lump.type for lump in self.lumps.values()
+            if lump._dirty
+        }
+        game_dirty = self._game_lump_header != self._game_lump_dir() or any(
+            sub_lump._dirty for sub_lump in self.game_lumps.values()
+        )
+        if game_dirty:
+            dirty.add(BSP_LUMPS.GAME_LUMP)
+        else:
+            dirty.discard(BSP_LUMPS.GAME_LUMP)
+
+        def compute_layout() -> Tuple[int, List[Tuple[int, int]]]:
+            """Find the regions of the file which are still used."""
+            regions = []  # type: List[Tuple[int, int]]
+            for lump in self.lumps.values():
+                if lump.type in dirty or lump._length == 0:
+                    continue
+                regions.append((lump._offset, lump._offset + lump._length))
+                if lump.type is BSP_LUMPS.GAME_LUMP:
+                    for sub_lump in self.game_lumps.values():
+                        if sub_lump._length:
+                            regions.append((sub_lump._offset, sub_lump._offset + sub_lump._length))
+            return max([header_size] + [end for start, end in regions]), regions
+
+        clean_end, clean_regions = compute_layout()
+
+        pak_lump = self.lumps[BSP_LUMPS.PAKFILE]
+        if (
+            dirty - {BSP_LUMPS.PAKFILE} and
+            pak_lump.type not in dirty and
+            pak_lump._length > 0 and
+            pak_lump._offset + pak_lump._length == clean_end
+        ):
+            # Other lumps may need to be appended, but keep the packfile at
+            # the end so generic zip programs can read it. That requires
+            # moving it.
+            pak_lump.data = pak_lump.data
+            dirty.add(BSP_LUMPS.PAKFILE)
+            clean_end, clean_regions = compute_layout()
+
+        def sizeof(lump: Lump) -> int:
+            """Compute the size of a lump."""
+            if lump.type in spooled:
+                return spooled[lump.type][1]
+            if lump.type is BSP_LUMPS.GAME_LUMP:
+                return 4 + GameLump.ST.size * len(self.game_lumps) + sum(
+                    sub_lump._size() for sub_lump in self.game_lumps.values()
+                )
+            return lump._size()
+
+        # Decide where to write each modified lump.
+        in_place = []  # type: List[Lump]
+        appended = []  # type: List[Lump]
+        for lump_name in LUMP_WRITE_ORDER:
+            if lump_name not in dirty:
+                continue
+            lump = self.lumps[lump_name]
+            start = lump._offset
+            end = start + lump._length
+            if (
+                lump.type not in spooled and
+                0 < sizeof(lump) <= lump._length and
+                header_size <= start and end <= clean_end and
+                not any(
+                    start < reg_end and reg_start < end
+                    for reg_start, reg_end in clean_regions
+                )
+            ):
+                in_place.append(lump)
+                # Don't let another lump which shares this region overwrite it.
+                clean_regions.append((start, end))
+            else:
+                appended.append(lump)
+
+        total_size = clean_end + sum(map(sizeof, appended))
+        used_size = header_size + sum(map(sizeof, self.lumps.values()))
+        if total_size - used_size > total_size // 4:
+            # Too much dead space, rewrite the whole file to compact it.
+            return False
+
+        # We're about to overwrite data, so read everything which is going
+        # to be moved, then unmap the file.
+        if game_dirty:
+            for sub_lump in self.game_lumps.values():
+                sub_lump.data = sub_lump.data
+        self.close()
+
+        locations = {}  # type: Dict[Union[BSP_LUMPS, bytes], Tuple[int, int]]
+        for lump in self.lumps.values():
+            locations[lump.type] = lump._offset, lump._length
+        for sub_lump in self.game_lumps.values():
+            locations[sub_lump.id] = sub_lump._offset, sub_lump._length
+
+        saved = False
+        try:
+            with open(self.filename, 'r+b') as file:
+                for lump in in_place:
+                    file.seek(lump._offset)
+                    self._write_lump(file, lump, locations)
+                file.seek(clean_end)
+                file.truncate()
+                for lump in appended:
+                    if lump.type in spooled:
+                        spool, size = spooled[lump.type]
+                        locations[lump.type] = file.tell(), size
+                        spool.seek(0)
+                        shutil.copyfileobj(spool, file, COPY_CHUNK_SIZE)
+                    else:
+                        self._write_lump(file, lump, locations)
+                file.seek(0)
+                self._write_header(file, locations)
+            saved = True
+        finally:
+            if saved:
+                self._update_locations(locations)
+            else:
+                self._remap()
+        return True
 
     def read_header(self) -> None:
         """No longer used."""
@@ -439,73 +829,8 @@ class BSP:
         This returns a VMF object, with entities mirroring that in the BSP. 
         No brushes are read.
         """
-        ent_data = self.get_lump(BSP_LUMPS.ENTITIES)
         vmf = VMF()
-        cur_ent = None  # None when between brackets.
-        seen_spawn = False  # The first entity is worldspawn.
-        
-        # This code performs the same thing as property_parser, but simpler
-        # since there's no nesting, comments, or whitespace, except between
-        # key and value. We also operate directly on the (ASCII) binary.
-        for line in ent_data.splitlines():
-            if line == b'{':
-                if cur_ent is not None:
-                    raise ValueError(
-                        '2 levels of nesting after {} ents'.format(
-                            len(vmf.entities)
-                        )
-                    )
-                if not seen_spawn:
-                    cur_ent = vmf.spawn
-                    seen_spawn = True
-                else:
-                    cur_ent = Entity(vmf)
-                continue
-            elif line == b'}':
-                if cur_ent is None:
-                    raise ValueError(
-                        f'Too many closing brackets after'
-                        f' {len(vmf.entities)} ents!'
-                    )
-                if cur_ent is vmf.spawn:
-                    if cur_ent['classname'] != 'worldspawn':
-                        raise ValueError('No worldspawn entity!')
-                else:
-                    # The spawn ent is stored in the attribute, not in the ent
-                    # list.
-                    vmf.add_ent(cur_ent)
-                cur_ent = None
-                continue
-            elif line == b'\x00':  # Null byte at end of lump.
-                if cur_ent is not None:
-                    raise ValueError("Last entity didn't end!")
-                return vmf
-
-            if cur_ent is None:
-                raise ValueError("Keyvalue outside brackets!")
-
-            # Line is of the form <"key" "val">
-            key, value = line.split(b'" "')
-            decoded_key = key[1:].decode('ascii')
-            decoded_value = value[:-1].decode('ascii')
-
-            # Now, we need to figure out if this is a keyvalue,
-            # or connection.
-            # If we're L4D+, this is easy - they use 0x1D as separator.
-            # Before, it's a comma which is common in keyvalues.
-            # Assume it's an output if it has exactly 4 commas, and the last two
-            # successfully parse as numbers.
-            if 27 in value:
-                # All outputs use the comma_sep, so we can ID them.
-                cur_ent.add_out(Output.parse(Property(decoded_key, decoded_value)))
-            elif value.count(b',') == 4:
-                try:
-                    cur_ent.add_out(Output.parse(Property(decoded_key, decoded_value)))
-                except ValueError:
-                    cur_ent[decoded_key] = decoded_value
-            else:
-                # Normal keyvalue.
-                cur_ent[decoded_key] = decoded_value
+        _parse_ent_data(vmf, self.get_lump(BSP_LUMPS.ENTITIES))
 
         # This keyvalue needs to be stored in the VMF object too.
         # The one in the entity is ignored.
@@ -522,19 +847,7 @@ class BSP:
 
         use_comma_sep can be used to force using either commas, or 0x1D in I/O.
         """
-        out = BytesIO()
-        for ent in itertools.chain([vmf.spawn], vmf.entities):
-            out.write(b'{\n')
-            for key, value in ent.keys.items():
-                out.write('"{}" "{}"\n'.format(key, value).encode('ascii'))
-            for output in ent.outputs:
-                if use_comma_sep is not None:
-                    output.comma_sep = use_comma_sep
-                out.write(output._get_text().encode('ascii'))
-            out.write(b'}\n')
-        out.write(b'\x00')
-
-        return out.getvalue()
+        return _build_ent_data(vmf, use_comma_sep)
 
     def static_prop_models(self) -> Iterator[str]:
         """Yield all model filenames used in static props."""
@@ -564,101 +877,59 @@ class BSP:
             # Predates HL2...
             raise ValueError('Static prop version {} is too old!')
 
-        static_lump = BytesIO(self.game_lumps[b'sprp'].data)
+        prop_struct, read_order, write_order = _static_prop_struct(version)
+        data = self.game_lumps[b'sprp'].data
+        static_lump = BytesIO(data)
 
         # Array of model filenames.
         model_dict = list(self._read_static_props_models(static_lump))
 
         [visleaf_count] = struct_read('<i', static_lump)
-        visleaf_list = list(struct_read('H' * visleaf_count, static_lump))
+        visleaf_list = array('H', static_lump.read(2 * visleaf_count))
+        if sys.byteorder == 'big':
+            visleaf_list.byteswap()
 
         [prop_count] = struct_read('<i', static_lump)
-
-        for i in range(prop_count):
-            origin = Vec(struct_read('fff', static_lump))
-            angles = Vec(struct_read('fff', static_lump))
-
-            [model_ind] = struct_read('<H', static_lump)
-
+        start = static_lump.tell()
+        end = start + prop_count * prop_struct.size
+        if len(data) < end:
+            raise ValueError('Static prop lump is truncated!')
+
+        # Decode all the props at once, but only build the objects when
+        # required.
+        for values in prop_struct.iter_unpack(data[start:end]):
             (
-                first_leaf,
-                leaf_count,
-                solidity,
-                flags,
+                origin_x, origin_y, origin_z,
+                angle_x, angle_y, angle_z,
+                model_ind,
+                first_leaf, leaf_count,
+                solidity, flags,
                 skin,
-                min_fade,
-                max_fade,
-            ) = struct_read('<HHBBiff', static_lump)
-
-            model_name = model_dict[model_ind]
-
-            visleafs = visleaf_list[first_leaf:first_leaf + leaf_count]
-            lighting_origin = Vec(struct_read('<fff', static_lump))
-
-            if version >= 5:
-                fade_scale = struct_read('<f', static_lump)[0]
-            else:
-                fade_scale = 1  # default
-
-            if version in (6, 7):
-                min_dx_level, max_dx_level = struct_read('<HH', static_lump)
-            else:
-                # Replaced by GPU & CPU in later versions.
-                min_dx_level = max_dx_level = 0  # None
-
-            if version >= 8:
-                (
-                    min_cpu_level,
-                    max_cpu_level,
-                    min_gpu_level,
-                    max_gpu_level,
-                ) = struct_read('BBBB', static_lump)
-            else:
-                # None
-                min_cpu_level = max_cpu_level = 0
-                min_gpu_level = max_gpu_level = 0
-
-            if version >= 7:
-                r, g, b, renderfx = struct_read('BBBB', static_lump)
-                # Alpha isn't used.
-                tint = Vec(r, g, b)
-            else:
-                # No tint.
-                tint = Vec(255, 255, 255)
-                renderfx = 255
-
-            if version >= 11:
-                # Unknown data, though it's float-like.
-                unknown_1 = struct_read('<i', static_lump)
-
-            if version >= 10:
-                # Extra flags, post-CSGO.
-                flags |= struct_read('<I', static_lump)[0] << 8
-
-            flags = StaticPropFlags(flags)
-
-            scaling = 1.0
-            disable_on_xbox = False
-
-            if version >= 11:
-                # XBox support was removed. Instead this is the scaling factor.
-                [scaling] = struct_read("<f", static_lump)
-            elif version >= 9:
-                # The single boolean byte also produces 3 pad bytes.
-                [disable_on_xbox] = struct_read('<?xxx', static_lump)
+                min_fade, max_fade,
+                light_x, light_y, light_z,
+                fade_scale,
+                min_dx_level, max_dx_level,
+                min_cpu_level, max_cpu_level,
+                min_gpu_level, max_gpu_level,
+                tint_r, tint_g, tint_b,
+                renderfx,
+                flags_sec,
+                scaling,
+                disable_on_xbox,
+            ) = read_order(values + _STATIC_PROP_DEFAULTS)
 
             yield StaticProp(
-                model_name,
-                origin,
-                angles,
+                model_dict[model_ind],
+                Vec(origin_x, origin_y, origin_z),
+                Vec(angle_x, angle_y, angle_z),
                 scaling,
-                visleafs,
+                visleaf_list[first_leaf:first_leaf + leaf_count].tolist(),
                 solidity,
-                flags,
+                StaticPropFlags(flags | flags_sec << 8),
                 skin,
                 min_fade,
                 max_fade,
-                lighting_origin,
+                Vec(light_x, light_y, light_z),
                 fade_scale,
                 min_dx_level,
                 max_dx_level,
@@ -666,7 +937,7 @@ class BSP:
                 max_cpu_level,
                 min_gpu_level,
                 max_gpu_level,
-                tint,
+                Vec(tint_r, tint_g, tint_b),
                 renderfx,
                 disable_on_xbox,
             )
@@ -676,7 +947,7 @@ class BSP:
 
         # First generate the visleaf and model-names block.
         # Unfortunately it seems reusing visleaf parts isn't possible.
-        leaf_array = []  # type: List[int]
+        leaf_array = array('H')
         leaf_offsets = []  # type: List[int]
 
         models = set()
@@ -694,6 +965,7 @@ class BSP:
         }
 
         game_lump = self.game_lumps[b'sprp']
+        prop_struct, read_order, write_order = _static_prop_struct(game_lump.version)
 
         # Now write out the sections.
         prop_lump = BytesIO()
@@ -702,72 +974,15 @@ class BSP:
             prop_lump.write(struct.pack('<128s', name.encode('ascii')))
 
         prop_lump.write(struct.pack('<i', len(leaf_array)))
-        prop_lump.write(struct.pack('<{}H'.format(len(leaf_array)), *leaf_array))
+        if sys.byteorder == 'big':
+            leaf_array.byteswap()
+        prop_lump.write(leaf_array.tobytes())
 
         prop_lump.write(struct.pack('<i', len(props)))
-        for leaf_off, prop in zip(leaf_offsets, props):
-            prop_lump.write(struct.pack(
-                '<6fH',
-                prop.origin.x,
-                prop.origin.y,
-                prop.origin.z,
-                prop.angles.x,
-                prop.angles.y,
-                prop.angles.z,
-                model_ind[prop.model],
-            ))
-
-            prop_lump.write(struct.pack(
-                '<HHBBifffff',
-                leaf_off,
-                len(prop.visleafs),
-                prop.solidity,
-                prop.flags.value_prim,
-                prop.skin,
-                prop.min_fade,
-                prop.max_fade,
-                prop.lighting.x,
-                prop.lighting.y,
-                prop.lighting.z,
-            ))
-            if game_lump.version >= 5:
-                prop_lump.write(struct.pack('<f', prop.fade_scale))
-
-            if game_lump.version in (6, 7):
-                prop_lump.write(struct.pack(
-                    '<HH',
-                    prop.min_dx_level,
-                    prop.max_dx_level,
-                ))
-
-            if game_lump.version >= 8:
-                prop_lump.write(struct.pack(
-                    '<BBBB',
-                    prop.min_cpu_level,
-                    prop.max_cpu_level,
-                    prop.min_gpu_level,
-                    prop.max_gpu_level
-                ))
-
-            if game_lump.version >= 7:
-                prop_lump.write(struct.pack(
-                    '<BBBB',
-                    int(prop.tint.x),
-                    int(prop.tint.y),
-                    int(prop.tint.z),
-                    prop.renderfx,
-                ))
-
-            if game_lump.version >= 10:
-                prop_lump.write(struct.pack('<I', prop.flags.value_sec))
-
-            if game_lump.version >= 11:
-                # Unknown padding/data, though it's always zero.
-
-                prop_lump.write(struct.pack('<xxxxf', prop.scaling))
-            elif game_lump.version >= 9:
-                # The 1-byte bool gets expanded to the full 4-byte size.
-                prop_lump.write(struct.pack('<?xxx', prop.disable_on_xbox))
+        prop_lump.write(b''.join([
+            prop_struct.pack(*write_order(prop._lump_fields(leaf_off, model_ind[prop.model])))
+            for leaf_off, prop in zip(leaf_offsets, props)
+        ]))
 
         game_lump.data = prop_lump.getvalue()
 
@@ -830,7 +1045,313 @@ class BSP:
         return nodes[0][0]
 
 
-class Lump:
+def _py_parse_output(key: str, value: str, sep: str) -> Output:
+    """Parse an output from the entity lump.
+
+    This matches Output.parse(), but without needing a Property.
+    """
+    try:
+        targ, inp, param, delay, times = value.split(sep)
+    except ValueError as e:
+        raise ValueError('Bad output value: "{}"'.format(value)) from e
+
+    inst_out, out = Output.parse_name(key)
+    inst_inp, inp = Output.parse_name(inp)
+
+    return Output(
+        out,
+        targ,
+        inp,
+        param=param,
+        delay=float(delay),
+        times=int(times),
+        inst_out=inst_out,
+        inst_in=inst_inp,
+        comma_sep=sep == ',',
+    )
+
+
+def _py_parse_ent_data(vmf: VMF, ent_data: bytes) -> None:
+    """Parse the entity lump, adding the entities to the VMF.
+
+    This is the Python implementation, replaced by the version in
+    _bsp_entlump if compiled.
+    """
+    cur_keys = None  # type: Optional[Dict[str, str]]  # None when between brackets.
+    # Casefolded key -> the first key name used.
+    cur_folded = {}  # type: Dict[str, str]
+    cur_outputs = []  # type: List[Output]
+    seen_spawn = False  # The first entity is worldspawn.
+
+    # This code performs the same thing as property_parser, but simpler
+    # since there's no nesting, comments, or whitespace, except between
+    # key and value. The lump is ASCII, so decode it all at once.
+    text = ent_data.decode('ascii')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+
+    for line in text.split('\n'):
+        if line == '{':
+            if cur_keys is not None:
+                raise ValueError(
+                    '2 levels of nesting after {} ents'.format(
+                        len(vmf.entities)
+                    )
+                )
+            cur_keys = {}
+            cur_folded = {}
+            cur_outputs = []
+            continue
+        elif line == '}':
+            if cur_keys is None:
+                raise ValueError(
+                    f'Too many closing brackets after'
+                    f' {len(vmf.entities)} ents!'
+                )
+            if not seen_spawn:
+                seen_spawn = True
+                # The spawn ent is stored in the attribute, not in the ent
+                # list.
+                for key, value in cur_keys.items():
+                    vmf.spawn[key] = value
+                vmf.spawn.add_out(*cur_outputs)
+                if vmf.spawn['classname'] != 'worldspawn':
+                    raise ValueError('No worldspawn entity!')
+            else:
+                vmf.add_ent(Entity(vmf, keys=cur_keys, outputs=cur_outputs))
+            cur_keys = None
+            continue
+        elif line == '\x00':  # Null byte at end of lump.
+            if cur_keys is not None:
+                raise ValueError("Last entity didn't end!")
+            return
+        elif not line:
+            continue
+
+        if cur_keys is None:
+            raise ValueError("Keyvalue outside brackets!")
+
+        # Line is of the form <"key" "val">
+        key, value = line.split('" "')
+        key = key[1:]
+        value = value[:-1]
+
+        # Now, we need to figure out if this is a keyvalue,
+        # or connection.
+        # If we're L4D+, this is easy - they use 0x1B as separator.
+        # Before, it's a comma which is common in keyvalues.
+        # Assume it's an output if it has exactly 4 commas, and the last two
+        # successfully parse as numbers.
+        if OUTPUT_SEP in value:
+            # All outputs use the comma_sep, so we can ID them.
+            cur_outputs.append(_py_parse_output(key, value, OUTPUT_SEP))
+            continue
+        elif value.count(',') == 4:
+            try:
+                cur_outputs.append(_py_parse_output(key, value, ','))
+                continue
+            except ValueError:
+                pass
+        # Normal keyvalue. Keys are case-insensitive, keeping the first
+        # case used.
+        cur_keys[cur_folded.setdefault(key.casefold(), key)] = value
+
+
+def _py_build_ent_data(vmf: VMF, use_comma_sep: Optional[bool]) -> bytes:
+    """Generate the entity lump.
+
+    This is the Python implementation, replaced by the version in
+    _bsp_entlump if compiled.
+    """
+    out = []  # type: List[str]
+    for ent in itertools.chain([vmf.spawn], vmf.entities):
+        out.append('{\n')
+        for key, value in ent.keys.items():
+            out.append(f'"{key}" "{value}"\n')
+        for output in ent.outputs:
+            if use_comma_sep is not None:
+                output.comma_sep = use_comma_sep
+            out.append(output._get_text())
+        out.append('}\n')
+    out.append('\x00')
+
+    return ''.join(out).encode('ascii')
+
+
+class _LazyData:
+    """Handles the data for lumps, and tracks where it is located in the file.
+
+    If the BSP was opened lazily, the data is read from the memory-mapped file
+    only when required. Until then _mmap is set and _data is None.
+    Once data is assigned, the lump is marked as dirty.
+    Alternatively _stream may be set to a function which writes the data
+    when the BSP is saved.
+    """
+    __slots__ = ()
+    _data: Optional[bytes]
+    _mmap: Optional[mmap.mmap]
+    _stream: Optional[Callable[[BinaryIO], None]]
+    _offset: int
+    _length: int
+    _dirty: bool
+
+    @property
+    def data(self) -> bytes:
+        """The contents of the lump."""
+        if self._stream is not None:
+            with BytesIO() as buf:
+                self._stream(_LumpFile(buf, 0))
+                self._data = buf.getvalue()
+            self._stream = None
+        if self._data is None:
+            if self._mmap is None or self._mmap.closed:
+                raise ValueError('BSP file was closed, lump cannot be read!')
+            self._data = self._mmap[self._offset:self._offset + self._length]
+            self._mmap = None
+        return self._data
+
+    @data.setter
+    def data(self, value: bytes) -> None:
+        self._data = value
+        self._mmap = None
+        self._stream = None
+        self._dirty = True
+
+    def set_stream(self, writer: Callable[[BinaryIO], None]) -> None:
+        """Set the data to be produced by a function when the BSP is saved.
+
+        The writer is passed a seekable file, positioned at the start of the
+        lump. This allows large lumps to be written directly into the BSP,
+        instead of being built in memory. It may be called again if the data
+        is required before then, or the BSP is saved more than once.
+        """
+        self._stream = writer
+        self._data = None
+        self._mmap = None
+        self._dirty = True
+
+    def reader(self) -> Callable[[], BinaryIO]:
+        """Return a function which opens the current data as a file.
+
+        This remains valid if the lump is later modified. If the data has not
+        been read from the BSP yet, it is read directly from the mapped file
+        instead of being copied into memory.
+        """
+        if self._stream is not None or self._mmap is None:
+            data = self.data
+            return lambda: BytesIO(data)
+        mapping = self._mmap
+        start = self._offset
+        end = self._offset + self._length
+
+        def open_view() -> BinaryIO:
+            """Open a view of the mapped data."""
+            if mapping.closed:
+                raise ValueError('BSP file was closed, lump cannot be read!')
+            with memoryview(mapping) as view:
+                return ViewFile(view[start:end])
+        return open_view
+
+    def _set_location(self, offset: int, length: int, mapping: mmap.mmap=None) -> None:
+        """Record where this lump's data is stored in the file.
+
+        This marks the data as matching the file. If a mapping is provided,
+        the data is discarded and will be read from there when required.
+        """
+        self._offset = offset
+        self._length = length
+        self._dirty = False
+        if mapping is not None:
+            self._data = None
+            self._stream = None
+            self._mmap = mapping
+
+    def _size_repr(self) -> str:
+        """Describe the size of the data for repr(), without running streams."""
+        if self._stream is not None:
+            return 'streamed'
+        return '{} bytes'.format(self._size())
+
+    def _size(self) -> int:
+        """Return the length of the data, without reading it if possible.
+
+        Streamed data has to be built in memory to find its length.
+        """
+        if self._stream is not None:
+            return len(self.data)
+        if self._data is None:
+            return self._length
+        return len(self._data)
+
+    def _write_to(self, file: BinaryIO) -> int:
+        """Write the data to the file, returning the length.
+
+        Unread data is copied directly from the mapped file, in chunks.
+        """
+        if self._stream is not None:
+            start = file.tell()
+            lump_file = _LumpFile(file, start)
+            self._stream(lump_file)
+            file.seek(start + lump_file.size)
+            return lump_file.size
+        if self._data is not None:
+            file.write(self._data)
+            return len(self._data)
+        if self._mmap is None or self._mmap.closed:
+            raise ValueError('BSP file was closed, lump cannot be read!')
+        with memoryview(self._mmap) as view:
+            for off in range(self._offset, self._offset + self._length, COPY_CHUNK_SIZE):
+                end = min(off + COPY_CHUNK_SIZE, self._offset + self._length)
+                with view[off:end] as chunk:
+                    file.write(chunk)
+        return self._length
+
+
+class _LumpFile(io.RawIOBase):
+    """Wraps the BSP file while a streamed lump is written.
+
+    Positions are relative to the start of the lump, and the furthest
+    position written to is tracked.
+    """
+    def __init__(self, file: BinaryIO, start: int) -> None:
+        super().__init__()
+        self._file = file
+        self._start = start
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._file.tell() - self._start
+
+    def seek(self, pos: int, whence: int=io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = self._start + pos
+        elif whence == io.SEEK_CUR:
+            pos = self._file.tell() + pos
+        elif whence == io.SEEK_END:
+            pos = self._start + self.size + pos
+        else:
+            raise ValueError('Invalid whence ({!r})'.format(whence))
+        if pos < self._start:
+            raise ValueError('Cannot seek before the start of the lump!')
+        self._file.seek(pos)
+        return pos - self._start
+
+    def write(self, data: bytes) -> int:
+        count = self._file.write(data)
+        self.size = max(self.size, self.tell())
+        return count
+
+    def flush(self) -> None:
+        self._file.flush()
+
+
+class Lump(_LazyData):
     """Represents a lump header in a BSP file.
 
     """
@@ -844,18 +1365,22 @@ class Lump:
         self.type = typ
         self.version = version
         self.ident = [int(x) for x in ident]
-        self.data = b''
+        self._mmap = None
+        self._stream = None
+        self._offset = self._length = 0
+        self._dirty = True
+        self._data = b''
 
     def __repr__(self) -> str:
-        return '<BSP Lump "{}", v{}, ident={}, {} bytes>'.format(
+        return '<BSP Lump "{}", v{}, ident={}, {}>'.format(
             self.type.name,
             self.version,
             bytes(self.ident),
-            len(self.data)
+            self._size_repr(),
         )
 
 
-class GameLump:
+class GameLump(_LazyData):
     """Represents a game lump.
 
     These are designed to be game-specific.
@@ -864,7 +1389,12 @@ class GameLump:
         'id',
         'flags',
         'version',
-        'data',
+        '_data',
+        '_mmap',
+        '_stream',
+        '_offset',
+        '_length',
+        '_dirty',
     ]
 
     ST = struct.Struct('<4s HH ii')
@@ -880,14 +1410,18 @@ class GameLump:
         self.id = lump_id
         self.flags = flags
         self.version = version
-        self.data = data
+        self._mmap = None
+        self._stream = None
+        self._offset = self._length = 0
+        self._dirty = True
+        self._data = data
 
     def __repr__(self) -> str:
-        return '<GameLump {}, flags={}, v{}, {} bytes>'.format(
+        return '<GameLump {}, flags={}, v{}, {}>'.format(
             repr(self.id)[1:],
             self.flags,
             self.version,
-            len(self.data),
+            self._size_repr(),
         )
 
 
@@ -962,6 +1496,34 @@ class StaticProp:
             self.angles,
         )
 
+    def _lump_fields(self, leaf_off: int, model_ind: int) -> tuple:
+        """Return the values in _STATIC_PROP_FIELDS, to write this into the lump."""
+        origin = self.origin
+        angles = self.angles
+        lighting = self.lighting
+        tint = self.tint
+        flags = self.flags.value
+        return (
+            origin.x, origin.y, origin.z,
+            angles.x, angles.y, angles.z,
+            model_ind,
+            leaf_off, len(self.visleafs),
+            self.solidity, flags & 0xFF,
+            self.skin,
+            self.min_fade, self.max_fade,
+            lighting.x, lighting.y, lighting.z,
+            self.fade_scale,
+            self.min_dx_level, self.max_dx_level,
+            self.min_cpu_level, self.max_cpu_level,
+            self.min_gpu_level, self.max_gpu_level,
+            int(tint.x), int(tint.y), int(tint.z),
+            self.renderfx,
+            flags >> 8,
+            self.scaling,
+            self.disable_on_xbox,
+        )
+
+
 class VisLeaf:
     """A leaf in the visleaf data.
 
@@ -1013,3 +1575,15 @@ class VisTree:
         # Replaced after.
         self.child_neg = None  # type: ignore
         self.child_pos = None  # type: ignore
+
+
+# Use the compiled versions of these if available.
+_parse_ent_data = _cy_parse_ent_data = _py_parse_ent_data
+_build_ent_data = _cy_build_ent_data = _py_build_ent_data
+try:
+    from srctools import _bsp_entlump
+except ImportError:
+    pass
+else:
+    _parse_ent_data = _cy_parse_ent_data = _bsp_entlump.parse_ent_data
+    _build_ent_data = _cy_build_ent_data = _bsp_entlump.build_ent_data
@@ -111,9 +111,14 @@ def run_transformations(
     bsp: BSP,
     game: Game,
     studiomdl_loc: Path=None,
+    fgd: FGD=None,
 ) -> None:
     """Run all transformations."""
-    context = Context(filesys, vmf, pack, bsp, game, studiomdl_loc=studiomdl_loc)
+    context = Context(
+        filesys, vmf, pack, bsp, game,
+        fgd=fgd,
+        studiomdl_loc=studiomdl_loc,
+    )
 
     for func_name, func in sorted(
         TRANSFORMS.items(),
@@ -8,6 +8,7 @@ import pickle
 import subprocess
 import tempfile
 import random
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import (
     Optional, TypeVar, Any,
     Dict, Set, List, Hashable,
@@ -33,6 +34,8 @@ class GenModel:
         self.name = mdl_name  # This is just the filename.
         self.used = False
         self.result = result  # Return value from compile function.
+        # If StudioMDL is running in the background, the job.
+        self.compiling: Optional[Future] = None
 
     def __repr__(self) -> str:
         return f'<Model "{self.name}, used={self.used}>'
@@ -47,7 +50,14 @@ class ModelCompiler:
         pack: PackList,
         map_name: str,
         folder_name: str,
+        max_workers: Optional[int]=None,
     ) -> None:
+        """Prepare the compiler.
+
+        max_workers is the number of StudioMDL processes which may run at
+        once, for models compiled in the background. If not set, this is the
+        number of CPUs.
+        """
         # The models already constructed.
         self._built_models: Dict[ModelKey, GenModel] = {}
 
@@ -63,6 +73,11 @@ class ModelCompiler:
             studiomdl_loc = game.bin_folder() / 'studiomdl.exe'
         self.studiomdl_loc: Path = studiomdl_loc.resolve()
 
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Models which are being compiled, and need packing once done.
+        self._pending: List[GenModel] = []
+
     @classmethod
     def from_ctx(cls, ctx: Context, folder_name: str) -> 'ModelCompiler':
         """Convenience method to construct from the context's data."""
@@ -80,7 +95,7 @@ class ModelCompiler:
 
     def __enter__(self) -> 'ModelCompiler':
         # Ensure the folder exists.
-        os.makedirs(self.model_folder, exist_ok=True)
+        os.makedirs(self.model_folder_abs, exist_ok=True)
         try:
             with (self.model_folder_abs / 'manifest.bin').open('rb') as f:
                 data: List[Tuple[ModelKey, str, InT]] = pickle.load(f)
@@ -117,7 +132,12 @@ class ModelCompiler:
     def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
         """Write the constructed models to the cache file and remove unused models."""
         if exc_type is not None or exc_val is not None:
+            self._shutdown()
             return False
+        try:
+            self.wait()
+        finally:
+            self._shutdown()
         data = []
         used_mdls = set()
         for key, mdl in self._built_models.items():
@@ -147,6 +167,8 @@ class ModelCompiler:
         key: ModelKey,
         compile_func: Callable[[ModelKey, Path, str, InT], OutT],
         args: InT,
+        *,
+        wait: bool=True,
     ) -> Tuple[str, OutT]:
         """Given a model key, either return the existing model, or compile it.
 
@@ -161,6 +183,10 @@ class ModelCompiler:
         StudioMDL will be called on the model to comile it. The return value will
         be passed back from this function.
 
+        If wait is False, StudioMDL is instead run in the background, with up to
+        max_workers models compiling at once. The model is packed once it
+        finishes, when wait() is called or the compiler is exited.
+
         If the model key is None, a new model will always be compiled.
         The model key and return value must be pickleable, so they can be saved
         for use in subsequent compiles.
@@ -178,39 +204,89 @@ class ModelCompiler:
 
             model = self._built_models[key] = GenModel(mdl_name)
 
-            with tempfile.TemporaryDirectory(prefix='mdl_compile') as folder:
-                path = Path(folder)
+            # Each model gets its own folder, so they can be compiled at once.
+            # The folder is removed once StudioMDL is done.
+            folder = tempfile.TemporaryDirectory(prefix='mdl_compile')
+            try:
+                path = Path(folder.name)
                 model.result = compile_func(key, path, f'{self.model_folder}{mdl_name}.mdl', args)
-                studio_args = [
-                    str(self.studiomdl_loc),
-                    '-nop4',
-                    '-game', str(self.game.path),
-                    str(path / 'model.qc'),
-                ]
-                res = subprocess.run(studio_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                LOGGER.debug(
-                    'Executing {}:\n{}',
-                    studio_args,
-                    res.stdout.replace(b'\r\n', b'\n').decode('ascii', 'replace'),
-                )
-                res.check_returncode()  # Or raise.
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.max_workers)
+                model.compiling = self._executor.submit(self._run_studiomdl, path, folder)
+            except BaseException:
+                folder.cleanup()
+                raise
 
         if not model.used:
-            # Pack it in.
             model.used = True
+            if model.compiling is None:
+                self._pack_model(model)
+            else:
+                self._pending.append(model)
 
-            full_model_path = self.model_folder_abs / model.name
-            LOGGER.debug('Packing model {}.mdl:', full_model_path)
-            for ext in MDL_EXTS:
-                try:
-                    with open(str(full_model_path.with_suffix(ext)), 'rb') as fb:
-                        self.pack.pack_file(
-                            'models/{}{}{}'.format(
-                                self.model_folder, model.name, ext,
-                            ),
-                            data=fb.read(),
-                        )
-                except FileNotFoundError:
-                    pass
+        if wait and model.compiling is not None:
+            self._finish(model)
 
         return f'models/{self.model_folder}{model.name}.mdl', model.result
+
+    def wait(self) -> None:
+        """Wait for all models compiling in the background, then pack them."""
+        while self._pending:
+            # Leave it in the list until done, in case this raises.
+            self._finish(self._pending[0])
+
+    def _finish(self, model: GenModel) -> None:
+        """Wait for a model to compile, then pack it."""
+        assert model.compiling is not None, model
+        model.compiling.result()  # Or raise.
+        model.compiling = None
+        self._pending.remove(model)
+        self._pack_model(model)
+
+    def _shutdown(self) -> None:
+        """Stop the background compiles.
+
+        Jobs not yet started are cancelled, but we wait for running ones to
+        finish so their temporary folders are removed.
+        """
+        for model in self._pending:
+            if model.compiling is not None:
+                model.compiling.cancel()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _run_studiomdl(self, path: Path, folder: tempfile.TemporaryDirectory) -> None:
+        """Run StudioMDL on the model in the folder, then remove the folder."""
+        try:
+            studio_args = [
+                str(self.studiomdl_loc),
+                '-nop4',
+                '-game', str(self.game.path),
+                str(path / 'model.qc'),
+            ]
+            res = subprocess.run(studio_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            LOGGER.debug(
+                'Executing {}:\n{}',
+                studio_args,
+                res.stdout.replace(b'\r\n', b'\n').decode('ascii', 'replace'),
+            )
+            res.check_returncode()  # Or raise.
+        finally:
+            folder.cleanup()
+
+    def _pack_model(self, model: GenModel) -> None:
+        """Pack the files for a compiled model."""
+        full_model_path = self.model_folder_abs / model.name
+        LOGGER.debug('Packing model {}.mdl:', full_model_path)
+        for ext in MDL_EXTS:
+            try:
+                with open(str(full_model_path.with_suffix(ext)), 'rb') as fb:
+                    self.pack.pack_file(
+                        'models/{}{}{}'.format(
+                            self.model_folder, model.name, ext,
+                        ),
+                        data=fb.read(),
+                    )
+            except FileNotFoundError:
+                pass
@@ -4,27 +4,31 @@ This merges static props together, so they can be drawn with a single
 draw call.
 """
 import os
+import math
+import pickle
 import random
 import colorsys
 import functools
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
 from enum import Enum
 from pathlib import Path
 from typing import (
     Optional, Tuple, Callable, NamedTuple,
     FrozenSet, Dict, List, Set,
-    Iterator,
+    Iterator, Sequence,
 )
 
-from srctools import Vec, VMF, Entity, conv_int, Angle, Matrix
+from srctools import Vec, VMF, Entity, conv_int, Angle, Matrix, AtomicWriter
 from srctools.tokenizer import Tokenizer, Token
 from srctools.game import Game
 
 from srctools.logger import get_logger
 from srctools.packlist import PackList
 from srctools.bsp import BSP, StaticProp
-from srctools.mdl import Model
-from srctools.smd import Mesh
+from srctools.mdl import Model, Flags as ModelFlags
+from srctools.filesys import FileSystem
+from srctools.smd import Mesh, ArrayMesh
 from srctools.compiler.mdl_compiler import ModelCompiler
 
 
@@ -60,10 +64,68 @@ $collisionmodel "physics.smd" {
 
 MAX_GROUP = 24  # Studiomdl does't allow more than this...
 
+# Increment if the cache file is incompatible with older versions.
+CACHE_VERSION = 1
+
+# For each QC file, the modification time and size, then the result of parsing.
+QCCacheEntry = Tuple[Tuple[int, int], Optional[Tuple[str, QC]]]
+
 # Cache of the SMD models we have already parsed, so we don't need
 # to parse them again. The second is the collision model.
-_mesh_cache = {}  # type: Dict[Tuple[QC, int], Mesh]
-_coll_cache = {}  # type: Dict[str, Mesh]
+_mesh_cache = {}  # type: Dict[Tuple[QC, int], ArrayMesh]
+_coll_cache = {}  # type: Dict[str, ArrayMesh]
+# If set, parsed SMDs are also stored in this folder between compiles.
+_smd_cache_folder = None  # type: Optional[Path]
+
+class ModelSummary:
+    """The information about a model which propcombine requires.
+
+    This is much quicker to load than parsing the model. Only the data
+    is cached, since textures need to be looked up in the filesystem.
+    """
+    __slots__ = ['_sys', 'surfaceprop', 'cdmaterials', 'skins', 'contents', 'flags']
+
+    def __init__(
+        self,
+        filesystem: FileSystem,
+        surfaceprop: str,
+        cdmaterials: List[str],
+        skins: List[List[str]],
+        contents: int,
+        flags: ModelFlags,
+    ) -> None:
+        self._sys = filesystem
+        self.surfaceprop = surfaceprop
+        self.cdmaterials = cdmaterials
+        self.skins = skins
+        self.contents = contents
+        self.flags = flags
+
+    @classmethod
+    def from_model(cls, mdl: Model) -> 'ModelSummary':
+        """Extract the information from a parsed model."""
+        return cls(
+            mdl._sys,
+            mdl.surfaceprop,
+            list(mdl.cdmaterials),
+            [list(skin) for skin in mdl.skins],
+            mdl.contents,
+            mdl.flags,
+        )
+
+    @classmethod
+    def from_cache(cls, filesystem: FileSystem, data: tuple) -> 'ModelSummary':
+        """Rebuild from the data produced by cache_data()."""
+        surfaceprop, cdmaterials, skins, contents, flags = data
+        return cls(filesystem, surfaceprop, cdmaterials, skins, contents, ModelFlags(flags))
+
+    def cache_data(self) -> tuple:
+        """Return the data to store in the cache."""
+        return self.surfaceprop, self.cdmaterials, self.skins, self.contents, self.flags.value
+
+    # This only uses the attributes we have.
+    iter_textures = Model.iter_textures
+
 
 class DynamicModel(Exception):
     """Used as flow control."""
@@ -90,6 +152,73 @@ def bsp_collision(point: Vec, planes: List[Tuple[Vec, Vec]]) -> bool:
     return True
 
 
+class ConvexVolume(NamedTuple):
+    """A convex volume, defined by (pos, normal) planes facing outward.
+
+    The bounding box is used to quickly discard points which can't be inside.
+    """
+    bbox_min: Vec
+    bbox_max: Vec
+    planes: List[Tuple[Vec, Vec]]
+
+    @classmethod
+    def from_box(cls, origin: Vec, matrix: Matrix, mins: Vec, maxes: Vec) -> 'ConvexVolume':
+        """Construct the volume for a rotated box."""
+        # For each direction, compute a position on the plane and
+        # the normal vector.
+        planes = [
+            (
+                origin + Vec.with_axes(axis, offset) @ matrix,
+                Vec.with_axes(axis, norm) @ matrix,
+            )
+            for offset, norm in zip([mins, maxes], (-1, 1))
+            for axis in ('x', 'y', 'z')
+        ]
+        bbox_min, bbox_max = Vec.bbox(
+            origin + Vec(x, y, z) @ matrix
+            for x in (mins.x, maxes.x)
+            for y in (mins.y, maxes.y)
+            for z in (mins.z, maxes.z)
+        )
+        # Points slightly outside the planes are still counted as inside.
+        return cls(bbox_min - 1.0, bbox_max + 1.0, planes)
+
+
+def bsp_collision_bulk(points: Sequence[Vec], volumes: Sequence[ConvexVolume]) -> List[List[int]]:
+    """Check which points are inside each of the volumes.
+
+    For each volume, this returns the indexes of the points inside, in order.
+    The result is the same as calling bsp_collision() for each combination,
+    but the points are sorted so only those inside each volume's bounding box
+    need to be checked.
+    """
+    coords = sorted([
+        (point.x, point.y, point.z, ind)
+        for ind, point in enumerate(points)
+    ])
+    xs = [x for x, y, z, ind in coords]
+    result = []
+    for volume in volumes:
+        min_x, min_y, min_z = volume.bbox_min
+        max_x, max_y, max_z = volume.bbox_max
+        candidates = [
+            (x, y, z, ind)
+            for x, y, z, ind in coords[bisect_left(xs, min_x):bisect_right(xs, max_x)]
+            if min_y <= y <= max_y and min_z <= z <= max_z
+        ]
+        # Test each plane against all the points in turn, like bsp_collision().
+        for (pos_x, pos_y, pos_z), (norm_x, norm_y, norm_z) in volume.planes:
+            if not candidates:
+                break
+            candidates = [
+                (x, y, z, ind)
+                for x, y, z, ind in candidates
+                if (pos_x - x) * norm_x + (pos_y - y) * norm_y + (pos_z - z) * norm_z >= -0.1
+            ]
+        result.append(sorted([ind for x, y, z, ind in candidates]))
+    return result
+
+
 class CollType(Enum):
     """Collision types that static props can have."""
     NONE = 0  # No collision
@@ -119,7 +248,7 @@ class PropPos(NamedTuple):
 def combine_group(
     compiler: ModelCompiler,
     props: List[StaticProp],
-    lookup_model: Callable[[str], Tuple[QC, Model]],
+    lookup_model: Callable[[str], Tuple[QC, ModelSummary]],
 ) -> StaticProp:
     """Merge the given props together, compiling a model if required."""
 
@@ -168,9 +297,12 @@ def combine_group(
         ))
     # We don't want to build collisions if it's not used.
     has_coll = any(pos.solidity is not CollType.NONE for pos in prop_pos)
+    # We only need the name, so other groups can be processed while
+    # this compiles.
     mdl_name, result = compiler.get_model(
         (frozenset(prop_pos), has_coll),
         compile_func, lookup_model,
+        wait=False,
     )
 
     # Many of these we require to be the same, so we can read them
@@ -193,7 +325,7 @@ def compile_func(
     mdl_key: Tuple[Set[PropPos], bool],
     temp_folder: Path,
     mdl_name: str,
-    lookup_model: Callable[[str], Tuple[QC, Model]],
+    lookup_model: Callable[[str], Tuple[QC, ModelSummary]],
 ) -> None:
     """Build this merged model."""
     LOGGER.info('Compiling {}...', mdl_name)
@@ -220,8 +352,8 @@ def compile_func(
     [surfprop] = surfprops
     [phy_content_type] = contents
 
-    ref_mesh = Mesh.blank('static_prop')
-    coll_mesh = None  #  type: Optional[Mesh]
+    ref_mesh = ArrayMesh.blank('static_prop')
+    coll_mesh = None  #  type: Optional[ArrayMesh]
 
     for prop in prop_pos:
         qc, mdl = lookup_model(prop.model)
@@ -229,25 +361,18 @@ def compile_func(
             child_ref = _mesh_cache[qc, prop.skin]
         except KeyError:
             LOGGER.info('Parsing ref "{}"', qc.ref_smd)
-            with open(qc.ref_smd, 'rb') as fb:
-                child_ref = Mesh.parse_smd(fb)
+            child_ref = ArrayMesh.parse_file(qc.ref_smd, _smd_cache_folder)
 
             if prop.skin != 0 and prop.skin < len(mdl.skins):
                 # We need to rename the materials to match the skin.
-                swap_skins = dict(zip(
+                child_ref.rename_materials(dict(zip(
                     mdl.skins[0],
                     mdl.skins[prop.skin]
-                ))
-                for tri in child_ref.triangles:
-                    tri.mat = swap_skins.get(tri.mat, tri.mat)
+                )))
 
             # For some reason all the SMDs are rotated badly, but only
             # if we append them.
-            rot = Matrix.from_yaw(90)
-            for tri in child_ref.triangles:
-                for vert in tri:
-                    vert.pos @= rot
-                    vert.norm @= rot
+            child_ref.transform(Matrix.from_yaw(90))
 
             _mesh_cache[qc, prop.skin] = child_ref
 
@@ -260,7 +385,7 @@ def compile_func(
 
         if has_coll and child_coll is not None:
             if coll_mesh is None:
-                coll_mesh = Mesh.blank('static_prop')
+                coll_mesh = ArrayMesh.blank('static_prop')
             coll_mesh.append_model(child_coll, angles, offset, prop.scale * qc.phy_scale)
 
     with (temp_folder / 'reference.smd').open('wb') as fb:
@@ -301,7 +426,7 @@ def compile_func(
             f.write(QC_COLL_TEMPLATE)
 
 
-def build_collision(qc: QC, prop: PropPos, ref_mesh: Mesh) -> Optional[Mesh]:
+def build_collision(qc: QC, prop: PropPos, ref_mesh: ArrayMesh) -> Optional[ArrayMesh]:
     """Get the correct collision mesh for this model."""
     if prop.solidity is CollType.NONE:  # Non-solid
         return None
@@ -312,30 +437,29 @@ def build_collision(qc: QC, prop: PropPos, ref_mesh: Mesh) -> Optional[Mesh]:
             return _coll_cache[qc.phy_smd]
         except KeyError:
             LOGGER.info('Parsing coll "{}"', qc.phy_smd)
-            with open(qc.phy_smd, 'rb') as fb:
-                coll = Mesh.parse_smd(fb)
+            coll = ArrayMesh.parse_file(qc.phy_smd, _smd_cache_folder)
 
-            rot = Matrix.from_yaw(90)
-            for tri in coll.triangles:
-                for vert in tri:
-                    vert.pos @= rot
-                    vert.norm @= rot
+            coll.transform(Matrix.from_yaw(90))
 
             _coll_cache[qc.phy_smd] = coll
             return coll
     # Else, it's one of the three bounding box types.
     # We don't really care about which.
-    bbox_min, bbox_max = Vec.bbox(
-        vert.pos
-        for tri in
-        ref_mesh.triangles
-        for vert in tri
-    )
-    return Mesh.build_bbox('static_prop', 'phy', bbox_min, bbox_max)
+    bbox_min, bbox_max = ref_mesh.bbox()
+    return ArrayMesh.from_mesh(Mesh.build_bbox('static_prop', 'phy', bbox_min, bbox_max))
 
 
-def load_qcs(qc_map: Dict[str, QC], qc_folder: Path) -> None:
-    """Parse through all the QC files to match to compiled models."""
+def load_qcs(
+    qc_map: Dict[str, QC],
+    qc_folder: Path,
+    cache: Dict[str, QCCacheEntry]=None,
+    prev_cache: Dict[str, QCCacheEntry]=None,
+) -> None:
+    """Parse through all the QC files to match to compiled models.
+
+    If provided, the results of parsing each QC are stored in cache.
+    Results from prev_cache are reused if the QC has not been modified.
+    """
     for dirpath, dirnames, filenames in os.walk(str(qc_folder)):
         qc_loc = Path(dirpath)
         for fname in filenames:
@@ -343,34 +467,61 @@ def load_qcs(qc_map: Dict[str, QC], qc_folder: Path) -> None:
                 continue
             qc_path = qc_loc / fname
 
-            qc_result = parse_qc(qc_loc, qc_path)
+            if cache is None:
+                result = load_qc(qc_loc, qc_path)
+            else:
+                path_str = str(qc_path)
+                try:
+                    stat = os.stat(path_str)
+                except OSError:
+                    continue
+                file_key = (stat.st_mtime_ns, stat.st_size)
+                try:
+                    cached_key, result = prev_cache[path_str]
+                    if cached_key != file_key:
+                        raise KeyError(path_str)
+                except (KeyError, TypeError):
+                    result = load_qc(qc_loc, qc_path)
+                cache[path_str] = file_key, result
+
+            if result is not None:
+                model_name, qc = result
+                qc_map[model_name] = qc
+
+
+def load_qc(qc_loc: Path, qc_path: Path) -> Optional[Tuple[str, QC]]:
+    """Parse a QC file, and check it can be combined.
+
+    If so, the canonical model name and the QC data is returned.
+    """
+    qc_result = parse_qc(qc_loc, qc_path)
+
+    if qc_result is None:
+        # It's a dynamic QC, we can't combine.
+        return None
 
-            if qc_result is None:
-                # It's a dynamic QC, we can't combine.
-                continue
+    (
+        model_name,
+        ref_scale, ref_smd,
+        phy_scale, phy_smd,
+    ) = qc_result
 
-            (
-                model_name,
-                ref_scale, ref_smd,
-                phy_scale, phy_smd,
-            ) = qc_result
-
-            # We can't parse FBX files right now.
-            if ref_smd.suffix.casefold() not in ('.smd', '.dmx_DISABLE'):
-                LOGGER.warning('Reference mesh not a SMD/DMX:\n{}', ref_smd)
-                continue
+    # We can't parse FBX files right now.
+    if ref_smd.suffix.casefold() not in ('.smd', '.dmx_DISABLE'):
+        LOGGER.warning('Reference mesh not a SMD/DMX:\n{}', ref_smd)
+        return None
 
-            if phy_smd is not None and phy_smd.suffix.casefold() not in ('.smd', '.dmx_DISABLE'):
-                LOGGER.warning('Collision mesh not a SMD/DMX:\n{}', ref_smd)
-                continue
+    if phy_smd is not None and phy_smd.suffix.casefold() not in ('.smd', '.dmx_DISABLE'):
+        LOGGER.warning('Collision mesh not a SMD/DMX:\n{}', ref_smd)
+        return None
 
-            qc_map[unify_mdl(model_name)] = QC(
-                str(qc_path).replace('\\', '/'),
-                str(ref_smd).replace('\\', '/'),
-                str(phy_smd).replace('\\', '/') if phy_smd else None,
-                ref_scale,
-                phy_scale,
-            )
+    return unify_mdl(model_name), QC(
+        str(qc_path).replace('\\', '/'),
+        str(ref_smd).replace('\\', '/'),
+        str(phy_smd).replace('\\', '/') if phy_smd else None,
+        ref_scale,
+        phy_scale,
+    )
 
 
 def parse_qc(qc_loc: Path, qc_path: Path) -> Optional[Tuple[
@@ -464,17 +615,18 @@ def parse_qc(qc_loc: Path, qc_path: Path) -> Optional[Tuple[
 def group_props_ent(
     prop_groups: Dict[Optional[tuple], List[StaticProp]],
     rejected: List[StaticProp],
-    get_model: Callable[[str], Tuple[Optional[QC], Optional[Model]]],
+    get_model: Callable[[str], Tuple[Optional[QC], Optional[ModelSummary]]],
     bbox_ents: List[Entity],
     min_cluster: int,
 ) -> Iterator[List[StaticProp]]:
     """Given the groups of props, merge props according to the provided ents."""
-    # (name, skinset) -> list of boxes, constructed as 6 (pos, norm) tuples.
-    combine_sets = defaultdict(list)  # type: Dict[Tuple[str, FrozenSet[str]], List[List[Tuple[Vec, Vec]]]]
+    # (name, skinset) -> list of boxes.
+    combine_sets = defaultdict(list)  # type: Dict[Tuple[str, FrozenSet[str]], List[ConvexVolume]]
 
     empty_fs = frozenset('')
 
-    for ent in bbox_ents:
+    # The ents usually come from a set, sort so the order of sets is consistent.
+    for ent in sorted(bbox_ents, key=lambda ent: ent.id):
         # Either provided name, or unique value.
         name = ent['name'] or format(int(ent['hammerid']), 'X')
         origin = Vec.from_str(ent['origin'])
@@ -502,16 +654,7 @@ def group_props_ent(
         mins -= 0.05
         maxes += 0.05
 
-        # For each direction, compute a position on the plane and
-        # the normal vector.
-        combine_sets[name, skinset].append([
-            (
-                origin + Vec.with_axes(axis, offset) @ mat,
-                Vec.with_axes(axis, norm) @ mat,
-            )
-            for offset, norm in zip([mins, maxes], (-1, 1))
-            for axis in ('x', 'y', 'z')
-        ])
+        combine_sets[name, skinset].append(ConvexVolume.from_box(origin, mat, mins, maxes))
 
     # Each of these groups cannot be merged with other ones.
     for group_key, group in prop_groups.items():
@@ -525,25 +668,32 @@ def group_props_ent(
             group.clear()
             continue
 
-        for (name, skinset), boxes in combine_sets.items():
-            if skinset and skinset != group_skinset:
-                continue  # No match
-            found = defaultdict(list)  # type: Dict[int, List[StaticProp]]
-            for prop in list(group):
-                for box in boxes:
-                    if bsp_collision(prop.origin, box):
-                        # Group by this box object's identity.
-                        # That's a cheap way to keep each propcombine set
-                        # grouped uniquely.
-                        found[id(boxes)].append(prop)
-                        break
-
-            for subgroup in found.values():
-                actual = set(subgroup).intersection(group)
-                if len(actual) >= min_cluster:
-                    yield list(actual)
-                    for prop in actual:
-                        group.remove(prop)
+        # Classify every prop against every box at once.
+        set_boxes = [
+            boxes for (name, skinset), boxes in combine_sets.items()
+            if not skinset or skinset == group_skinset
+        ]
+        inside = bsp_collision_bulk(
+            [prop.origin for prop in group],
+            [box for boxes in set_boxes for box in boxes],
+        )
+        remaining = [True] * len(group)
+        box_ind = 0
+        for boxes in set_boxes:
+            # Each propcombine set forms a single cluster, made from any
+            # props inside any of its boxes.
+            found = set()  # type: Set[int]
+            for prop_inds in inside[box_ind:box_ind + len(boxes)]:
+                found.update(prop_inds)
+            box_ind += len(boxes)
+
+            actual = [ind for ind in sorted(found) if remaining[ind]]
+            if len(actual) >= min_cluster:
+                yield [group[ind] for ind in actual]
+                for ind in actual:
+                    remaining[ind] = False
+
+        group[:] = [prop for ind, prop in enumerate(group) if remaining[ind]]
 
     # Finally, reject all the ones not in a bbox.
     for group in prop_groups.values():
@@ -556,11 +706,22 @@ def group_props_auto(
     dist: float,
     min_cluster: int,
 ) -> Iterator[List[StaticProp]]:
-    """Given the groups of props, automatically find close props to merge."""
+    """Given the groups of props, automatically find close props to merge.
+
+    Props are bucketed into a grid, so only those in neighbouring cells
+    need to be checked. Each group is processed in order, so the same input
+    always produces the same clusters.
+    """
     # Each of these groups cannot be merged with other ones.
 
     dist_sq = dist * dist
     large_dist_sq = 4 * dist_sq
+    # Cells are as large as the search radius, so only the adjacent cells
+    # need to be checked.
+    cell_size = 2 * dist
+    if cell_size <= 0:
+        # Only props in the same location can merge.
+        cell_size = 1.0
 
     for group in prop_groups.values():
         # No point merging single/empty groups.
@@ -568,14 +729,44 @@ def group_props_auto(
             rejected.extend(group)
             continue
 
-        todo = set(group)
-        while todo:
-            center = todo.pop()
-            cluster = {center}
+        origins = [(prop.origin.x, prop.origin.y, prop.origin.z) for prop in group]
+        cells = {}  # type: Dict[Tuple[int, int, int], List[int]]
+        prop_cells = []
+        for ind, (x, y, z) in enumerate(origins):
+            cell = (
+                math.floor(x / cell_size),
+                math.floor(y / cell_size),
+                math.floor(z / cell_size),
+            )
+            prop_cells.append(cell)
+            cells.setdefault(cell, []).append(ind)
 
-            for prop in todo:
-                if (center.origin - prop.origin).mag_sq() <= large_dist_sq:
-                    cluster.add(prop)
+        done = [False] * len(group)
+        for center_ind, center in enumerate(group):
+            if done[center_ind]:
+                continue
+            done[center_ind] = True
+            cell_x, cell_y, cell_z = prop_cells[center_ind]
+            cent_x, cent_y, cent_z = origins[center_ind]
+
+            nearby = []
+            for off_x in (-1, 0, 1):
+                for off_y in (-1, 0, 1):
+                    for off_z in (-1, 0, 1):
+                        try:
+                            cell_props = cells[cell_x + off_x, cell_y + off_y, cell_z + off_z]
+                        except KeyError:
+                            continue
+                        # Discard finished props, so they aren't checked again.
+                        cell_props[:] = [ind for ind in cell_props if not done[ind]]
+                        nearby += cell_props
+            nearby.sort()
+
+            cluster = [center_ind]
+            for ind in nearby:
+                x, y, z = origins[ind]
+                if (cent_x - x)**2 + (cent_y - y)**2 + (cent_z - z)**2 <= large_dist_sq:
+                    cluster.append(ind)
                     if len(cluster) > MAX_GROUP:
                         # Limit the number of maximum props that can be used.
                         break
@@ -584,22 +775,21 @@ def group_props_auto(
                 rejected.append(center)
                 continue
 
-            bbox_min, bbox_max = Vec.bbox(prop.origin for prop in cluster)
+            bbox_min, bbox_max = Vec.bbox(group[ind].origin for ind in cluster)
             center_pos = (bbox_min + bbox_max) / 2
 
             cluster_list = []
 
-            for prop in cluster:
-                prop_off = (center_pos - prop.origin).mag_sq()
+            for ind in cluster:
+                prop_off = (center_pos - group[ind].origin).mag_sq()
                 if prop_off <= dist_sq:
-                    cluster_list.append((prop, prop_off))
+                    cluster_list.append((ind, prop_off))
 
             cluster_list.sort(key=lambda t: t[1])
-            selected_props = [
-                prop for prop, off in
-                cluster_list[:MAX_GROUP]
-            ]
-            todo.difference_update(selected_props)
+            selected_props = []
+            for ind, off in cluster_list[:MAX_GROUP]:
+                done[ind] = True
+                selected_props.append(group[ind])
 
             if len(selected_props) >= min_cluster:
                 yield selected_props
@@ -607,6 +797,36 @@ def group_props_auto(
                 rejected.extend(selected_props)
 
 
+def load_cache(cache_file: Path) -> Tuple[Dict[str, QCCacheEntry], Dict[str, Tuple[int, tuple]]]:
+    """Load the QC and model data cached by a previous compile."""
+    try:
+        with cache_file.open('rb') as f:
+            version, qc_cache, mdl_cache = pickle.load(f)
+        if version != CACHE_VERSION:
+            return {}, {}
+        if not isinstance(qc_cache, dict) or not isinstance(mdl_cache, dict):
+            raise ValueError('Invalid cache data!')
+    except FileNotFoundError:
+        return {}, {}
+    except Exception:
+        LOGGER.warning('Could not parse propcombine cache {}:', cache_file, exc_info=True)
+        return {}, {}
+    return qc_cache, mdl_cache
+
+
+def save_cache(
+    cache_file: Path,
+    qc_cache: Dict[str, QCCacheEntry],
+    mdl_cache: Dict[str, Tuple[int, tuple]],
+) -> None:
+    """Write out the cached QC and model data."""
+    try:
+        with AtomicWriter(cache_file, is_bytes=True) as f:
+            pickle.dump((CACHE_VERSION, qc_cache, mdl_cache), f, pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        LOGGER.warning('Could not write propcombine cache {}:', cache_file, exc_info=True)
+
+
 def combine(
     bsp: BSP,
     bsp_ents: VMF,
@@ -617,8 +837,15 @@ def combine(
     auto_range: float=0,
     min_cluster: int=2,
     debug_tint: bool=False,
+    cache_file: Optional[Path]=None,
 ) -> None:
-    """Combine props in this map."""
+    """Combine props in this map.
+
+    If cache_file is provided, the results of parsing QCs and models are
+    stored there, so they only need to be parsed again once modified.
+    Parsed SMDs are stored in a folder next to the cache file.
+    """
+    global _smd_cache_folder
 
     # First parse out the bbox ents, so they are always removed.
     bbox_ents = list(bsp_ents.by_class['comp_propcombine_set'])
@@ -635,22 +862,34 @@ def combine(
         # But allow users to override this.
         qc_folders = [game.path.parent.parent / 'content']
 
+    prev_qc_cache = {}  # type: Dict[str, QCCacheEntry]
+    prev_mdl_cache = {}  # type: Dict[str, Tuple[int, tuple]]
+    if cache_file is not None:
+        prev_qc_cache, prev_mdl_cache = load_cache(cache_file)
+        _smd_cache_folder = cache_file.with_name(cache_file.stem + '_smd')
+    else:
+        _smd_cache_folder = None
+    qc_cache = {}  # type: Dict[str, QCCacheEntry]
+    mdl_cache = {}  # type: Dict[str, Tuple[int, tuple]]
+
     # Parse through all the QC files.
     LOGGER.info('Parsing QC files. Paths: \n{}', '\n'.join(map(str, qc_folders)))
     qc_map = {}  # type: Dict[str, QC]
     for qc_folder in qc_folders:
-        load_qcs(qc_map, qc_folder)
+        load_qcs(qc_map, qc_folder, qc_cache, prev_qc_cache)
     LOGGER.info('Done! {} props.', len(qc_map))
 
     map_name = Path(bsp.filename).stem
 
     # Don't re-parse models continually.
-    mdl_map = {}  # type: Dict[str, Model]
+    mdl_map = {}  # type: Dict[str, Optional[ModelSummary]]
+    # (model, skin) -> textures, since this requires checking the filesystem.
+    texture_map = {}  # type: Dict[Tuple[str, int], FrozenSet[str]]
     # Wipe these, if they're being used again.
     _mesh_cache.clear()
     _coll_cache.clear()
 
-    def get_model(filename: str) -> Tuple[Optional[QC], Optional[Model]]:
+    def get_model(filename: str) -> Tuple[Optional[QC], Optional[ModelSummary]]:
         """Given a filename, load/parse the QC and MDL data."""
         key = unify_mdl(filename)
         try:
@@ -664,10 +903,35 @@ def combine(
                 mdl_file = pack.fsys[filename]
             except FileNotFoundError:
                 # We don't have this model, we can't combine...
+                model = mdl_map[key] = None
                 return None, None
-            model = mdl_map[key] = Model(pack.fsys, mdl_file)
+            file_key = mdl_file.cache_key()
+            try:
+                cached_key, data = prev_mdl_cache[key]
+                if file_key == -1 or cached_key != file_key:
+                    raise KeyError(key)
+                model = ModelSummary.from_cache(pack.fsys, data)
+            except (KeyError, TypeError, ValueError):
+                model = ModelSummary.from_model(Model(pack.fsys, mdl_file))
+            if file_key != -1:
+                mdl_cache[key] = file_key, model.cache_data()
+            mdl_map[key] = model
+        if model is None:
+            return None, None
         return qc, model
 
+    def get_textures(filename: str, model: ModelSummary, skin: int) -> FrozenSet[str]:
+        """Find the textures used by a model's skin."""
+        try:
+            return texture_map[filename, skin]
+        except KeyError:
+            textures = texture_map[filename, skin] = frozenset({
+                tex.casefold().replace('\\', '/')
+                for tex in
+                model.iter_textures([skin])
+            })
+            return textures
+
     def get_grouping_key(prop: StaticProp) -> Optional[tuple]:
         """Compute a grouping key for this prop.
 
@@ -681,11 +945,7 @@ def combine(
 
         return (
             # Must be first, we pull this out later.
-            frozenset({
-                tex.casefold().replace('\\', '/')
-                for tex in
-                model.iter_textures([prop.skin])
-            }),
+            get_textures(unify_mdl(prop.model), model, prop.skin),
             model.flags.value,
             prop.flags.value,
             model.contents,
@@ -721,6 +981,8 @@ def combine(
     else:
         # No way provided to choose props.
         LOGGER.info('No propcombine groups provided.')
+        if cache_file is not None:
+            save_cache(cache_file, qc_cache, mdl_cache)
         return
 
     for prop in bsp.static_props():
@@ -757,4 +1019,7 @@ def combine(
     except FileNotFoundError:
         pass
 
+    if cache_file is not None:
+        save_cache(cache_file, qc_cache, mdl_cache)
+
     bsp.write_static_props(final_props)
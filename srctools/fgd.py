@@ -4,15 +4,16 @@ from copy import deepcopy
 from collections import defaultdict
 from enum import Enum
 from pathlib import PurePosixPath
-from struct import Struct
+from struct import Struct, error as struct_error
 import io
 import math
+import os
 
 from typing import (
     Optional, Union, overload,
     TypeVar, Callable, Type,
     Dict, Tuple, List, Set, FrozenSet,
-    Mapping, Iterator, Iterable, Collection,
+    Mapping, MutableMapping, Iterator, Iterable, Collection,
     BinaryIO, TextIO,
     Container,
     IO,
@@ -46,15 +47,31 @@ _fmt_8bit = Struct('>B')
 _fmt_16bit = Struct('>H')
 _fmt_32bit = Struct('>I')
 _fmt_double = Struct('>d')
-_fmt_header = Struct('>BddI')
+_fmt_header = Struct('>BddIB')
 _fmt_ent_header = Struct('<BBBBBB')
+_fmt_cache_key = Struct('>q')
 
 
 def _read_struct(fmt: Struct, file: BinaryIO) -> tuple:
     return fmt.unpack(file.read(fmt.size))
 
+
+def _write_text(file: BinaryIO, text: str) -> None:
+    """Write a long string directly, for help text in the binary format."""
+    encoded = text.encode('utf8')
+    file.write(_fmt_32bit.pack(len(encoded)))
+    file.write(encoded)
+
+
+def _read_text(file: BinaryIO) -> str:
+    """Read a string written by _write_text()."""
+    [length] = _read_struct(_fmt_32bit, file)
+    return file.read(length).decode('utf8')
+
 # Version number for the format.
-BIN_FORMAT_VERSION = 5
+BIN_FORMAT_VERSION = 7
+# Flag set in the binary format if help text is included.
+BIN_FLAG_HELP = 1
 # Cached result of FGD.engine_dbase().
 _ENGINE_FGD: Optional['FGD'] = None
 
@@ -313,8 +330,8 @@ assert set(VALUE_TYPE_ORDER) == set(ValueTypes), \
 assert set(ENTITY_TYPE_ORDER) == set(EntityTypes), \
     "Missing values: " + repr(set(EntityTypes) - set(ENTITY_TYPE_ORDER))
     
-# Can only store this many in the bytes.
-assert len(VALUE_TYPE_ORDER) < 127, "Too many values."
+# Can only store this many in the bytes, the top two bits are flags.
+assert len(VALUE_TYPE_ORDER) < 64, "Too many values."
 assert len(ENTITY_TYPE_ORDER) < 255, "Too many entity types."
     
 VALUE_TYPE_INDEX = {val: ind for (ind, val) in enumerate(VALUE_TYPE_ORDER)}
@@ -517,17 +534,26 @@ class BinStrDict:
         This returns a function which reads
         a string from a file at the current point. 
         """
+        return BinStrDict.make_lookup(file, BinStrDict.read_strings(file))
+
+    @staticmethod
+    def read_strings(file: BinaryIO) -> List[str]:
+        """Read the list of strings in the dictionary from a file."""
         [length] = _read_struct(_fmt_32bit, file)
         inv_list = [''] * length
         for ind in range(length):
             [str_len] = _fmt_16bit.unpack(file.read(2))
             inv_list[ind] = file.read(str_len).decode('utf8')
+        return inv_list
 
+    @staticmethod
+    def make_lookup(file: BinaryIO, inv_list: List[str]) -> Callable[[], str]:
+        """Return a function which reads strings from the given file."""
         def lookup() -> str:
             """Read the index from the file, and return the string it matches."""
             [index] = _fmt_16bit.unpack(file.read(2))
             return inv_list[index]
-        
+
         return lookup
 
     @staticmethod
@@ -842,15 +868,19 @@ class KeyValues:
 
         file.write('\n')
 
-    def serialise(self, file, str_dict: BinStrDict):
+    def serialise(self, file, str_dict: BinStrDict, with_help: bool=False):
         """Write to the binary file."""
         file.write(str_dict(self.name))
         file.write(str_dict(self.disp_name))
         value_type = VALUE_TYPE_INDEX[self.type]
-        # Use the high bit to store this inside here as well.
+        # Use the high bits to store these inside here as well.
         if self.readonly:
             value_type |= 128
+        if self.reportable:
+            value_type |= 64
         file.write(_fmt_8bit.pack(value_type))
+        if with_help:
+            _write_text(file, self.desc)
         
         # Spawnflags have integer names and defaults,
         # choices has string values and no default.
@@ -883,13 +913,16 @@ class KeyValues:
     def unserialise(
         file: BinaryIO,
         from_dict: Callable[[], str],
+        with_help: bool=False,
     ) -> 'KeyValues':
         """Recover a KeyValue from a binary file."""
         name = from_dict()
         disp_name = from_dict()
         [value_ind] = _read_struct(_fmt_8bit, file)
-        readonly = value_ind & 128
-        value_type = VALUE_TYPE_ORDER[value_ind & 127]
+        readonly = (value_ind & 128) != 0
+        reportable = (value_ind & 64) != 0
+        value_type = VALUE_TYPE_ORDER[value_ind & 63]
+        desc = _read_text(file) if with_help else ''
         
         val_list = None
         
@@ -922,9 +955,10 @@ class KeyValues:
             value_type,
             disp_name,
             default,
-            '',
+            desc,
             val_list,
             readonly,
+            reportable,
         )
 
 
@@ -993,19 +1027,24 @@ class IODef:
             _write_longstring(file, self.desc.replace('\n', '\\n'), indent='\t')
         file.write('\n')
         
-    def serialise(self, file: BinaryIO, dic: BinStrDict) -> None:
+    def serialise(self, file: BinaryIO, dic: BinStrDict, with_help: bool=False) -> None:
         """Write to the binary file."""
         file.write(dic(self.name))
         file.write(_fmt_8bit.pack(VALUE_TYPE_INDEX[self.type]))
+        if with_help:
+            _write_text(file, self.desc)
 
     @staticmethod
     def unserialise(
         file: BinaryIO,
         from_dict: Callable[[], str],
+        with_help: bool=False,
     ) -> 'IODef':
         """Recover an IODef from a binary file."""
         name = from_dict()
         value_type = VALUE_TYPE_ORDER[_read_struct(_fmt_8bit, file)[0]]
+        if with_help:
+            return IODef(name, value_type, _read_text(file))
         return IODef(name, value_type)
 
 
@@ -1496,6 +1535,7 @@ class EntityDef:
     def __deepcopy__(self, memodict: dict) -> 'EntityDef':
         """Handle copying ourselves, to eliminate lookups when not required."""
         copy = EntityDef.__new__(EntityDef)
+        memodict[id(self)] = copy
         copy.type = self.type
         copy.classname = self.classname
         copy.kv_order = self.kv_order.copy()
@@ -1507,14 +1547,14 @@ class EntityDef:
         for attr in ['keyvalues', 'inputs', 'outputs']:
             coll = {}
             setattr(copy, attr, coll)
-            for key, tags_map in getattr(copy, attr).items():
+            for key, tags_map in getattr(self, attr).items():
                 coll[key] = {
                     key: value.copy()
                     for key, value in tags_map.items()
                 }
-        copy.kv = _EntityView(self, 'keyvalues', 'kv')
-        copy.inp = _EntityView(self, 'inputs', 'inp')
-        copy.out = _EntityView(self, 'outputs', 'out')
+        copy.kv = _EntityView(copy, 'keyvalues', 'kv')
+        copy.inp = _EntityView(copy, 'inputs', 'inp')
+        copy.out = _EntityView(copy, 'outputs', 'out')
         return copy
 
     def __getstate__(self) -> tuple:
@@ -1660,8 +1700,11 @@ class EntityDef:
             yield ent
             yield from ent.iter_bases(_done)
             
-    def serialise(self, file, str_dict: BinStrDict):
-        """Write to the binary file."""
+    def serialise(self, file, str_dict: BinStrDict, with_help: bool=False):
+        """Write to the binary file.
+
+        If with_help is set, descriptions are also written.
+        """
         file.write(_fmt_ent_header.pack(
             ENTITY_TYPE_INDEX[self.type],
             len(self.bases),
@@ -1693,20 +1736,35 @@ class EntityDef:
                     [(tags, value)] = tag_map.items()
                     if not tags:
                         file.write(_fmt_8bit.pack(0))
-                        value.serialise(file, str_dict)
+                        value.serialise(file, str_dict, with_help)
                         continue
 
                 file.write(_fmt_8bit.pack(len(tag_map)))
                 for tags, value in tag_map.items():
                     BinStrDict.write_tags(file, str_dict, tags)
-                    value.serialise(file, str_dict)
+                    value.serialise(file, str_dict, with_help)
 
-        # Helpers are not added.
+        # Helpers are stored using the same arguments as in the text format.
+        file.write(_fmt_8bit.pack(len(self.helpers)))
+        for helper in self.helpers:
+            args = helper.export()
+            file.write(str_dict(helper.TYPE.value))
+            file.write(_fmt_8bit.pack(len(args)))
+            for arg in args:
+                file.write(str_dict(arg))
+
+        file.write(_fmt_16bit.pack(len(self.kv_order)))
+        for name in self.kv_order:
+            file.write(str_dict(name))
+
+        if with_help:
+            _write_text(file, self.desc)
         
     @staticmethod
     def unserialise(
         file: BinaryIO,
         from_dict: Callable[[], str],
+        with_help: bool=False,
     ) -> 'EntityDef':
         """Read from the binary file."""
         [
@@ -1738,7 +1796,7 @@ class EntityDef:
                 [tag_count] = _read_struct(_fmt_8bit, file)
                 if tag_count == 0:
                     # Special case, a single untagged item.
-                    obj = cls.unserialise(file, from_dict)
+                    obj = cls.unserialise(file, from_dict, with_help)
                     val_map[obj.name] = {frozenset(): obj}
                 else:
 
@@ -1746,15 +1804,100 @@ class EntityDef:
                     # one tag.
 
                     tag = BinStrDict.read_tags(file, from_dict)
-                    obj = cls.unserialise(file, from_dict)
+                    obj = cls.unserialise(file, from_dict, with_help)
                     tag_map = val_map[obj.name] = {tag: obj}
                     for _ in range(tag_count - 1):
                         tag = BinStrDict.read_tags(file, from_dict)
-                        obj = cls.unserialise(file, from_dict)
+                        obj = cls.unserialise(file, from_dict, with_help)
                         tag_map[tag] = obj
 
+        [helper_count] = _read_struct(_fmt_8bit, file)
+        for _ in range(helper_count):
+            helper_type = HelperTypes(from_dict())
+            [arg_count] = _read_struct(_fmt_8bit, file)
+            args = [from_dict() for _ in range(arg_count)]
+            ent.helpers.append(HELPER_IMPL[helper_type].parse(args))
+
+        [order_count] = _read_struct(_fmt_16bit, file)
+        ent.kv_order = [from_dict() for _ in range(order_count)]
+
+        if with_help:
+            ent.desc = _read_text(file)
+
+        return ent
+
+
+class _LazyEntities(MutableMapping[str, EntityDef]):
+    """The entities in a FGD read from the binary format.
+
+    Each entity is only decoded the first time it is accessed.
+    Until then the value is the offset of its data.
+    """
+    def __init__(
+        self,
+        strings: List[str],
+        offsets: Dict[str, int],
+        data: bytes,
+        with_help: bool,
+    ) -> None:
+        self._strings = strings
+        self._data = data
+        self._with_help = with_help
+        self._ents: Dict[str, Union[int, EntityDef]] = dict(offsets)
+
+    def __getitem__(self, classname: str) -> EntityDef:
+        ent = self._ents[classname]
+        if isinstance(ent, EntityDef):
+            return ent
+        file = io.BytesIO(self._data)
+        file.seek(ent)
+        ent = EntityDef.unserialise(
+            file,
+            BinStrDict.make_lookup(file, self._strings),
+            self._with_help,
+        )
+        self._ents[classname] = ent
+        # Bases are stored as classnames, decode those too.
+        base_names = ent.bases
+        ent.bases = []
+        for base in base_names:
+            try:
+                ent.bases.append(self[base.casefold()])  # type: ignore
+            except KeyError:
+                raise ValueError('Unknown base ({}) for {}'.format(
+                    base,
+                    ent.classname,
+                )) from None
         return ent
 
+    def __setitem__(self, classname: str, ent: EntityDef) -> None:
+        self._ents[classname] = ent
+
+    def __delitem__(self, classname: str) -> None:
+        del self._ents[classname]
+
+    def __contains__(self, classname: object) -> bool:
+        return classname in self._ents
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._ents)
+
+    def __len__(self) -> int:
+        return len(self._ents)
+
+    def __deepcopy__(self, memo: dict) -> '_LazyEntities':
+        """The encoded data is immutable, so it can be shared."""
+        copy = _LazyEntities.__new__(_LazyEntities)
+        memo[id(self)] = copy
+        copy._strings = self._strings
+        copy._data = self._data
+        copy._with_help = self._with_help
+        copy._ents = {
+            classname: deepcopy(ent, memo)
+            for classname, ent in self._ents.items()
+        }
+        return copy
+
 
 class FGD:
     """A FGD set for a game. May be composed of several files."""
@@ -1765,7 +1908,8 @@ class FGD:
         self._parse_list = set()
 
         # Entity definitions
-        self.entities: Dict[str, EntityDef] = {}
+        # This is lazily decoded if read from the binary format.
+        self.entities: MutableMapping[str, EntityDef] = {}
 
         # Maximum bounding box of map
         self.map_size_min = 0
@@ -1788,6 +1932,9 @@ class FGD:
         cls,
         file: Union[File, str],
         filesystem: FileSystem=None,
+        *,
+        cache_file: Union[str, os.PathLike, None]=None,
+        cache_help: bool=True,
     ) -> 'FGD':
         """Parse an FGD file.
 
@@ -1796,6 +1943,10 @@ class FGD:
         * filesystem: The system to lookup files in. This is needed to 
           resolve file inclusions. If not passed, file must be a filesystem
           File to obtain a matching filesystem.
+        * cache_file: If set, the parsed result is stored in this file in the
+          binary format. Later calls load from that instead, unless the
+          cache key of the FGD or any included file has changed.
+        * cache_help: If False, help text is not stored in the cache.
         """
         if filesystem is not None and not isinstance(file, File):
             if not file.endswith('.fgd'):
@@ -1811,10 +1962,89 @@ class FGD:
             raise TypeError(
                 'String file path passed ({!r}), but no filesystem!'.format(file)
             )
+        if cache_file is not None:
+            fgd = cls._load_cache(cache_file, filesystem, file, cache_help)
+            if fgd is not None:
+                return fgd
         fgd = cls()
         fgd.parse_file(filesystem, file)
+        if cache_file is not None:
+            fgd._save_cache(cache_file, file, cache_help)
+        return fgd
+
+    @classmethod
+    def _load_cache(
+        cls,
+        cache_file: Union[str, os.PathLike],
+        filesystem: FileSystem,
+        file: File,
+        need_help: bool,
+    ) -> Optional['FGD']:
+        """Load a cached FGD, or return None if it's missing or outdated."""
+        try:
+            with open(cache_file, 'rb') as f:
+                data = io.BytesIO(f.read())
+        except OSError:
+            return None
+        try:
+            if data.read(4) != b'FGDC':
+                return None
+            [count] = _read_struct(_fmt_32bit, data)
+            files: List[File] = []
+            with filesystem:
+                for _ in range(count):
+                    [path_len] = _read_struct(_fmt_16bit, data)
+                    path = data.read(path_len).decode('utf8')
+                    [key] = _read_struct(_fmt_cache_key, data)
+                    # The first file is the one we parsed.
+                    if not files and path != file.path:
+                        return None
+                    try:
+                        inc_file = filesystem[path]
+                    except (KeyError, ValueError, FileNotFoundError):
+                        return None
+                    if inc_file.cache_key() != key:
+                        return None
+                    files.append(inc_file)
+            # Any corruption in the data is caught below.
+            fgd = cls.unserialise(data)
+            if need_help and not fgd.entities._with_help:
+                return None
+        except (ValueError, TypeError, EOFError, struct_error):
+            return None
+        fgd._parse_list = set(files)
         return fgd
 
+    def _save_cache(
+        self,
+        cache_file: Union[str, os.PathLike],
+        file: File,
+        with_help: bool,
+    ) -> None:
+        """Write this FGD to a cache file, with the keys of each parsed file."""
+        # The root file first, then all the included ones.
+        files = [file]
+        files += sorted(
+            (inc_file for inc_file in self._parse_list if inc_file is not file),
+            key=lambda inc_file: inc_file.path,
+        )
+        keys = [inc_file.cache_key() for inc_file in files]
+        if -1 in keys:
+            # Changes can't be detected, so it can't be cached.
+            return
+        try:
+            with srctools.AtomicWriter(cache_file, is_bytes=True) as f:
+                f.write(b'FGDC')
+                f.write(_fmt_32bit.pack(len(files)))
+                for inc_file, key in zip(files, keys):
+                    encoded = inc_file.path.encode('utf8')
+                    f.write(_fmt_16bit.pack(len(encoded)))
+                    f.write(encoded)
+                    f.write(_fmt_cache_key.pack(key))
+                self.serialise(f, with_help)
+        except OSError:
+            pass  # It's only a cache, parsing still succeeded.
+
     def apply_bases(self) -> None:
         """Fix base values in entities after parsing.
         
@@ -2137,6 +2367,7 @@ class FGD:
         """
         # It's pretty expensive to parse, so keep the original privately,
         # returning a deep-copy.
+        # Entities are only decoded when used, so the copy is cheap.
         global _ENGINE_FGD
         if _ENGINE_FGD is None:
             try:
@@ -2146,7 +2377,7 @@ class FGD:
                 from importlib_resources import open_binary
             from lzma import LZMAFile
             with open_binary(srctools, 'fgd.lzma') as comp, LZMAFile(comp) as f:
-                return cls.unserialise(f)
+                _ENGINE_FGD = FGD.unserialise(f)
         return deepcopy(_ENGINE_FGD)
 
     def __getitem__(self, classname: str) -> EntityDef:
@@ -2189,11 +2420,12 @@ class FGD:
                     break
             self._fix_missing_bases(base)
 
-    def serialise(self, file: BinaryIO) -> None:
+    def serialise(self, file: BinaryIO, with_help: bool=False) -> None:
         """Write the FGD into a compacted binary format.
         
-        This is only readable by this module, and does not contain
-        entity, keyvalue and IO help descriptions to keep the data small.
+        This is only readable by this module. Unless with_help is set, it
+        does not contain entity, keyvalue and IO help descriptions to keep
+        the data small.
         """
         for ent in list(self):
             self._fix_missing_bases(ent)
@@ -2201,21 +2433,47 @@ class FGD:
         # The start of a file is a list of all used strings. 
         dictionary = BinStrDict()
         
-        # Start of file - format version, FGD min/max, number of entities.
+        # Start of file - format version, FGD min/max, number of entities,
+        # flags.
         file.write(b'FGD' + _fmt_header.pack(
             BIN_FORMAT_VERSION,
             self.map_size_min,
             self.map_size_max,
             len(self.entities),
+            BIN_FLAG_HELP if with_help else 0,
         ))
-        
+
+        # Material exclusions and visgroups.
+        extra_data = io.BytesIO()
+        extra_data.write(_fmt_16bit.pack(len(self.mat_exclusions)))
+        for folder in sorted(self.mat_exclusions):
+            extra_data.write(dictionary(str(folder)))
+        extra_data.write(_fmt_16bit.pack(len(self.auto_visgroups)))
+        for key, visgroup in self.auto_visgroups.items():
+            extra_data.write(dictionary(key))
+            extra_data.write(dictionary(visgroup.name))
+            extra_data.write(dictionary(visgroup.parent))
+            extra_data.write(_fmt_16bit.pack(len(visgroup.ents)))
+            for classname in sorted(visgroup.ents):
+                extra_data.write(dictionary(classname))
+
         ent_data = io.BytesIO()
-        for ent in self.entities.values():
-            ent.serialise(ent_data, dictionary)
-            
-        # The final file is the header, dictionary data, and all the entities 
-        # one after each other.
+        offsets: List[Tuple[str, int]] = []
+        for classname, ent in self.entities.items():
+            offsets.append((classname, ent_data.tell()))
+            ent.serialise(ent_data, dictionary, with_help)
+
+        # The final file is the header, dictionary data, exclusions and
+        # visgroups, the offset of each entity, then all the entities one
+        # after each other.
         dictionary.serialise(file)
+        file.write(extra_data.getvalue())
+        for classname, offset in offsets:
+            encoded = classname.encode('utf8')
+            file.write(_fmt_16bit.pack(len(encoded)))
+            file.write(encoded)
+            file.write(_fmt_32bit.pack(offset))
+        file.write(_fmt_32bit.pack(ent_data.tell()))
         file.write(ent_data.getvalue())
         # print('Dict size: ', format(dictionary.cur_index / (1 << 16), '%'))
 
@@ -2223,7 +2481,8 @@ class FGD:
     def unserialise(cls, file: BinaryIO) -> 'FGD':
         """Unpack data from FGD.serialise() to return the original data.
         
-        Help descriptions are not preserved, and are set to <BINARY>.
+        Help descriptions are blank unless they were included.
+        Entities are only decoded when first accessed.
         """
         
         if file.read(3) != b'FGD':
@@ -2236,18 +2495,36 @@ class FGD:
             fgd.map_size_min,
             fgd.map_size_max,
             ent_count,
+            flags,
         ] = _read_struct(_fmt_header, file)
-        
+
         if format_version != BIN_FORMAT_VERSION:
             raise TypeError('Unknown format version "{}"!'.format(format_version))
-            
-        from_dict = BinStrDict.unserialise(file)
 
-        # Now there's ent_count entities after each other.
-        for _ in range(ent_count):
-            ent = EntityDef.unserialise(file, from_dict)
-            fgd.entities[ent.classname.casefold()] = ent
+        strings = BinStrDict.read_strings(file)
+        from_dict = BinStrDict.make_lookup(file, strings)
+
+        [excl_count] = _read_struct(_fmt_16bit, file)
+        for _ in range(excl_count):
+            fgd.mat_exclusions.add(PurePosixPath(from_dict()))
+        [vis_count] = _read_struct(_fmt_16bit, file)
+        for _ in range(vis_count):
+            key = from_dict()
+            visgroup = fgd.auto_visgroups[key] = AutoVisgroup(from_dict(), from_dict())
+            [vis_ent_count] = _read_struct(_fmt_16bit, file)
+            visgroup.ents.update(from_dict() for _ in range(vis_ent_count))
 
-        fgd.apply_bases()
+        offsets: Dict[str, int] = {}
+        for _ in range(ent_count):
+            [name_len] = _read_struct(_fmt_16bit, file)
+            classname = file.read(name_len).decode('utf8')
+            [offsets[classname]] = _read_struct(_fmt_32bit, file)
+        [data_size] = _read_struct(_fmt_32bit, file)
+        fgd.entities = _LazyEntities(
+            strings,
+            offsets,
+            file.read(data_size),
+            (flags & BIN_FLAG_HELP) != 0,
+        )
 
         return fgd
@@ -3,18 +3,21 @@
 This allows accessing raw files, zips and VPKs in the same way.
 Files are case-insensitive, and both slashes are converted to '/'.
 """
+from collections import OrderedDict
 from zipfile import ZipFile, ZipInfo
 import io
 import os
+import threading
+import weakref
 
-from srctools.vpk import VPK, FileInfo as VPKFile
+from srctools.vpk import VPKIndex, FileInfo as VPKFile
 from srctools.property_parser import Property
 
 from typing import (
     TypeVar, Generic, Any,
     Union, Optional, Tuple,
     Iterator, List, Dict, Set,
-    TextIO, BinaryIO,
+    TextIO, BinaryIO, NamedTuple,
 )
 
 
@@ -99,20 +102,34 @@ class FileSystem(Generic[_SysRefT, _FileDataT]):
         self.path = os.fspath(path)
         self._ref: Optional[_SysRefT] = None
         self._ref_count = 0
+        # Allow references to be opened from several threads.
+        self._ref_lock = threading.Lock()
+        # Chains containing this system, which need to know about changes.
+        self._parents: 'weakref.WeakValueDictionary[int, FileSystemChain]' = weakref.WeakValueDictionary()
+
+    def _notify_change(self) -> None:
+        """Called when the contents of this system may have changed.
+
+        This clears the caches of any chains containing this system.
+        """
+        for chain in list(self._parents.values()):
+            chain.clear_cache()
 
     def open_ref(self) -> None:
         """Lock open a reference to this system."""
-        self._ref_count += 1
-        if self._ref is None:
-            self._create_ref()
+        with self._ref_lock:
+            self._ref_count += 1
+            if self._ref is None:
+                self._create_ref()
 
     def close_ref(self) -> None:
         """Reverse self.open_ref() - must be done in pairs."""
-        self._ref_count -= 1
-        if self._ref_count < 0:
-            raise ValueError('Closed too many times!')
-        if self._ref_count == 0 and self._ref is not None:
-            self._delete_ref()
+        with self._ref_lock:
+            self._ref_count -= 1
+            if self._ref_count < 0:
+                raise ValueError('Closed too many times!')
+            if self._ref_count == 0 and self._ref is not None:
+                self._delete_ref()
 
     def read_prop(self, path: str, encoding='utf8') -> Property:
         """Read a Property file from the filesystem.
@@ -214,12 +231,39 @@ class FileSystem(Generic[_SysRefT, _FileDataT]):
         return -1
 
 
+class CacheInfo(NamedTuple):
+    """Statistics for the FileSystemChain resolution cache."""
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
 class FileSystemChain(Generic[ChildSysT], FileSystem[None, File]):
-    """Chains several filesystem into one prioritised whole."""
+    """Chains several filesystem into one prioritised whole.
 
-    def __init__(self, *systems: Union[ChildSysT, Tuple[str, ChildSysT]]) -> None:
+    Up to cache_size lookups are cached, including files which do not exist.
+    The cache is cleared when systems are added, the chain is reopened, or
+    a child system detects a change. If files are modified while the chain
+    is open, call clear_cache().
+    """
+
+    def __init__(
+        self,
+        *systems: Union[ChildSysT, Tuple[str, ChildSysT]],
+        cache_size: int=4096,
+    ) -> None:
         super().__init__('')
         self.systems: List[Tuple[ChildSysT, str]] = []
+        # Name -> the file, or None if not present.
+        self._cache: 'OrderedDict[str, Optional[File[ChildSysT]]]' = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_hits = self._cache_misses = 0
+        # The chain may be shared between threads, so guard the cache.
+        # The generation is incremented whenever it is cleared, so lookups
+        # made in the meantime are not stored.
+        self._cache_lock = threading.Lock()
+        self._cache_gen = 0
         for sys in systems:
             if isinstance(sys, tuple):
                 self.add_sys(*sys)
@@ -259,13 +303,52 @@ class FileSystemChain(Generic[ChildSysT], FileSystem[None, File]):
             self.systems.insert(0, (sys, prefix))
         else:
             self.systems.append((sys, prefix))
+        sys._parents[id(self)] = self
+        self._notify_change()
         # If we're currently open, apply that to the added systems.
         if self._ref_count > 0:
             sys.open_ref()
 
+    def _notify_change(self) -> None:
+        """Our contents have changed, so clear the cache."""
+        self.clear_cache()
+
+    def clear_cache(self) -> None:
+        """Clear the resolution cache.
+
+        This also clears the caches of any chains containing this one.
+        """
+        with self._cache_lock:
+            self._cache.clear()
+            self._cache_gen += 1
+        super()._notify_change()
+
+    def cache_info(self) -> CacheInfo:
+        """Report the performance of the resolution cache."""
+        return CacheInfo(
+            self._cache_hits,
+            self._cache_misses,
+            self._cache_size,
+            len(self._cache),
+        )
+
     def _get_file(self: 'FileSystemChain[ChildSysT]', name: str) -> File[ChildSysT]:
         """Search for a file on each filesystem in turn."""
         self._check_open()
+        key = name.replace('\\', '/')
+        with self._cache_lock:
+            try:
+                file = self._cache[key]
+            except KeyError:
+                self._cache_misses += 1
+                generation = self._cache_gen
+            else:
+                self._cache_hits += 1
+                self._cache.move_to_end(key)
+                if file is None:
+                    raise FileNotFoundError(name)
+                return file
+
         for sys, prefix in self.systems:
             full_name = os.path.join(prefix, name).replace('\\', '/')
             try:
@@ -274,8 +357,20 @@ class FileSystemChain(Generic[ChildSysT], FileSystem[None, File]):
                 continue
             # Pass the original file instance, so we can open
             # from the original system.
-            return File(self, full_name, file_info)
-        raise FileNotFoundError(name)
+            file = File(self, full_name, file_info)
+            break
+        else:
+            file = None
+
+        if self._cache_size > 0:
+            with self._cache_lock:
+                if generation == self._cache_gen:
+                    self._cache[key] = file
+                    if len(self._cache) > self._cache_size:
+                        self._cache.popitem(last=False)
+        if file is None:
+            raise FileNotFoundError(name)
+        return file
 
     def open_str(self, name: Union[str, File[ChildSysT]], encoding: str = 'utf8') -> TextIO:
         """Open a file in unicode mode or raise FileNotFoundError.
@@ -327,7 +422,11 @@ class FileSystemChain(Generic[ChildSysT], FileSystem[None, File]):
         self._ref = None
 
     def _create_ref(self) -> None:
-        """Creating and deleting refs affects the underlying systems."""
+        """Creating and deleting refs affects the underlying systems.
+
+        Files may have changed while we were closed, so clear the cache.
+        """
+        self.clear_cache()
         for sys, prefix in self.systems:
             sys.open_ref()
         self._ref = True
@@ -451,11 +550,21 @@ class RawFileSystem(FileSystem):
     """Accesses files in a real folder.
 
     This prohibits access to folders above the root.
+
+    If index is true, directory listings are cached to make lookups fast and
+    case-insensitive on all platforms. Each directory is scanned the first
+    time it's used, then rescanned if its modification time has changed when
+    the filesystem is next opened.
     """
-    def __init__(self, path: Union[str, os.PathLike]):
+    def __init__(self, path: Union[str, os.PathLike], index: bool=False) -> None:
         super().__init__(os.path.abspath(path))
+        # Relative folder -> (mtime, files, folders). The dicts map both the
+        # real and casefolded names to the real name.
+        self._index: Optional[Dict[str, Tuple[int, Dict[str, str], Dict[str, str]]]] = {} if index else None
 
     def __repr__(self):
+        if self._index is not None:
+            return 'RawFileSystem({!r}, index=True)'.format(self.path)
         return 'RawFileSystem({!r})'.format(self.path)
 
     def _resolve_path(self, path: str) -> str:
@@ -465,6 +574,66 @@ class RawFileSystem(FileSystem):
             raise ValueError('Path "{}" escaped "{}"!'.format(path, self.path))
         return abs_path
 
+    def _scan_folder(self, folder: str) -> Tuple[int, Dict[str, str], Dict[str, str]]:
+        """Return the index for a folder, scanning it if required."""
+        try:
+            return self._index[folder]
+        except KeyError:
+            pass
+        files: Dict[str, str] = {}
+        folders: Dict[str, str] = {}
+        path = os.path.join(self.path, folder)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            with os.scandir(path) as scan:
+                for entry in scan:
+                    names = folders if entry.is_dir() else files
+                    # Exact matches take priority over case-insensitive ones.
+                    names.setdefault(entry.name.casefold(), entry.name)
+                    names[entry.name] = entry.name
+        except (FileNotFoundError, NotADirectoryError):
+            mtime = -1
+        self._index[folder] = result = (mtime, files, folders)
+        return result
+
+    def _lookup(self, name: str) -> Optional[str]:
+        """Find the real relative path for a file, or None if it doesn't exist."""
+        if self._index is None or os.path.isabs(name):
+            if os.path.isfile(self._resolve_path(name)):
+                return name.replace('\\', '/')
+            return None
+        parts = [part for part in name.replace('\\', '/').split('/') if part and part != '.']
+        if not parts or '..' in parts:
+            if os.path.isfile(self._resolve_path(name)):
+                return name.replace('\\', '/')
+            return None
+        folder = ''
+        for part in parts[:-1]:
+            folders = self._scan_folder(folder)[2]
+            real = folders.get(part) or folders.get(part.casefold())
+            if real is None:
+                return None
+            folder = folder + '/' + real if folder else real
+        files = self._scan_folder(folder)[1]
+        real = files.get(parts[-1]) or files.get(parts[-1].casefold())
+        if real is None:
+            return None
+        return folder + '/' + real if folder else real
+
+    def _check_index(self) -> None:
+        """Discard the indexes for any folders which have been modified."""
+        changed = False
+        for folder, (mtime, files, folders) in list(self._index.items()):
+            try:
+                cur_mtime = os.stat(os.path.join(self.path, folder)).st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                cur_mtime = -1
+            if cur_mtime != mtime:
+                del self._index[folder]
+                changed = True
+        if changed:
+            self._notify_change()
+
     def walk_folder(self, folder: str) -> Iterator[File]:
         """Yield files in a folder."""
         path = self._resolve_path(folder)
@@ -485,6 +654,8 @@ class RawFileSystem(FileSystem):
         self._check_open()
         if isinstance(name, File):
             name = self._get_data(name)
+        elif self._index is not None:
+            name = self._get_data(self._get_file(name))
         return open(self._resolve_path(name), mode='rt', encoding=encoding)
 
     def open_bin(self, name: Union[str, File['RawFileSystem']]) -> BinaryIO:
@@ -496,21 +667,24 @@ class RawFileSystem(FileSystem):
         self._check_open()
         if isinstance(name, File):
             name = self._get_data(name)
+        elif self._index is not None:
+            name = self._get_data(self._get_file(name))
         return open(self._resolve_path(name), mode='rb')
 
     def _file_exists(self, name: str) -> bool:
         # We don't need this, but it should match other filesystems.
         self._check_open()
 
-        return os.path.isfile(self._resolve_path(name))
+        return self._lookup(name) is not None
 
     def _get_file(self, name: str):
         # We don't need this, but it should match other filesystems.
         self._check_open()
 
-        if os.path.isfile(self._resolve_path(name)):
-            name = name.replace('\\', '/')
-            return File(self, name, name)
+        real_name = self._lookup(name)
+        if real_name is not None:
+            # The data is the name with the real case.
+            return File(self, name.replace('\\', '/'), real_name)
         raise FileNotFoundError(name)
 
     def _delete_ref(self) -> None:
@@ -518,13 +692,18 @@ class RawFileSystem(FileSystem):
         self._ref = None
 
     def _create_ref(self) -> None:
-        """The raw filesystem doesn't need a reference to anything."""
+        """The raw filesystem doesn't need a reference to anything.
+
+        If indexed, this is when we check if folders have changed.
+        """
+        if self._index is not None:
+            self._check_index()
         self._ref = True
 
     def _get_cache_key(self, file: File['RawFileSystem']) -> int:
         """Our cache key is the last modification time."""
         try:
-            return os.stat(self._resolve_path(file.path)).st_mtime_ns
+            return os.stat(self._resolve_path(self._get_data(file))).st_mtime_ns
         except FileNotFoundError:
             return -1
 
@@ -615,49 +794,66 @@ class ZipFileSystem(FileSystem[ZipFile, ZipInfo]):
         return self._get_data(file).CRC
 
 
-class VPKFileSystem(FileSystem[VPK, VPKFile]):
-    """Accesses files in a VPK file."""
-    def __init__(self, path: Union[str, os.PathLike]):
+class VPKFileSystem(FileSystem[VPKIndex, VPKFile]):
+    """Accesses files in a VPK file.
+
+    If index_file is set, the directory index is cached there, so it does not
+    need to be parsed again until the VPK changes.
+    """
+    def __init__(
+        self,
+        path: Union[str, os.PathLike],
+        index_file: Union[str, os.PathLike, None]=None,
+    ) -> None:
         super().__init__(path)
-        # Used to enforce case-insensitivity.
+        self.index_file = index_file
+        # FileInfo objects for files we have looked up so far.
+        # Keys are casefolded, to enforce case-insensitivity.
         self._name_to_file: Dict[str, VPKFile] = {}
 
     def __repr__(self) -> str:
         return 'VPKFileSystem({!r})'.format(self.path)
 
     def _create_ref(self) -> None:
-        self._ref = VPK(self.path)
-
+        self._ref = VPKIndex(self.path, self.index_file)
         self._name_to_file.clear()
-        for file in self._ref:
-            self._name_to_file[
-                file.filename.replace('\\', '/').casefold()
-            ] = file
 
     def _delete_ref(self) -> None:
-        # We only read from VPKs, so no cleanup needs to be done.
+        # We only read from VPKs, so only the index needs to be closed.
+        self._ref.close()
         self._ref = None
         self._name_to_file.clear()
 
-    def _file_exists(self, name: str) -> bool:
+    def _get_info(self, name: str) -> VPKFile:
+        """Find the FileInfo for a file, or raise FileNotFoundError."""
         self._check_open()
-        return name in self._name_to_file
-
-    def _get_file(self, name: str) -> File['VPKFileSystem']:
         key = name.casefold().replace('\\', '/')
         try:
-            file = self._name_to_file[key]
+            return self._name_to_file[key]
         except KeyError:
-            raise FileNotFoundError(name) from None
-        return File(self, key, file)
+            pass
+        entry = self._ref.lookup(key)
+        if entry is None:
+            raise FileNotFoundError(name)
+        file = self._name_to_file[key] = self._ref.file_info(entry)
+        return file
+
+    def _file_exists(self, name: str) -> bool:
+        self._check_open()
+        return name in self._ref
+
+    def _get_file(self, name: str) -> File['VPKFileSystem']:
+        file = self._get_info(name)
+        return File(self, name.casefold().replace('\\', '/'), file)
 
     def walk_folder(self, folder: str) -> Iterator[File['VPKFileSystem']]:
         """Yield files in a folder."""
+        self._check_open()
         # All VPK files use forward slashes.
         folder = folder.replace('\\', '/')
-        for file in self._name_to_file.values():
-            if file.dir.startswith(folder):
-                yield File(self, file.filename, file)
+        for entry in self._ref:
+            if entry.path.rpartition('/')[0].startswith(folder):
+                yield File(self, entry.path, self._get_info(entry.path))
 
     def open_bin(self, name: Union[str, File['VPKFileSystem']]) -> BinaryIO:
         """Open a file in bytes mode or raise FileNotFoundError."""
@@ -666,11 +862,9 @@ class VPKFileSystem(FileSystem[VPK, VPKFile]):
             if isinstance(name, File):
                 file = self._get_data(name)
             else:
-                try:
-                    file = self._name_to_file[name.casefold().replace('\\', '/')]
-                except KeyError:
-                    raise FileNotFoundError(name)
-            return io.BytesIO(file.read())
+                file = self._get_info(name)
+            # This reads directly from the archive.
+            return file.open_bin()
 
     def open_str(
         self,
@@ -683,13 +877,9 @@ class VPKFileSystem(FileSystem[VPK, VPKFile]):
             if isinstance(name, File):
                 file = self._get_data(name)
             else:
-                try:
-                    file = self._name_to_file[name.casefold().replace('\\', '/')]
-                except KeyError:
-                    raise FileNotFoundError(name)
-            # Wrap the data to treat it as bytes, then
-            # wrap that to decode and clean up universal newlines.
-            return io.TextIOWrapper(io.BytesIO(file.read()), encoding)
+                file = self._get_info(name)
+            # Wrap the archive data to decode and clean up universal newlines.
+            return io.TextIOWrapper(file.open_bin(), encoding)
 
     def _get_cache_key(self, file: File['VPKFileSystem']) -> int:
         """Return the CRC of the VPK file."""
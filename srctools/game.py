@@ -7,6 +7,7 @@ import itertools
 
 from srctools import Property
 from srctools.filesys import FileSystemChain, VPKFileSystem, RawFileSystem
+from srctools.vpk import get_index_filename
 
 
 GINFO = 'gameinfo.txt'
@@ -86,8 +87,16 @@ class Game:
 
         return (self.root / prop.value).absolute()
 
-    def get_filesystem(self) -> FileSystemChain:
-        """Build a chained filesystem from the search paths."""
+    def get_filesystem(
+        self,
+        index_folder: Optional[Path]=None,
+        index_raw: bool=False,
+    ) -> FileSystemChain:
+        """Build a chained filesystem from the search paths.
+
+        If index_folder is set, VPK directory indexes are cached there.
+        If index_raw is set, raw folders cache their directory listings.
+        """
         vpks = []
         raw_folders = []
 
@@ -112,9 +121,13 @@ class Game:
 
         fsys = FileSystemChain()
         for path in vpks:
-            fsys.add_sys(VPKFileSystem(path))
+            if index_folder is not None:
+                index_file = index_folder / get_index_filename(path)
+            else:
+                index_file = None
+            fsys.add_sys(VPKFileSystem(path, index_file))
         for path in raw_folders:
-            fsys.add_sys(RawFileSystem(path))
+            fsys.add_sys(RawFileSystem(path, index=index_raw))
 
         return fsys
 
@@ -294,6 +294,42 @@ ANIM_EVENT_BY_NAME = {
 ST_PHY_HEADER = Struct('<iiil')
 
 
+def iter_textures(
+    fsys: FileSystem,
+    cdmaterials: Sequence[str],
+    skins: Sequence[Sequence[str]],
+    wanted_skins: Iterable[int]=None,
+) -> Iterator[str]:
+    """Yield the materials used by a model's skins.
+
+    If wanted_skins is given, only those skin indexes are used. Each texture
+    is looked up in the filesystem to determine which CDMaterials folder to
+    use, if any. The results are sorted, so the order is consistent.
+    """
+    if wanted_skins:
+        paths = set()
+        for ind in wanted_skins:
+            try:
+                paths.update(skins[ind])
+            except IndexError:
+                # Default to skin 0.
+                paths.update(skins[0])
+    else:
+        paths = {
+            tex
+            for texgroup in skins
+            for tex in texgroup
+        }
+
+    with fsys:
+        for tex in sorted(paths):
+            for folder in cdmaterials:
+                full = str(PurePosixPath('materials', folder, tex).with_suffix('.vmt'))
+                if full in fsys:
+                    yield full
+                    break
+
+
 class Model:
     """Represents parts of Source models.
 
@@ -750,29 +786,7 @@ class Model:
         list. This looks up in the filesystem to determine which CDMaterials
         folder to use, if any.
         """
-
-        if skins:
-            paths = set()
-            for ind in skins:
-                try:
-                    paths.update(self.skins[ind])
-                except IndexError:
-                    # Default to skin 0.
-                    paths.update(self.skins[0])
-        else:
-            paths = {
-                tex
-                for texgroup in self.skins
-                for tex in texgroup
-            }
-
-        with self._sys:
-            for tex in paths:
-                for folder in self.cdmaterials:
-                    full = str(PurePosixPath('materials', folder, tex).with_suffix('.vmt'))
-                    if full in self._sys:
-                        yield full
-                        break
+        return iter_textures(self._sys, self.cdmaterials, self.skins, skins)
 
     def find_sounds(self) -> Iterator[str]:
         """Yield all sounds used by animations.
@@ -1,29 +1,45 @@
 """Handles the list of files which are desired to be packed into the BSP."""
+import contextlib
+import copy
+import functools
+import hashlib
 import io
 import itertools
-from collections import OrderedDict
-from typing import Iterable, Dict, Tuple, List, Iterator, Set, Optional
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import (
+    Iterable, Dict, Tuple, List, Iterator, Set, Optional, NamedTuple, Union,
+    BinaryIO, Mapping, Deque,
+)
 from enum import Enum, auto as auto_enum
-from zipfile import ZipFile
+from zipfile import (
+    ZipFile, ZipInfo, BadZipFile, is_zipfile, ZIP_STORED, ZIP_LZMA,
+)
+import zipfile
+import zlib
 import os
+import shutil
+import struct
 
 from srctools import conv_bool
 from srctools.tokenizer import TokenSyntaxError
 from srctools.property_parser import Property, KeyValError
 from srctools.vmf import VMF
 from srctools.fgd import FGD, ValueTypes as KVTypes, KeyValues, EntityDef, EntityTypes
-from srctools.bsp import BSP, BSP_LUMPS
+from srctools.bsp import BSP, BSP_LUMPS, COPY_CHUNK_SIZE
 from srctools.filesys import (
     FileSystem, VPKFileSystem, FileSystemChain, File,
     VirtualFileSystem,
 )
-from srctools.mdl import Model, MDL_EXTS
+from srctools.mdl import Model, MDL_EXTS, iter_textures as mdl_iter_textures
 from srctools.vmt import Material, VarType
 from srctools.sndscript import Sound, SND_CHARS
 import srctools.logger
 
 LOGGER = srctools.logger.get_logger(__name__)
 SOUND_CACHE_VERSION = '1'  # Used to allow ignoring incompatible versions.
+DEPENDENCY_CACHE_VERSION = '1'
 
 
 class FileType(Enum):
@@ -79,6 +95,12 @@ def load_fgd() -> FGD:
     return FGD.engine_dbase()
 
 
+class _Duplicate(NamedTuple):
+    """A packed file with identical contents to an earlier one."""
+    info: ZipInfo  # The earlier file.
+    data: 'Future[bytes]'
+
+
 class PackFile:
     """Represents a single file we are packing.
     
@@ -117,6 +139,58 @@ class PackFile:
         return text
 
 
+class EvalStats(NamedTuple):
+    """Statistics for one type of file, from PackList.eval_dependencies()."""
+    count: int  # The number of files analysed.
+    time: float  # Total time taken, summed across all threads.
+    cached: int = 0  # The number of files found in the dependency cache.
+
+
+# A file to pack - the filename, type and if it is optional.
+_Dependency = Tuple[str, FileType, bool]
+
+
+class _MaterialDeps(NamedTuple):
+    """The cached dependencies of a material."""
+    key: int  # cache_key() of the VMT.
+    parents: List[Tuple[str, int]]  # Patch parents, and their cache_key().
+    depends: List[Tuple[str, FileType]]
+
+
+class _ModelDeps(NamedTuple):
+    """The information about a model required to find its dependencies.
+
+    Textures are looked up in the CDMaterials folders each time, since
+    which exist can change without the model changing.
+    """
+    key: int  # cache_key() of the MDL.
+    phy_key: int  # cache_key() of the PHY, or 0 if not present.
+    cdmaterials: List[str]
+    skins: List[List[str]]
+    includes: List[str]
+    sounds: List[str]
+    breaks: List[str]
+
+    @classmethod
+    def from_model(cls, mdl: Model, key: int, phy_key: int) -> '_ModelDeps':
+        """Read the information from a parsed model."""
+        return cls(
+            key, phy_key,
+            list(mdl.cdmaterials),
+            [list(skin) for skin in mdl.skins],
+            [inc_mdl.filename for inc_mdl in mdl.included_models],
+            list(mdl.find_sounds()),
+            [
+                prop.value
+                for prop in mdl.phys_keyvalues.find_all('break', 'model')
+            ],
+        )
+
+    def iter_textures(self, fsys: FileSystem, skins: Optional[Set[int]]) -> Iterator[str]:
+        """Yield materials used by the model, like Model.iter_textures()."""
+        return mdl_iter_textures(fsys, self.cdmaterials, self.skins, skins)
+
+
 def unify_path(path: str):
     """Convert paths to a unique form."""
     path = os.path.normpath(path).casefold().replace('\\', '/')
@@ -125,6 +199,116 @@ def unify_path(path: str):
     return path.lstrip('/')
 
 
+# A compression policy for pack_into_zip(). Textures and models are streamed
+# by the engine, and sounds are already compressed, so these are stored.
+# Everything else is compressed with LZMA.
+COMPRESSION_POLICY_LZMA = {
+    'vtf': ZIP_STORED,
+    'vtx': ZIP_STORED,
+    'vvd': ZIP_STORED,
+    'wav': ZIP_STORED,
+    'mp3': ZIP_STORED,
+    'ogg': ZIP_STORED,
+    '*': ZIP_LZMA,
+}  # type: Dict[str, int]
+
+# When packing, the number of compressed files which may be waiting to be
+# written.
+COMPRESS_WINDOW = 32
+
+# The timestamp used for reproducible packfiles, the earliest zips allow.
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+# The fixed part of a zip's local file header.
+_ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+
+
+def _copy_zip_entry(src: BinaryIO, info: ZipInfo, dest_zip: ZipFile, dest: BinaryIO) -> None:
+    """Copy an entry from one zip file to another, without recompressing it.
+
+    src is the file containing the entry, and dest is the file dest_zip
+    writes to.
+    """
+    src.seek(info.header_offset)
+    header = _ZIP_LOCAL_HEADER.unpack(src.read(_ZIP_LOCAL_HEADER.size))
+    if header[0] != b'PK\x03\x04':
+        raise BadZipFile('Bad magic number for file header of "{}"'.format(info.filename))
+    # Skip the filename and extra field.
+    src.seek(header[10] + header[11], io.SEEK_CUR)
+
+    new_info = copy.copy(info)
+    # The sizes are known, so a data descriptor isn't required.
+    new_info.flag_bits &= ~0x08
+    _write_raw_entry(dest_zip, dest, new_info, _read_chunks(src, info))
+
+
+def _read_chunks(file: BinaryIO, info: ZipInfo) -> Iterator[bytes]:
+    """Read the compressed data for an entry, in chunks."""
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = file.read(min(remaining, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise BadZipFile('Truncated data for "{}"'.format(info.filename))
+        yield chunk
+        remaining -= len(chunk)
+
+
+def _write_raw_entry(dest_zip: ZipFile, dest: BinaryIO, info: ZipInfo, chunks: Iterable[bytes]) -> None:
+    """Write already compressed data into a zip.
+
+    The CRC and sizes must be filled in. ZipFile has no API for this, so the
+    archive needs to be updated the same way ZipFile.write() does.
+    """
+    info.header_offset = dest.tell()
+    dest.write(info.FileHeader())
+    for chunk in chunks:
+        dest.write(chunk)
+
+    dest_zip.filelist.append(info)
+    dest_zip.NameToInfo[info.filename] = info
+    dest_zip.start_dir = dest.tell()
+    dest_zip._didModify = True
+
+
+def _hash_entry(source: Union[ZipInfo, bytes, File], start_zip: Optional[ZipFile]) -> Tuple[bytes, int]:
+    """Hash the contents of a file to be packed, returning the digest and size."""
+    if isinstance(source, bytes):
+        return hashlib.sha256(source).digest(), len(source)
+    hasher = hashlib.sha256()
+    size = 0
+    if isinstance(source, ZipInfo):
+        assert start_zip is not None
+        f = start_zip.open(source)
+    else:
+        f = source.open_bin()
+    with f:
+        for chunk in iter(functools.partial(f.read, COPY_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+            size += len(chunk)
+    return hasher.digest(), size
+
+
+def _compress_entry(info: ZipInfo, source: Union[bytes, File], level: Optional[int]) -> bytes:
+    """Compress a file for a zip, filling in the CRC and sizes of the info."""
+    compressor = zipfile._get_compressor(info.compress_type, level)
+    if info.compress_type == ZIP_LZMA:
+        # Indicates the end of the stream is marked.
+        info.flag_bits |= 0x02
+    crc = size = 0
+    parts = []
+    with (io.BytesIO(source) if isinstance(source, bytes) else source.open_bin()) as f:
+        for chunk in iter(functools.partial(f.read, COPY_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            parts.append(compressor.compress(chunk))
+    parts.append(compressor.flush())
+    data = b''.join(parts)
+    info.CRC = crc
+    info.file_size = size
+    info.compress_size = len(data)
+    return data
+
+
 class PackList:
     """Represents a list of resources for a map."""
     def __init__(self, fsys: FileSystemChain):
@@ -148,6 +332,10 @@ class PackList:
         # one use is unknown, so all skins could be used.
         self.skinsets = {}  # type: Dict[str, Optional[Set[int]]]
 
+        # Dependencies of materials and models, from previous runs.
+        self._material_cache = {}  # type: Dict[str, _MaterialDeps]
+        self._model_cache = {}  # type: Dict[str, _ModelDeps]
+
     def __getitem__(self, path: str) -> PackFile:
         """Look up a packfile by filename."""
         return self._files[unify_path(path)]
@@ -746,6 +934,13 @@ class PackList:
         whitelist: Iterable[FileSystem]=(),
         blacklist: Iterable[FileSystem]=(),
         ignore_vpk: bool=True,
+        stream: bool=False,
+        compression: Union[int, Mapping[str, int]]=ZIP_STORED,
+        compress_level: Optional[int]=None,
+        max_workers: Optional[int]=None,
+        executor: Optional[Executor]=None,
+        dedup: bool=False,
+        reproducible: bool=False,
     ) -> None:
         """Pack all our files into the packfile in the BSP.
 
@@ -753,18 +948,42 @@ class PackList:
         Filesystems must be in the whitelist and not in the blacklist, if provided.
         If ignore_vpk is True, files in VPK won't be packed unless that system
         is in allow_filesys.
+
+        If stream is True, the packfile is instead built when the BSP is saved,
+        writing it directly into the file. Files already in the packfile are
+        copied without recompressing them, and others are read in chunks, so
+        the contents never need to be in memory all at once. The filesystem
+        must then remain accessible until the BSP is saved.
+
+        compression is either one of the zipfile compression types, or a
+        mapping from file extension to the type to use, with the '*' key
+        applying to other files. See COMPRESSION_POLICY_LZMA for an example.
+        Files are compressed on the executor, or a thread pool with max_workers
+        threads if not provided. They are always written in the same order.
+        Existing entries are only recompressed if the type differs. Note that
+        the engine is only able to read stored or LZMA compressed files.
+
+        If dedup is True, the contents of each file are hashed to find
+        duplicates, which are logged. Zip files can't share data between
+        entries, so these are still stored each time, but only compressed once.
+        If reproducible is True, files are sorted by name and timestamps are
+        fixed, so packing the same files always produces identical data.
         """
         # We need to rebuild the zipfile from scratch, so we can overwrite
         # old data if required.
+        pak_lump = bsp.lumps[BSP_LUMPS.PAKFILE]
+        open_pakfile = pak_lump.reader()
+
+        # This is a casefolded name -> (orig name, source) dict. The source
+        # is the ZipInfo in the existing zip, the data or the file to read.
+        packed_files = {}  # type: Dict[str, Tuple[str, Union[ZipInfo, bytes, File]]]
+        with open_pakfile() as pak_file:
+            # An empty lump isn't a valid zip.
+            if is_zipfile(pak_file):
+                with ZipFile(pak_file) as start_zip:
+                    for info in start_zip.infolist():
+                        packed_files[info.filename.casefold()] = (info.filename, info)
 
-        # First retrieve the data.
-        with bsp.packfile() as start_zip:
-            packed_files = {
-                info.filename.casefold(): (info.filename, start_zip.read(info))
-                for info in start_zip.infolist()
-            }  # type: Dict[str, Tuple[str, bytes]]
-
-        # The packed_files dict is a casefolded name -> (orig name, bytes) tuple.
         all_systems = {
             sys for sys, prefix in
             self.fsys.systems
@@ -808,96 +1027,409 @@ class PackList:
 
                 if self.fsys.get_system(sys_file) in allowed:
                     LOGGER.debug('ADD:  {}', fname)
-                    with sys_file.open_bin() as f:
-                        packed_files[fname.casefold()] = (fname, f.read())
+                    packed_files[fname.casefold()] = (fname, sys_file)
                 else:
                     LOGGER.debug('SKIP: {}', fname)
 
-        LOGGER.info('Compressing packfile...')
-        with io.BytesIO() as new_data:
-            with ZipFile(new_data, 'w') as new_zip:
-                for fname, data in packed_files.values():
-                    new_zip.writestr(fname, data)
-            bsp.lumps[BSP_LUMPS.PAKFILE].data = new_data.getvalue()
+        if reproducible:
+            entries = [packed_files[key] for key in sorted(packed_files)]
+            date_time = ZIP_EPOCH
+        else:
+            entries = list(packed_files.values())
+            date_time = time.localtime(time.time())[:6]
+        LOGGER.info('Packed files: \n{}', '\n'.join([fname for fname, source in entries]))
+        if isinstance(compression, int):
+            policy = {'*': compression}  # type: Mapping[str, int]
+        else:
+            policy = compression
+
+        def write_pakfile(file: BinaryIO) -> None:
+            """Build the packfile into the file."""
+            LOGGER.info('Writing packfile...')
+            pool = executor  # type: Optional[Executor]
+            own_pool = None  # type: Optional[ThreadPoolExecutor]
+            # Compressed entries are written in order once done, while the
+            # next ones are compressed.
+            pending = deque()  # type: Deque[Tuple[ZipInfo, Union[ZipInfo, bytes, File, Future[bytes], _Duplicate]]]
+            # (digest, compression) -> the first entry with that content.
+            digests = {}  # type: Dict[Tuple[bytes, int], Tuple[ZipInfo, Union[ZipInfo, bytes, File, Future[bytes]]]]
+            dup_count = dup_size = 0
+            try:
+                with contextlib.ExitStack() as stack:
+                    pak_file = stack.enter_context(open_pakfile())
+                    stack.enter_context(self.fsys)
+                    new_zip = stack.enter_context(ZipFile(file, 'w'))
+                    # Existing entries which need recompressing are read here,
+                    # since the file can't be shared between threads.
+                    if is_zipfile(pak_file):
+                        start_zip = stack.enter_context(ZipFile(pak_file))  # type: Optional[ZipFile]
+                    else:
+                        start_zip = None
+
+                    def write_entry(
+                        info: ZipInfo,
+                        source: Union[ZipInfo, bytes, File, 'Future[bytes]', _Duplicate],
+                    ) -> None:
+                        """Write an entry into the new zip."""
+                        if isinstance(source, _Duplicate):
+                            data = source.data.result()
+                            info.CRC = source.info.CRC
+                            info.file_size = source.info.file_size
+                            info.compress_size = source.info.compress_size
+                            info.flag_bits = source.info.flag_bits
+                            _write_raw_entry(new_zip, file, info, [data])
+                        elif isinstance(source, ZipInfo):
+                            _copy_zip_entry(pak_file, source, new_zip, file)
+                        elif isinstance(source, Future):
+                            _write_raw_entry(new_zip, file, info, [source.result()])
+                        elif isinstance(source, bytes):
+                            new_zip.writestr(info, source)
+                        else:
+                            with source.open_bin() as src, new_zip.open(info, 'w') as dest:
+                                shutil.copyfileobj(src, dest, COPY_CHUNK_SIZE)
+
+                    for fname, source in entries:
+                        ext = fname.rpartition('/')[2].rpartition('.')[2].casefold()
+                        info = ZipInfo(fname, date_time)
+                        info.compress_type = policy.get(ext, policy.get('*', ZIP_STORED))
+                        info.external_attr = 0o600 << 16
+                        if reproducible:
+                            # Otherwise this depends on the OS.
+                            info.create_system = 0
+
+                        if isinstance(source, ZipInfo):
+                            if source.compress_type != info.compress_type:
+                                assert start_zip is not None
+                                source = start_zip.read(source)
+                            elif reproducible:
+                                source = copy.copy(source)
+                                source.date_time = date_time
+                                source.create_system = 0
+
+                        if dedup:
+                            digest, size = _hash_entry(source, start_zip)
+                            try:
+                                first_info, first = digests[digest, info.compress_type]
+                            except KeyError:
+                                pass
+                            else:
+                                LOGGER.debug('DUP:  {} = {}', fname, first_info.filename)
+                                dup_count += 1
+                                dup_size += size
+                                if isinstance(first, Future):
+                                    pending.append((info, _Duplicate(first_info, first)))
+                                    continue
+
+                        if info.compress_type != ZIP_STORED and not isinstance(source, ZipInfo):
+                            if pool is None:
+                                # Only start threads once something needs compressing.
+                                pool = own_pool = ThreadPoolExecutor(max_workers)
+                            source = pool.submit(
+                                _compress_entry, info, source, compress_level,
+                            )
+                        if dedup:
+                            digests.setdefault((digest, info.compress_type), (info, source))
+                        pending.append((info, source))
+                        while len(pending) > COMPRESS_WINDOW:
+                            write_entry(*pending.popleft())
+                    while pending:
+                        write_entry(*pending.popleft())
+                if dup_count:
+                    LOGGER.info('{} packed files are duplicates, using {} bytes.', dup_count, dup_size)
+            finally:
+                for info, source in pending:
+                    if isinstance(source, Future):
+                        source.cancel()
+                    elif isinstance(source, _Duplicate):
+                        source.data.cancel()
+                if own_pool is not None:
+                    own_pool.shutdown()
+
+        if stream:
+            pak_lump.set_stream(write_pakfile)
+        else:
+            with io.BytesIO() as new_data:
+                write_pakfile(new_data)
+                pak_lump.data = new_data.getvalue()
 
-    def eval_dependencies(self) -> None:
+    def eval_dependencies(
+        self,
+        *,
+        max_workers: Optional[int]=None,
+        executor: Optional[Executor]=None,
+        cache_file: Union[str, os.PathLike, None]=None,
+    ) -> Dict[FileType, EvalStats]:
         """Add files to the list which need to also be packed.
 
-        This requires parsing through many files.
+        This requires parsing through many files. Each pass reads all the
+        files not yet analysed using the executor, or a thread pool with
+        max_workers threads if not provided. The dependencies are then added
+        in the original order, so the result doesn't depend on timing.
+        This returns the number of files analysed and the time taken for
+        each type.
+
+        If cache_file is provided, it should be a path to a file used to
+        cache the dependencies of models and materials for later use.
+        Entries are reused as long as the cache key of the file (and any
+        patch parents) is unchanged.
         """
-        # Run though repeatedly, until all are analysed.
-        todo = True
-        with self.fsys:
-            while todo:
-                todo = False
-
-                for file in list(self._files.values()):
-                    if file._analysed:
-                        continue
-                    file._analysed = True
-                    todo = True
-
-                    try:
-                        if file.type is FileType.MATERIAL:
-                            self._get_material_files(file)
-                        elif file.type is FileType.MODEL:
-                            self._get_model_files(file)
-                        elif file.type is FileType.TEXTURE:
-                            # Try packing the '.hdr.vtf' file as well if present.
-                            # But don't recurse!
-                            if not file.filename.endswith('.hdr.vtf'):
-                                hdr_tex = file.filename[:-3] + 'hdr.vtf'
-                                if hdr_tex in self.fsys:
-                                    self.pack_file(hdr_tex, optional=True)
-                    except Exception as exc:
-                        # Skip errors in the file format - means we can't find the dependencies.
-                        LOGGER.warning('Bad file "{}"!', file.filename, exc_info=exc)
-
-    def _get_model_files(self, file: PackFile) -> None:
-        """Find any needed files for a model."""
+        if cache_file is not None:
+            self._load_dependency_cache(cache_file)
+
+        stats = {}  # type: Dict[FileType, EvalStats]
+        own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers)
+        try:
+            with self.fsys:
+                # Files are only ever added to the end, so we only need to
+                # check the new ones each time.
+                done_count = 0
+                while done_count < len(self._files):
+                    todo = list(itertools.islice(
+                        self._files.values(), done_count, None,
+                    ))
+                    done_count += len(todo)
+                    futures = []
+                    for file in todo:
+                        if file._analysed:
+                            continue
+                        file._analysed = True
+                        futures.append((file, executor.submit(
+                            self._get_dependencies,
+                            file,
+                            self.skinsets.get(file.filename, None),
+                        )))
+                    for file, future in futures:
+                        depends, duration, cached = future.result()
+                        count, total, cache_hits = stats.get(file.type, (0, 0.0, 0))
+                        stats[file.type] = EvalStats(
+                            count + 1,
+                            total + duration,
+                            cache_hits + cached,
+                        )
+                        for filename, data_type, optional in depends:
+                            self.pack_file(filename, data_type, optional=optional)
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+        for data_type, (count, total, cache_hits) in stats.items():
+            LOGGER.debug(
+                'Analysed {} {} files in {:.3f}s ({} cached)',
+                count, data_type.name, total, cache_hits,
+            )
+
+        if cache_file is not None:
+            self._save_dependency_cache(cache_file)
+        return stats
+
+    def _load_dependency_cache(self, cache_file: Union[str, os.PathLike]) -> None:
+        """Read the dependency cache, if it's present and valid."""
+        # If the file doesn't exist or is corrupt, that's
+        # fine. We'll just parse the files the slow way.
+        try:
+            with open(cache_file) as f:
+                cache = Property.parse(f, os.fspath(cache_file))
+            if cache['version'] != DEPENDENCY_CACHE_VERSION:
+                raise LookupError
+        except (FileNotFoundError, KeyValError, LookupError):
+            return
+        try:
+            for prop in cache.find_children('Materials'):
+                self._material_cache[prop.real_name] = _MaterialDeps(
+                    prop.int('cache_key'),
+                    [
+                        (parent.real_name, int(parent.value))
+                        for parent in prop.find_children('parents')
+                    ],
+                    [
+                        (dep.value, FileType(dep.name))
+                        for dep in prop.find_children('files')
+                    ],
+                )
+            for prop in cache.find_children('Models'):
+                self._model_cache[prop.real_name] = _ModelDeps(
+                    prop.int('cache_key'),
+                    prop.int('phy_key'),
+                    prop.find_key('cdmaterials', []).as_array(),
+                    [
+                        skin.as_array()
+                        for skin in prop.find_children('skins')
+                    ],
+                    prop.find_key('includes', []).as_array(),
+                    prop.find_key('sounds', []).as_array(),
+                    prop.find_key('breaks', []).as_array(),
+                )
+        except (LookupError, ValueError):
+            LOGGER.warning('Dependency cache "{}" is corrupt!', cache_file)
+            self._material_cache.clear()
+            self._model_cache.clear()
+
+    def _save_dependency_cache(self, cache_file: Union[str, os.PathLike]) -> None:
+        """Write out the dependency cache, including entries not used this time."""
+        materials = Property('Materials', [])
+        for filename, mat_deps in sorted(self._material_cache.items()):
+            materials.append(Property(filename, [
+                Property('cache_key', str(mat_deps.key)),
+                Property('parents', [
+                    Property(parent, str(key))
+                    for parent, key in mat_deps.parents
+                ]),
+                Property('files', [
+                    Property(data_type.value, dep)
+                    for dep, data_type in mat_deps.depends
+                ]),
+            ]))
+        models = Property('Models', [])
+        for filename, mdl_deps in sorted(self._model_cache.items()):
+            models.append(Property(filename, [
+                Property('cache_key', str(mdl_deps.key)),
+                Property('phy_key', str(mdl_deps.phy_key)),
+                Property('cdmaterials', [
+                    Property('folder', folder)
+                    for folder in mdl_deps.cdmaterials
+                ]),
+                Property('skins', [
+                    Property('skin', [
+                        Property('tex', tex)
+                        for tex in skin
+                    ])
+                    for skin in mdl_deps.skins
+                ]),
+                Property('includes', [
+                    Property('mdl', mdl)
+                    for mdl in mdl_deps.includes
+                ]),
+                Property('sounds', [
+                    Property('snd', snd)
+                    for snd in mdl_deps.sounds
+                ]),
+                Property('breaks', [
+                    Property('mdl', mdl)
+                    for mdl in mdl_deps.breaks
+                ]),
+            ]))
+        with srctools.AtomicWriter(cache_file) as f:
+            for line in Property(None, [
+                Property('version', DEPENDENCY_CACHE_VERSION),
+                materials,
+                models,
+            ]).export():
+                f.write(line)
+
+    def _get_dependencies(
+        self,
+        file: PackFile,
+        skinset: Optional[Set[int]],
+    ) -> Tuple[List[_Dependency], float, bool]:
+        """Find the files a file requires, the time that took and if it was cached.
+
+        This is run in a worker thread, so it must not modify the packlist.
+        """
+        start = time.perf_counter()
+        depends = []  # type: List[_Dependency]
+        cached = False
+        try:
+            if file.type is FileType.MATERIAL:
+                cached = self._get_material_files(file, depends)
+            elif file.type is FileType.MODEL:
+                cached = self._get_model_files(file, skinset, depends)
+            elif file.type is FileType.TEXTURE:
+                # Try packing the '.hdr.vtf' file as well if present.
+                # But don't recurse!
+                if not file.filename.endswith('.hdr.vtf'):
+                    hdr_tex = file.filename[:-3] + 'hdr.vtf'
+                    if hdr_tex in self.fsys:
+                        depends.append((hdr_tex, FileType.GENERIC, True))
+        except Exception as exc:
+            # Skip errors in the file format - means we can't find the dependencies.
+            LOGGER.warning('Bad file "{}"!', file.filename, exc_info=exc)
+        return depends, time.perf_counter() - start, cached
+
+    def _get_model_files(
+        self,
+        file: PackFile,
+        skinset: Optional[Set[int]],
+        depends: List[_Dependency],
+    ) -> bool:
+        """Find any needed files for a model, returning if the cache was used."""
         filename, ext = os.path.splitext(file.filename)
 
         # Some of these are optional.
         for ext in MDL_EXTS:
             component = filename + ext
             if component in self.fsys:
-                self.pack_file(component)
+                depends.append((component, FileType.GENERIC, False))
 
+        cached = False
         if file.data is not None:
             # We need to add that file onto the system, so it's loaded.
-            virtual_system = VirtualFileSystem({
-                file.filename: file.data,
-            })
-            virtual_system.open_ref()
-            self.fsys.systems.insert(0, (virtual_system, ''))
-            try:
-                mdl = Model(self.fsys, self.fsys[file.filename])
-            finally:
-                self.fsys.systems.pop(0)
+            # Use a new chain, since others may be using ours.
+            fsys = FileSystemChain(
+                VirtualFileSystem({file.filename: file.data}),
+                self.fsys,
+            )
+            with fsys:
+                mdl_deps = _ModelDeps.from_model(Model(fsys, fsys[file.filename]), -1, -1)
         else:
             try:
-                mdl = Model(self.fsys, self.fsys[file.filename])
+                mdl_file = self.fsys[file.filename]
             except FileNotFoundError:
                 if not file.optional:
                     LOGGER.warning('Can\'t find model "{}"!', file.filename)
-                return
+                return False
+            key = mdl_file.cache_key()
+            # Breakable models are defined in the PHY.
+            try:
+                phy_key = self.fsys[filename + '.phy'].cache_key()
+            except FileNotFoundError:
+                phy_key = 0
+            mdl_deps = self._model_cache.get(file.filename)
+            if (
+                mdl_deps is not None and key != -1 and phy_key != -1
+                and mdl_deps.key == key and mdl_deps.phy_key == phy_key
+            ):
+                cached = True
+            else:
+                mdl_deps = _ModelDeps.from_model(Model(self.fsys, mdl_file), key, phy_key)
+                if key != -1 and phy_key != -1:
+                    self._model_cache[file.filename] = mdl_deps
 
-        for tex in mdl.iter_textures(self.skinsets.get(file.filename, None)):
-            self.pack_file(tex, FileType.MATERIAL, optional=file.optional)
+        for tex in mdl_deps.iter_textures(self.fsys, skinset):
+            depends.append((tex, FileType.MATERIAL, file.optional))
 
-        for mdl_file in mdl.included_models:
-            self.pack_file(mdl_file.filename, FileType.MODEL, optional=file.optional)
+        for mdl_name in mdl_deps.includes:
+            depends.append((mdl_name, FileType.MODEL, file.optional))
 
-        for snd in mdl.find_sounds():
-            self.pack_soundscript(snd)
+        for snd in mdl_deps.sounds:
+            depends.append((snd, FileType.GAME_SOUND, False))
 
-        for break_mdl in mdl.phys_keyvalues.find_all('break', 'model'):
-            self.pack_file(break_mdl.value, FileType.MODEL, optional=file.optional)
+        for break_mdl in mdl_deps.breaks:
+            depends.append((break_mdl, FileType.MODEL, file.optional))
+        return cached
 
-    def _get_material_files(self, file: PackFile) -> None:
-        """Find any needed files for a material."""
+    def _get_material_files(self, file: PackFile, depends: List[_Dependency]) -> bool:
+        """Find any needed files for a material, returning if the cache was used."""
+        if file.data is None:
+            try:
+                key = self.fsys[file.filename].cache_key()
+            except FileNotFoundError:
+                if not file.optional:
+                    LOGGER.warning('File "{}" does not exist!', file.filename)
+                return False
+            mat_deps = self._material_cache.get(file.filename)
+            if mat_deps is not None and key != -1 and mat_deps.key == key and all(
+                parent in self.fsys and self.fsys[parent].cache_key() == parent_key
+                for parent, parent_key in mat_deps.parents
+            ):
+                for dep, data_type in mat_deps.depends:
+                    depends.append((dep, data_type, file.optional))
+                return True
+        else:
+            key = -1
 
-        parents = []  # type: List[str]
+        parents = []  # type: List[File]
         try:
             if file.data is not None:
                 # Read directly from the data we have.
@@ -911,14 +1443,14 @@ class PackList:
         except FileNotFoundError:
             if not file.optional:
                 LOGGER.warning('File "{}" does not exist!', file.filename)
-            return
+            return False
         except TokenSyntaxError as exc:
             LOGGER.warning(
                 'File "{}" cannot be parsed:\n{}',
                 file.filename,
                 exc,
             )
-            return
+            return False
 
         try:
             # For 'patch' shaders, apply the originals.
@@ -929,10 +1461,11 @@ class PackList:
                 file.filename,
                 exc_info=True,
             )
-            return
+            return False
 
+        mat_files = []  # type: List[Tuple[str, FileType]]
         for vmt in parents:
-            self.pack_file(vmt, FileType.MATERIAL, optional=file.optional)
+            mat_files.append((vmt.path, FileType.MATERIAL))
 
         for param_name, param_type, param_value in mat:
             param_value = param_value.casefold()
@@ -940,10 +1473,18 @@ class PackList:
                 # Skip over reference to cubemaps, or realtime buffers.
                 if param_value == 'env_cubemap' or param_value.startswith('_rt_'):
                     continue
-                self.pack_file(param_value, FileType.TEXTURE, optional=file.optional)
+                mat_files.append((param_value, FileType.TEXTURE))
             # $bottommaterial for water brushes mainly.
             if param_type is VarType.MATERIAL:
-                self.pack_file(param_value, FileType.MATERIAL, optional=file.optional)
+                mat_files.append((param_value, FileType.MATERIAL))
+
+        for dep, data_type in mat_files:
+            depends.append((dep, data_type, file.optional))
+
+        parent_keys = [(vmt.path, vmt.cache_key()) for vmt in parents]
+        if key != -1 and all(parent_key != -1 for vmt, parent_key in parent_keys):
+            self._material_cache[file.filename] = _MaterialDeps(key, parent_keys, mat_files)
+        return False
 
 
 # noinspection PyProtectedMember
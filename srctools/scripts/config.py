@@ -6,6 +6,7 @@ from srctools.game import Game
 
 from srctools import Property, logger, AtomicWriter
 from srctools.filesys import FileSystemChain, FileSystem, RawFileSystem, VPKFileSystem
+from srctools.vpk import get_index_filename
 from srctools.props_config import Opt, Config, TYPE
 
 from srctools.scripts.plugin import Plugin
@@ -84,7 +85,9 @@ def parse(path: Path) -> Tuple[
 
     game = Game((folder / conf.get(str, 'gameinfo')).resolve())
 
-    fsys_chain = game.get_filesystem()
+    # Cache VPK directory indexes alongside the config.
+    index_folder = conf.path.with_name('srctools_vpk_index')
+    fsys_chain = game.get_filesystem(index_folder, conf.get(bool, 'index_search_paths'))
 
     blacklist = set()  # type: Set[FileSystem]
 
@@ -101,9 +104,16 @@ def parse(path: Path) -> Tuple[
         assert isinstance(prop.value, str)
 
         if prop.value.endswith('.vpk'):
-            fsys = VPKFileSystem(str((game_root / prop.value).resolve()))
+            vpk_path = (game_root / prop.value).resolve()
+            fsys = VPKFileSystem(
+                str(vpk_path),
+                index_folder / get_index_filename(vpk_path),
+            )
         else:
-            fsys = RawFileSystem(str((game_root / prop.value).resolve()))
+            fsys = RawFileSystem(
+                str((game_root / prop.value).resolve()),
+                index=conf.get(bool, 'index_search_paths'),
+            )
 
         if prop.name in ('prefix', 'priority'):
             fsys_chain.add_sys(fsys, priority=True)
@@ -161,6 +171,17 @@ OPTIONS = [
         'pack_vpk', False,
         """Prevent files in VPKs from being packed into the map.
     """),
+    Opt(
+        'pack_lzma', False,
+        """Compress packed files with LZMA, to reduce the size of the map.
+        Textures, models and sounds are left uncompressed. This is only
+        supported by newer engine branches.
+    """),
+    Opt(
+        'pack_dedup_report', False,
+        """Check packed files for duplicate contents, and log any found.
+        These are only compressed once.
+    """),
     Opt(
         'searchpaths', TYPE.RAW,
         """\
@@ -172,6 +193,12 @@ OPTIONS = [
         * "path" "vpk_path.vpk" adds the path to the end, so it is checked last.
         * "nopack" "folder/" prohibits files in this path from being packed, you'll need to use one of the others also to add the path.
     """),
+    Opt(
+        'index_search_paths', False,
+        """Cache the contents of search path folders, making file lookups
+        faster and case-insensitive. Folders are only rescanned once
+        modified, when the filesystem is reopened.
+    """),
     Opt(
         'studiomdl', 'bin/studiomdl.exe',
         """Set the path to StudioMDL so the compiler can generate props.
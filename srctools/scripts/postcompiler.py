@@ -4,6 +4,7 @@ import datetime
 import sys
 from logging import FileHandler
 from pathlib import Path
+from zipfile import ZIP_STORED
 
 from srctools import Property
 from srctools.logger import init_logging, Formatter
@@ -15,7 +16,7 @@ LOGGER = init_logging(Path(sys.argv[0]).with_name('postcompiler.log'))
 from srctools.fgd import FGD
 from srctools.bsp import BSP, BSP_LUMPS
 from srctools.bsp_transform import run_transformations
-from srctools.packlist import PackList
+from srctools.packlist import PackList, COMPRESSION_POLICY_LZMA
 from srctools.scripts import config
 from srctools.compiler import propcombine
 from typing import List
@@ -90,7 +91,8 @@ def main(argv: List[str]) -> None:
     LOGGER.info('Done! ({} sounds)', len(packlist.soundscripts))
 
     LOGGER.info('Reading BSP...')
-    bsp_file = BSP(path)
+    # Only the lumps we modify need to be loaded into memory.
+    bsp_file = BSP(path, lazy=True)
 
     LOGGER.info('Reading entities...')
     vmf = bsp_file.read_ent_data()
@@ -121,7 +123,7 @@ def main(argv: List[str]) -> None:
             LOGGER.warning('Set "use_comma_sep" in srctools.vdf.')
         use_comma_sep = False
 
-    run_transformations(vmf, fsys, packlist, bsp_file, game_info, studiomdl_loc)
+    run_transformations(vmf, fsys, packlist, bsp_file, game_info, studiomdl_loc, fgd)
 
     if studiomdl_loc is not None and args.propcombine:
         LOGGER.info('Combining props...')
@@ -139,6 +141,7 @@ def main(argv: List[str]) -> None:
             conf.get(int, 'propcombine_auto_range'),
             conf.get(int, 'propcombine_min_cluster'),
             debug_tint=args.showgroups,
+            cache_file=conf.path.with_name('srctools_propcombine.bin'),
         )
         LOGGER.info('Done!')
     else:  # Strip these if they're present.
@@ -153,15 +156,27 @@ def main(argv: List[str]) -> None:
 
         packlist.pack_from_bsp(bsp_file)
 
-        packlist.eval_dependencies()
-
-    packlist.pack_into_zip(bsp_file, blacklist=pack_blacklist, ignore_vpk=False)
+        packlist.eval_dependencies(
+            cache_file=conf.path.with_name('srctools_dependencies.vdf'),
+        )
 
-    with bsp_file.packfile() as pak_zip:
-        LOGGER.info('Packed files: \n{}'.format('\n'.join(pak_zip.namelist())))
+    # The packfile is built while the BSP is written, so it doesn't need to
+    # be held in memory.
+    packlist.pack_into_zip(
+        bsp_file,
+        blacklist=pack_blacklist,
+        ignore_vpk=False,
+        stream=True,
+        compression=COMPRESSION_POLICY_LZMA if conf.get(bool, 'pack_lzma') else ZIP_STORED,
+        dedup=conf.get(bool, 'pack_dedup_report'),
+        # So recompiling the same map produces the same BSP.
+        reproducible=True,
+    )
 
     LOGGER.info('Writing BSP...')
-    bsp_file.save()
+    # Only rewrite the lumps we changed.
+    bsp_file.save(incremental=True)
+    bsp_file.close()
 
     LOGGER.info("srctools VRAD hook finished!")
 
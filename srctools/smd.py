@@ -1,25 +1,34 @@
 """Parses SMD model/animation data."""
 import os
 import re
+import pickle
+import hashlib
 import warnings
+from array import array
 from copy import deepcopy
+from itertools import islice
 from operator import itemgetter
 
 import math
 from typing import (
     List, Optional, Dict, Tuple, Iterator, Iterable, Union,
-    BinaryIO,
+    BinaryIO, Callable, TypeVar,
     Any,
 )
 
-from srctools import Vec
+from srctools import Vec, AtomicWriter
 
 __all__ = [
-    'Mesh', 'Triangle', 'Vertex', 'Bone', 'BoneFrame', 'ParseError',
+    'Mesh', 'ArrayMesh', 'Triangle', 'Vertex', 'Bone', 'BoneFrame', 'ParseError',
 ]
 
 from srctools.vec import to_matrix, Angle, Matrix
 
+TriT = TypeVar('TriT')
+
+# Increment if ArrayMesh changes, to discard cached meshes.
+CACHE_VERSION = 2
+
 
 class Bone:
     """Represents a single bone."""
@@ -273,6 +282,27 @@ class Mesh:
         It is parsed in binary, since non-ASCII characters are not
         permitted in SMDs.
         """
+        bones, anim, tri = Mesh._parse_smd_sections(file, Mesh._parse_smd_tri)
+        if tri is None:
+            tri = []
+
+        return Mesh({
+            bone.name: bone
+            for bone in
+            bones.values()
+        }, anim, tri)
+
+    @staticmethod
+    def _parse_smd_sections(
+        file: Iterable[bytes],
+        parse_tri: Callable[[Iterator[Tuple[int, bytes]], Dict[int, Bone]], TriT],
+    ) -> Tuple[Dict[int, Bone], Dict[int, List[BoneFrame]], Optional[TriT]]:
+        """Parse the sections of a SMD file.
+
+        parse_tri() is called to parse the triangles section. This returns
+        the bones, animation and the result of parse_tri(), or None if the file
+        has no triangles.
+        """
         file_iter = _clean_file(file)
 
         bones = None
@@ -315,7 +345,7 @@ class Mesh:
                         line_num,
                         'Triangles section before bones section!'
                     )
-                tri = Mesh._parse_smd_tri(file_iter, bones)
+                tri = parse_tri(file_iter, bones)
 
         if bones is None:
             raise ParseError(line_num, 'No bone section!')
@@ -323,14 +353,7 @@ class Mesh:
         if anim is None:
             raise ParseError(line_num, 'No animation section!')
 
-        if tri is None:
-            tri = []
-
-        return Mesh({
-            bone.name: bone
-            for bone in
-            bones.values()
-        }, anim, tri)
+        return bones, anim, tri
 
     @staticmethod
     def _parse_smd_bones(file_iter: Iterator[Tuple[int, bytes]]) -> Dict[int, Bone]:
@@ -476,12 +499,46 @@ class Mesh:
 
     def export(self, file: BinaryIO):
         """Write out the SMD to the given file."""
+        bone_indexes = self._export_skeleton(self.bones, self.animation, file)
+        if self.triangles:
+            file.write(b'triangles\n')
+            for tri in self.triangles:
+                file.write(tri.mat.encode('ascii') + b'\n')
+                for vert in tri:
+                    # Add the last link as the "main" one, which recieves
+                    # the amount not set by the other weights.
+                    assert len(vert.links) > 0
+                    file.write(
+                        b'%i\t%.6f %.6f %.6f\t'  # bone index, position XYZ
+                        b'%.6f %.6f %.6f\t'  # Normal XYZ
+                        b'%.6f %.6f %i' % (  # UV, weight count.
+                            bone_indexes[vert.links[-1][0]],
+                            vert.pos.x, vert.pos.y, vert.pos.z,
+                            vert.norm.x, vert.norm.y, vert.norm.z,
+                            vert.tex_u, vert.tex_v, (len(vert.links) - 1)
+                        )
+                    )
+                    for bone, weight in vert.links[:-1]:
+                        file.write(b' %i %.6f' % (bone_indexes[bone], weight))
+                    file.write(b'\n')
+            file.write(b'end\n')
+
+    @staticmethod
+    def _export_skeleton(
+        bones: Dict[str, Bone],
+        animation: Dict[int, List[BoneFrame]],
+        file: BinaryIO,
+    ) -> Dict[Bone, int]:
+        """Write out the nodes and skeleton sections of a SMD.
+
+        This returns the index assigned to each bone.
+        """
         file.write(b"version 1\nnodes\n")
 
         # Deconstruct the tree into the original indexes.
         bone_indexes = {}  # type: Dict[Bone, int]
         next_ind = 0
-        todo = set(self.bones.values())
+        todo = set(bones.values())
         while todo:
             for bone in todo:
                 if not bone.parent or bone.parent in bone_indexes:
@@ -503,7 +560,7 @@ class Mesh:
                 raise ValueError('Loop in bone parenting!')
 
         file.write(b'end\nskeleton\n')
-        for time, frame in sorted(self.animation.items(), key=itemgetter(0)):
+        for time, frame in sorted(animation.items(), key=itemgetter(0)):
             file.write(b'time %i\n' % time)
             for bone_pose in frame:  # type: BoneFrame
                 x, y, z = bone_pose.position
@@ -514,28 +571,7 @@ class Mesh:
                     pit, yaw, rol,
                 ))
         file.write(b'end\n')
-        if self.triangles:
-            file.write(b'triangles\n')
-            for tri in self.triangles:
-                file.write(tri.mat.encode('ascii') + b'\n')
-                for vert in tri:
-                    # Add the last link as the "main" one, which recieves
-                    # the amount not set by the other weights.
-                    assert len(vert.links) > 0
-                    file.write(
-                        b'%i\t%.6f %.6f %.6f\t'  # bone index, position XYZ
-                        b'%.6f %.6f %.6f\t'  # Normal XYZ
-                        b'%.6f %.6f %i' % (  # UV, weight count.
-                            bone_indexes[vert.links[-1][0]],
-                            vert.pos.x, vert.pos.y, vert.pos.z,
-                            vert.norm.x, vert.norm.y, vert.norm.z,
-                            vert.tex_u, vert.tex_v, (len(vert.links) - 1)
-                        )
-                    )
-                    for bone, weight in vert.links[:-1]:
-                        file.write(b' %i %.6f' % (bone_indexes[bone], weight))
-                    file.write(b'\n')
-            file.write(b'end\n')
+        return bone_indexes
 
     def append_model(
         self,
@@ -663,3 +699,554 @@ class Mesh:
             ])
             mesh.triangles.append(tri)
         return mesh
+
+
+def _rotate_coords(
+    coords: 'array[float]',
+    matrix: Matrix,
+    offset: Tuple[float, float, float]=(0.0, 0.0, 0.0),
+    scale: float=1.0,
+) -> 'array[float]':
+    """Scale, rotate then offset each XYZ point in a flat array.
+
+    This performs the same operations as Vec.localise(), so the results
+    are identical.
+    """
+    xs = coords[0::3]
+    ys = coords[1::3]
+    zs = coords[2::3]
+    if scale != 1.0:
+        xs = [x * scale for x in xs]
+        ys = [y * scale for y in ys]
+        zs = [z * scale for z in zs]
+    aa, ab, ac = matrix[0, 0], matrix[0, 1], matrix[0, 2]
+    ba, bb, bc = matrix[1, 0], matrix[1, 1], matrix[1, 2]
+    ca, cb, cc = matrix[2, 0], matrix[2, 1], matrix[2, 2]
+    off_x, off_y, off_z = offset
+
+    result = array('d', coords)
+    result[0::3] = array('d', [(x * aa) + (y * ba) + (z * ca) for x, y, z in zip(xs, ys, zs)])
+    result[1::3] = array('d', [(x * ab) + (y * bb) + (z * cb) for x, y, z in zip(xs, ys, zs)])
+    result[2::3] = array('d', [(x * ac) + (y * bc) + (z * cc) for x, y, z in zip(xs, ys, zs)])
+    # Skip when zero, so -0.0 is preserved like Vec does.
+    if off_x:
+        result[0::3] = array('d', [x + off_x for x in result[0::3]])
+    if off_y:
+        result[1::3] = array('d', [y + off_y for y in result[1::3]])
+    if off_z:
+        result[2::3] = array('d', [z + off_z for z in result[2::3]])
+    return result
+
+
+class ArrayMesh:
+    """A compact version of Mesh, storing triangles in flat arrays.
+
+    This avoids creating objects for every vertex, and allows transforming
+    the entire mesh at once. Use from_mesh() and to_mesh() to convert
+    to and from the regular object form.
+
+    For each vertex, the position and normal are stored as XYZ triples,
+    and UVs as pairs. Each triangle has an index into the list of materials.
+    The bone weights for vertex i are stored in link_bones/link_weights, from
+    link_offsets[i] up to link_offsets[i+1]. Bones are indexes into bone_list.
+    """
+    def __init__(
+        self,
+        bones: Dict[str, Bone],
+        animation: Dict[int, List[BoneFrame]],
+    ) -> None:
+        self.bones = bones
+        self.animation = animation
+        self.bone_list: List[Bone] = list(bones.values())
+        self.materials: List[str] = []
+        self.tri_mats = array('I')
+        self.positions = array('d')
+        self.normals = array('d')
+        self.uvs = array('d')
+        self.link_offsets = array('I', [0])
+        self.link_bones = array('I')
+        self.link_weights = array('d')
+
+    def __len__(self) -> int:
+        """Return the number of triangles."""
+        return len(self.tri_mats)
+
+    def __repr__(self) -> str:
+        return '<ArrayMesh, {} bones, {} triangles>'.format(len(self.bones), len(self.tri_mats))
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Store the bones and animation as plain values.
+
+        The compiled Angle class can't be pickled, so frames are stored as
+        tuples of floats. Bones are replaced by indexes into a list of
+        (name, parent index) pairs.
+        """
+        all_bones: List[Bone] = []
+        # Bones compare by name, so use the identity instead.
+        bone_inds: Dict[int, int] = {}
+
+        def bone_ind(bone: Bone) -> int:
+            """Find or assign the index for a bone."""
+            try:
+                return bone_inds[id(bone)]
+            except KeyError:
+                bone_inds[id(bone)] = ind = len(all_bones)
+                all_bones.append(bone)
+                return ind
+
+        # bone_list must be first, so it can be sliced back out.
+        for bone in self.bone_list:
+            bone_ind(bone)
+        state = self.__dict__.copy()
+        state['bones'] = [(name, bone_ind(bone)) for name, bone in self.bones.items()]
+        state['bone_list'] = len(self.bone_list)
+        state['animation'] = {
+            frame_num: [
+                (
+                    bone_ind(frame.bone),
+                    frame.position.x, frame.position.y, frame.position.z,
+                    frame.rotation.pitch, frame.rotation.yaw, frame.rotation.roll,
+                )
+                for frame in frames
+            ]
+            for frame_num, frames in self.animation.items()
+        }
+        # Parents may add more bones while we iterate.
+        bone_parents = []
+        for bone in all_bones:
+            bone_parents.append((
+                bone.name,
+                -1 if bone.parent is None else bone_ind(bone.parent),
+            ))
+        state['all_bones'] = bone_parents
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        """Rebuild the bones and animation."""
+        state = state.copy()
+        bone_parents = state.pop('all_bones')
+        all_bones = [Bone(name, None) for name, parent in bone_parents]
+        for bone, (name, parent) in zip(all_bones, bone_parents):
+            if parent >= 0:
+                bone.parent = all_bones[parent]
+        self.__dict__.update(state)
+        self.bones = {name: all_bones[ind] for name, ind in state['bones']}
+        self.bone_list = all_bones[:state['bone_list']]
+        self.animation = {
+            frame_num: [
+                BoneFrame(all_bones[ind], Vec(x, y, z), Angle(pitch, yaw, roll))
+                for ind, x, y, z, pitch, yaw, roll in frames
+            ]
+            for frame_num, frames in state['animation'].items()
+        }
+
+    @classmethod
+    def blank(cls, root_name: str) -> 'ArrayMesh':
+        """Create an empty mesh, with a single root bone."""
+        mesh = Mesh.blank(root_name)
+        return cls(mesh.bones, mesh.animation)
+
+    @classmethod
+    def from_mesh(cls, mesh: Mesh) -> 'ArrayMesh':
+        """Convert a regular mesh into the array form.
+
+        The bones and animation are shared with the original mesh.
+        """
+        result = cls(mesh.bones, mesh.animation)
+        mat_inds: Dict[str, int] = {}
+        bone_inds = {bone: ind for ind, bone in enumerate(result.bone_list)}
+
+        tri_mats = []
+        positions = []
+        normals = []
+        uvs = []
+        link_offsets = []
+        link_bones = []
+        link_weights = []
+        for tri in mesh.triangles:
+            try:
+                tri_mats.append(mat_inds[tri.mat])
+            except KeyError:
+                mat_inds[tri.mat] = len(result.materials)
+                tri_mats.append(len(result.materials))
+                result.materials.append(tri.mat)
+            for vert in tri:
+                positions += (vert.pos.x, vert.pos.y, vert.pos.z)
+                normals += (vert.norm.x, vert.norm.y, vert.norm.z)
+                uvs += (vert.tex_u, vert.tex_v)
+                for bone, weight in vert.links:
+                    try:
+                        link_bones.append(bone_inds[bone])
+                    except KeyError:
+                        # Not in the bone dict, add it anyway.
+                        bone_inds[bone] = len(result.bone_list)
+                        link_bones.append(len(result.bone_list))
+                        result.bone_list.append(bone)
+                    link_weights.append(weight)
+                link_offsets.append(len(link_bones))
+
+        result.tri_mats.extend(tri_mats)
+        result.positions.extend(positions)
+        result.normals.extend(normals)
+        result.uvs.extend(uvs)
+        result.link_offsets.extend(link_offsets)
+        result.link_bones.extend(link_bones)
+        result.link_weights.extend(link_weights)
+        return result
+
+    @classmethod
+    def parse_smd(cls, file: Iterable[bytes]) -> 'ArrayMesh':
+        """Parse a SMD file directly into the array form.
+
+        This is equivalent to ArrayMesh.from_mesh(Mesh.parse_smd(file)),
+        but avoids constructing objects for every vertex.
+        """
+        def parse_tri(file_iter: Iterator[Tuple[int, bytes]], bones: Dict[int, Bone]) -> 'ArrayMesh':
+            """Create the mesh when the triangles are found."""
+            mesh = cls({
+                bone.name: bone
+                for bone in
+                bones.values()
+            }, {})
+            mesh._parse_smd_tri(file_iter, bones)
+            return mesh
+
+        bones, anim, mesh = Mesh._parse_smd_sections(file, parse_tri)
+        if mesh is None:
+            mesh = cls({
+                bone.name: bone
+                for bone in
+                bones.values()
+            }, anim)
+        else:
+            # The skeleton may come after the triangles.
+            mesh.animation = anim
+        return mesh
+
+    @classmethod
+    def parse_file(
+        cls,
+        filename: Union[str, 'os.PathLike[str]'],
+        cache_folder: Union[str, 'os.PathLike[str]', None]=None,
+    ) -> 'ArrayMesh':
+        """Parse a SMD file from disk.
+
+        If cache_folder is provided, the parsed mesh is saved there. Later calls
+        reuse that if the file's modification time and size are unchanged.
+        """
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        key = (CACHE_VERSION, filename, stat.st_mtime_ns, stat.st_size)
+        if cache_folder is None:
+            with open(filename, 'rb') as f:
+                return cls.parse_smd(f)
+
+        cache_file = os.path.join(
+            cache_folder,
+            hashlib.sha1(filename.encode('utf8')).hexdigest() + '.bin',
+        )
+        try:
+            with open(cache_file, 'rb') as f:
+                cache_key, mesh = pickle.load(f)
+            if cache_key == key and isinstance(mesh, cls):
+                return mesh
+        except Exception:
+            # Missing or invalid, parse again.
+            pass
+
+        with open(filename, 'rb') as f:
+            mesh = cls.parse_smd(f)
+        try:
+            os.makedirs(cache_folder, exist_ok=True)
+            with AtomicWriter(cache_file, is_bytes=True) as f:
+                pickle.dump((key, mesh), f, pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass
+        return mesh
+
+    def _parse_smd_tri(self, file_iter: Iterator[Tuple[int, bytes]], bones: Dict[int, Bone]) -> None:
+        """Parse the 'triangles' section of SMDs.
+
+        The numeric values are collected, then converted all at once.
+        """
+        bone_pos = {bone: ind for ind, bone in enumerate(self.bone_list)}
+        # Map SMD bone indexes to our bone list.
+        bone_inds = {smd_ind: bone_pos[bone] for smd_ind, bone in bones.items()}
+        mat_inds = {mat: ind for ind, mat in enumerate(self.materials)}
+
+        tri_mats = []
+        values = []  # Position, normal and UV for each vertex, unparsed.
+        line_nums = []
+        link_offsets = []
+        link_bones = []
+        link_weights = []
+
+        for line_num, line in file_iter:
+            if line == b'end':
+                break
+            try:
+                mat_name = line.decode('ascii')
+            except UnicodeDecodeError as exc:
+                raise ParseError(
+                    line_num,
+                    'Non-ASCII material: {} at position {} - {}',
+                    exc.reason,
+                    exc.start
+                ) from None
+
+            mat_name = os.path.basename(mat_name.rstrip('\\/ \t\b\n\r'))
+            try:
+                tri_mats.append(mat_inds[mat_name])
+            except KeyError:
+                mat_inds[mat_name] = len(self.materials)
+                tri_mats.append(len(self.materials))
+                self.materials.append(mat_name)
+
+            # Grab the three lines.
+            for i in range(3):
+                try:
+                    line_num, line = next(file_iter)
+                except StopIteration:
+                    raise ParseError('end', 'Incomplete triangles!')
+                split = line.split()
+                if len(split) < 9:
+                    raise ParseError(line_num, 'Not enough values!')
+                values += split[1:9]
+                line_nums.append(line_num)
+                try:
+                    parent = bone_inds[int(split[0])]
+                except KeyError:
+                    raise ParseError(line_num, 'Invalid bone {}!', int(split[0]))
+
+                links_raw = split[9:]
+                if not links_raw or links_raw == [b'0']:
+                    link_bones.append(parent)
+                    link_weights.append(1.0)
+                else:
+                    link_count = int(links_raw[0])
+
+                    if (link_count * 2 + 1) != len(links_raw):
+                        raise ParseError(line_num, 'Extra weight number: {}', links_raw)
+
+                    weights = []
+                    for off in range(1, len(links_raw), 2):
+                        try:
+                            link_bones.append(bone_inds[int(links_raw[off])])
+                        except KeyError:
+                            raise ParseError(line_num, 'Unknown bone {}!', links_raw[off])
+                        weights.append(float(links_raw[off+1]))
+                    link_weights += weights
+                    remainder = 1.0 - math.fsum(weights)
+                    if remainder:
+                        link_bones.append(parent)
+                        link_weights.append(remainder)
+                link_offsets.append(len(self.link_bones) + len(link_bones))
+        else:
+            raise ParseError('end', 'No end to triangles section!')
+
+        try:
+            floats = array('d', map(float, values))
+        except ValueError:
+            # Locate the invalid value, to produce the right error.
+            for vert_ind, line_num in enumerate(line_nums):
+                vert = values[8 * vert_ind: 8 * vert_ind + 8]
+                try:
+                    [float(x) for x in vert[:6]]
+                except ValueError:
+                    raise ParseError(line_num, 'Invalid normal or position!') from None
+                try:
+                    [float(x) for x in vert[6:]]
+                except ValueError:
+                    raise ParseError(line_num, 'Invalid texture UV!') from None
+            raise
+
+        vert_count = len(line_nums)
+        positions = array('d', bytes(8 * 3 * vert_count))
+        normals = array('d', bytes(8 * 3 * vert_count))
+        uvs = array('d', bytes(8 * 2 * vert_count))
+        for axis in range(3):
+            positions[axis::3] = floats[axis::8]
+            normals[axis::3] = floats[3 + axis::8]
+        uvs[0::2] = floats[6::8]
+        uvs[1::2] = floats[7::8]
+
+        self.tri_mats.extend(array('I', tri_mats))
+        self.positions.extend(positions)
+        self.normals.extend(normals)
+        self.uvs.extend(uvs)
+        self.link_offsets.extend(array('I', link_offsets))
+        self.link_bones.extend(array('I', link_bones))
+        self.link_weights.extend(link_weights)
+
+    def to_mesh(self) -> Mesh:
+        """Convert back to a regular mesh.
+
+        The bones and animation are shared with this mesh.
+        """
+        triangles = []
+        bone_list = self.bone_list
+        materials = self.materials
+        pos = self.positions
+        norm = self.normals
+        uvs = self.uvs
+        offsets = self.link_offsets
+        link_bones = self.link_bones
+        link_weights = self.link_weights
+
+        for tri_ind, mat_ind in enumerate(self.tri_mats):
+            verts = []
+            for vert_ind in range(3 * tri_ind, 3 * tri_ind + 3):
+                links = [
+                    (bone_list[link_bones[i]], link_weights[i])
+                    for i in range(offsets[vert_ind], offsets[vert_ind + 1])
+                ]
+                verts.append(Vertex(
+                    Vec(pos[3 * vert_ind], pos[3 * vert_ind + 1], pos[3 * vert_ind + 2]),
+                    Vec(norm[3 * vert_ind], norm[3 * vert_ind + 1], norm[3 * vert_ind + 2]),
+                    uvs[2 * vert_ind], uvs[2 * vert_ind + 1],
+                    links,
+                ))
+            triangles.append(Triangle(materials[mat_ind], *verts))
+        return Mesh(self.bones, self.animation, triangles)
+
+    def export(self, file: BinaryIO) -> None:
+        """Write out the SMD to the given file.
+
+        This produces the same result as self.to_mesh().export(file).
+        """
+        bone_indexes = Mesh._export_skeleton(self.bones, self.animation, file)
+        if not self.tri_mats:
+            return
+        # Only bones which are used need to be in the skeleton.
+        export_inds = [bone_indexes.get(bone, -1) for bone in self.bone_list]
+        for ind in set(self.link_bones):
+            if export_inds[ind] == -1:
+                raise KeyError(self.bone_list[ind])
+
+        mat_names = [mat.encode('ascii') + b'\n' for mat in self.materials]
+        pos = self.positions
+        norm = self.normals
+        offsets = self.link_offsets
+        link_bones = self.link_bones
+        link_weights = self.link_weights
+        verts = zip(
+            pos[0::3], pos[1::3], pos[2::3],
+            norm[0::3], norm[1::3], norm[2::3],
+            self.uvs[0::2], self.uvs[1::2],
+            offsets, islice(offsets, 1, None),
+        )
+
+        vert_lines = []
+        for x, y, z, nx, ny, nz, u, v, start, end in verts:
+            # The last link is the "main" one, which recieves
+            # the amount not set by the other weights.
+            assert end > start
+            line = (
+                b'%i\t%.6f %.6f %.6f\t'  # bone index, position XYZ
+                b'%.6f %.6f %.6f\t'  # Normal XYZ
+                b'%.6f %.6f %i' % (  # UV, weight count.
+                    export_inds[link_bones[end - 1]],
+                    x, y, z,
+                    nx, ny, nz,
+                    u, v, end - start - 1,
+                )
+            )
+            if end - start > 1:
+                line += b''.join([
+                    b' %i %.6f' % (export_inds[link_bones[i]], link_weights[i])
+                    for i in range(start, end - 1)
+                ])
+            vert_lines.append(line)
+
+        lines = [b'triangles\n']
+        for tri_ind, mat_ind in enumerate(self.tri_mats):
+            lines.append(mat_names[mat_ind])
+            lines.append(b'\n'.join(vert_lines[3 * tri_ind: 3 * tri_ind + 3]))
+            lines.append(b'\n')
+        lines.append(b'end\n')
+        file.write(b''.join(lines))
+
+    def copy(self) -> 'ArrayMesh':
+        """Duplicate the mesh. The bones and animation are shared."""
+        mesh = ArrayMesh(self.bones, self.animation)
+        mesh.bone_list = self.bone_list.copy()
+        mesh.materials = self.materials.copy()
+        mesh.tri_mats = array('I', self.tri_mats)
+        mesh.positions = array('d', self.positions)
+        mesh.normals = array('d', self.normals)
+        mesh.uvs = array('d', self.uvs)
+        mesh.link_offsets = array('I', self.link_offsets)
+        mesh.link_bones = array('I', self.link_bones)
+        mesh.link_weights = array('d', self.link_weights)
+        return mesh
+
+    __copy__ = copy
+
+    def rename_materials(self, mapping: Dict[str, str]) -> None:
+        """Replace materials used by the mesh, like for applying a skin."""
+        self.materials = [mapping.get(mat, mat) for mat in self.materials]
+
+    def transform(
+        self,
+        rotation: Union[Angle, Matrix, Vec, None]=None,
+        offset: Vec=(0.0, 0.0, 0.0),
+        scale: float=1.0,
+    ) -> None:
+        """Scale, rotate and then offset all the geometry in place."""
+        matrix = to_matrix(rotation)
+        self.positions = _rotate_coords(self.positions, matrix, offset, scale)
+        self.normals = _rotate_coords(self.normals, matrix)
+
+    def bbox(self) -> Tuple[Vec, Vec]:
+        """Return the bounding box of all the geometry."""
+        if not self.positions:
+            raise ValueError('Empty mesh!')
+        pos = self.positions
+        return (
+            Vec(min(pos[0::3]), min(pos[1::3]), min(pos[2::3])),
+            Vec(max(pos[0::3]), max(pos[1::3]), max(pos[2::3])),
+        )
+
+    def append_model(
+        self,
+        mdl: 'ArrayMesh',
+        rotation: Union[Angle, Matrix, Vec, None]=None,
+        offset: Vec=(0.0, 0.0, 0.0),
+        scale: float=1.0,
+    ) -> None:
+        """Append another model's geometry onto this one.
+
+        All geometry is attached to the root bone, like Mesh.append_model().
+        """
+        if not mdl.tri_mats:
+            # Nothing to add.
+            return
+
+        for root_ind, bone in enumerate(self.bone_list):
+            if bone.parent is None:
+                break
+        else:
+            raise ValueError('No root bone?')
+
+        matrix = to_matrix(rotation)
+
+        mat_inds = {mat: ind for ind, mat in enumerate(self.materials)}
+        remap = []
+        for mat in mdl.materials:
+            try:
+                remap.append(mat_inds[mat])
+            except KeyError:
+                mat_inds[mat] = len(self.materials)
+                remap.append(len(self.materials))
+                self.materials.append(mat)
+        self.tri_mats.extend(array('I', [remap[ind] for ind in mdl.tri_mats]))
+
+        self.positions.extend(_rotate_coords(mdl.positions, matrix, offset, scale))
+        self.normals.extend(_rotate_coords(mdl.normals, matrix))
+        self.uvs.extend(mdl.uvs)
+
+        vert_count = len(mdl.tri_mats) * 3
+        start = self.link_offsets[-1]
+        self.link_offsets.extend(range(start + 1, start + vert_count + 1))
+        self.link_bones.extend(array('I', [root_ind]) * vert_count)
+        self.link_weights.extend(array('d', [1.0]) * vert_count)
@@ -0,0 +1,21 @@
+"""Fixtures shared between test modules."""
+import shutil
+from pathlib import Path
+
+import pytest
+
+import srctools.test
+
+try:
+    from importlib.resources import path as import_file_path
+except ImportError:
+    from importlib_resources import path as import_file_path
+
+
+@pytest.fixture
+def bsp_path(tmp_path: Path) -> Path:
+    """Copy the sample BSP to a temporary location, so it can be modified."""
+    dest = tmp_path / 'rot_main.bsp'
+    with import_file_path(srctools.test, 'rot_main.bsp') as src_path:
+        shutil.copyfile(src_path, dest)
+    return dest
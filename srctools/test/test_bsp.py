@@ -0,0 +1,284 @@
+"""Test the BSP parser."""
+from pathlib import Path
+
+import pytest
+
+from srctools import Vec, bsp as bsp_mod
+from srctools.bsp import BSP, BSP_LUMPS, StaticProp, StaticPropFlags
+from srctools.vmf import VMF, Output
+
+
+if bsp_mod._cy_parse_ent_data is bsp_mod._py_parse_ent_data:
+    ent_codecs = [(bsp_mod._py_parse_ent_data, bsp_mod._py_build_ent_data)]
+    codec_names = ['Python']
+else:
+    ent_codecs = [
+        (bsp_mod._py_parse_ent_data, bsp_mod._py_build_ent_data),
+        (bsp_mod._cy_parse_ent_data, bsp_mod._cy_build_ent_data),
+    ]
+    codec_names = ['Python', 'Cython']
+
+
+@pytest.fixture(params=ent_codecs, ids=codec_names)
+def ent_codec(request):
+    """Run the test for the Python and Cython entity lump parsers."""
+    orig_parse = bsp_mod._parse_ent_data
+    orig_build = bsp_mod._build_ent_data
+    try:
+        bsp_mod._parse_ent_data, bsp_mod._build_ent_data = request.param
+        yield request.param
+    finally:
+        bsp_mod._parse_ent_data = orig_parse
+        bsp_mod._build_ent_data = orig_build
+
+
+def test_lazy_matches_eager(bsp_path: Path) -> None:
+    """Lazily reading a BSP should produce identical lump data."""
+    eager = BSP(bsp_path)
+    with BSP(bsp_path, lazy=True) as lazy:
+        assert lazy.version == eager.version
+        assert lazy.map_revision == eager.map_revision
+        for lump_id, lump in eager.lumps.items():
+            assert lazy.lumps[lump_id].data == lump.data, lump_id
+        assert list(lazy.game_lumps) == list(eager.game_lumps)
+        for lump_id, game_lump in eager.game_lumps.items():
+            assert lazy.game_lumps[lump_id].data == game_lump.data, lump_id
+
+
+def test_lazy_unread_after_close(bsp_path: Path) -> None:
+    """Lumps which were not read are unavailable after closing."""
+    bsp = BSP(bsp_path, lazy=True)
+    ents = bsp.lumps[BSP_LUMPS.ENTITIES].data
+    bsp.close()
+    # Already read, so still accessible.
+    assert bsp.lumps[BSP_LUMPS.ENTITIES].data == ents
+    with pytest.raises(ValueError):
+        bsp.lumps[BSP_LUMPS.PLANES].data
+
+
+@pytest.mark.parametrize('lazy', [False, True], ids=['eager', 'lazy'])
+def test_save_roundtrip(bsp_path: Path, tmp_path: Path, lazy: bool) -> None:
+    """Saving to a new file, then overwriting the original file."""
+    bsp = BSP(bsp_path, lazy=lazy)
+    vmf = bsp.read_ent_data()
+    vmf.spawn['message'] = 'Modified map'
+    new_ents = bsp.write_ent_data(vmf)
+    bsp.lumps[BSP_LUMPS.ENTITIES].data = new_ents
+
+    copy_path = tmp_path / 'copy.bsp'
+    bsp.save(copy_path)
+    bsp.save()  # And overwrite ourselves.
+
+    for filename in [copy_path, bsp_path]:
+        reloaded = BSP(filename)
+        assert reloaded.lumps[BSP_LUMPS.ENTITIES].data == new_ents
+        for lump_id, lump in reloaded.lumps.items():
+            assert bsp.lumps[lump_id].data == lump.data, lump_id
+        for lump_id, game_lump in reloaded.game_lumps.items():
+            assert bsp.game_lumps[lump_id].data == game_lump.data, lump_id
+    bsp.close()
+
+
+@pytest.mark.parametrize('lazy', [False, True], ids=['eager', 'lazy'])
+def test_save_incremental(bsp_path: Path, lazy: bool) -> None:
+    """Incremental saves should produce the same data as full saves."""
+    with BSP(bsp_path, lazy=lazy) as bsp:
+        # Nothing changed, this only rewrites the header.
+        orig_size = bsp_path.stat().st_size
+        bsp.save(incremental=True)
+        assert bsp_path.stat().st_size <= orig_size
+
+        orig_ent_off = bsp.lumps[BSP_LUMPS.ENTITIES]._offset
+        orig_tex_off = bsp.lumps[BSP_LUMPS.TEXDATA_STRING_DATA]._offset
+
+        # Shrink the entities, so they fit in place.
+        vmf = bsp.read_ent_data()
+        vmf.remove_ent(vmf.entities[0])
+        new_ents = bsp.write_ent_data(vmf)
+        bsp.lumps[BSP_LUMPS.ENTITIES].data = new_ents
+        # Grow this one, so it needs to be moved.
+        tex_data = bsp.lumps[BSP_LUMPS.TEXDATA_STRING_DATA].data + b'tools/toolsnodraw\0'
+        bsp.lumps[BSP_LUMPS.TEXDATA_STRING_DATA].data = tex_data
+        game_lump = bsp.game_lumps[b'sprp']
+        game_lump.version += 1
+        bsp.save(incremental=True)
+
+        assert bsp.lumps[BSP_LUMPS.ENTITIES].data == new_ents
+        assert bsp.lumps[BSP_LUMPS.TEXDATA_STRING_DATA].data == tex_data
+
+        reloaded = BSP(bsp_path)
+        assert reloaded.game_lumps[b'sprp'].version == game_lump.version
+        for lump_id, lump in reloaded.lumps.items():
+            assert bsp.lumps[lump_id].data == lump.data, lump_id
+        for lump_id, sub_lump in reloaded.game_lumps.items():
+            assert bsp.game_lumps[lump_id].data == sub_lump.data, lump_id
+        assert reloaded.lumps[BSP_LUMPS.ENTITIES]._offset == orig_ent_off
+        assert reloaded.lumps[BSP_LUMPS.TEXDATA_STRING_DATA]._offset > orig_tex_off
+        # The packfile must remain at the end.
+        pak_lump = reloaded.lumps[BSP_LUMPS.PAKFILE]
+        assert pak_lump._offset + pak_lump._length == bsp_path.stat().st_size
+
+
+def test_stream_repr(bsp_path: Path) -> None:
+    """Describing a streamed lump doesn't run the writer."""
+    write_count = 0
+
+    def write(file) -> None:
+        """Count the number of times the data is produced."""
+        nonlocal write_count
+        write_count += 1
+        file.write(b'streamed data')
+
+    with BSP(bsp_path) as bsp:
+        lump = bsp.lumps[BSP_LUMPS.PAKFILE]
+        lump.set_stream(write)
+        assert repr(lump) == '<BSP Lump "PAKFILE", v{}, ident={}, streamed>'.format(
+            lump.version, bytes(lump.ident),
+        )
+        assert write_count == 0
+        assert lump.data == b'streamed data'
+        assert write_count == 1
+        assert repr(lump).endswith(', 13 bytes>')
+
+
+@pytest.mark.parametrize('version', range(4, 12))
+def test_static_prop_roundtrip(bsp_path: Path, version: int) -> None:
+    """Check static props can be written and read back in each version."""
+    bsp = BSP(bsp_path)
+    bsp.game_lumps[b'sprp'].version = version
+    props = [
+        StaticProp(
+            'models/props/cube.mdl', Vec(1, 2, 3), Vec(0, 90, 0), 1.0,
+            [1, 2, 3], 6, StaticPropFlags.NO_SHADOW | StaticPropFlags.NO_FLASHLIGHT,
+            2, 128.0, 512.0, Vec(4, 5, 6), 1.0,
+        ),
+        StaticProp(
+            'models/props/sphere.mdl', Vec(-64, 32, 8.5), Vec(15, 0, 45), 2.5,
+            [], 0, min_dx_level=80, max_dx_level=95,
+            min_cpu_level=1, max_cpu_level=2, min_gpu_level=1, max_gpu_level=3,
+            tint=Vec(255, 128, 0), renderfx=30, disable_on_xbox=True,
+        ),
+    ]
+    bsp.write_static_props(props)
+    read_props = list(bsp.static_props())
+    assert len(read_props) == len(props)
+    for prop, read in zip(props, read_props):
+        assert read.model == prop.model
+        assert read.origin == prop.origin
+        assert read.angles == prop.angles
+        assert read.visleafs == prop.visleafs
+        assert read.solidity == prop.solidity
+        assert read.skin == prop.skin
+        assert read.min_fade == prop.min_fade
+        assert read.max_fade == prop.max_fade
+        assert read.lighting == prop.lighting
+        if version >= 10:
+            assert read.flags is prop.flags
+        else:
+            assert read.flags.value == prop.flags.value_prim
+        if version in (6, 7):
+            assert read.min_dx_level == prop.min_dx_level
+            assert read.max_dx_level == prop.max_dx_level
+        if version >= 7:
+            assert read.tint == prop.tint
+            assert read.renderfx == prop.renderfx
+        if version >= 8:
+            assert read.min_cpu_level == prop.min_cpu_level
+            assert read.max_gpu_level == prop.max_gpu_level
+        if version >= 11:
+            assert read.scaling == prop.scaling
+        elif version >= 9:
+            assert read.disable_on_xbox == prop.disable_on_xbox
+
+
+def test_ent_lump_parse(ent_codec) -> None:
+    """Test parsing keyvalues and outputs from the entity lump."""
+    vmf = VMF()
+    parse, build = ent_codec
+    parse(vmf, b"""{
+"classname" "worldspawn"
+"mapversion" "42"
+"skyname" "sky_black"
+}
+{
+"origin" "1 2 3"
+"Origin" "4 5 6"
+"classname" "logic_relay"
+"targetname" "relay"
+"message" "a,b,c,d,e"
+"OnTrigger" "door,Open,,0.5,-1"
+"instance:inst;OnUser1" "door\x1bClose\x1bparam\x1b0\x1b1"
+}\r
+{\r
+"classname" "info_target"\r
+}\r
+\x00""")
+    assert vmf.spawn['skyname'] == 'sky_black'
+    assert len(vmf.entities) == 2
+    relay, target = vmf.entities
+    assert relay['origin'] == '4 5 6'
+    assert list(relay.keys) == ['origin', 'classname', 'targetname', 'message']
+    assert relay['message'] == 'a,b,c,d,e'
+    assert vmf.by_target['relay'] == {relay}
+    assert vmf.by_class['info_target'] == {target}
+    assert len(relay.outputs) == 2
+    comma_out, sep_out = relay.outputs
+    assert comma_out.output == 'OnTrigger'
+    assert comma_out.target == 'door'
+    assert comma_out.input == 'Open'
+    assert comma_out.delay == 0.5
+    assert comma_out.times == -1
+    assert comma_out.comma_sep
+    assert sep_out.inst_out == 'inst'
+    assert sep_out.output == 'OnUser1'
+    assert sep_out.target == 'door'
+    assert sep_out.input == 'Close'
+    assert sep_out.params == 'param'
+    assert sep_out.times == 1
+    assert not sep_out.comma_sep
+
+    assert build(vmf, False) == b"""{
+"classname" "worldspawn"
+"mapversion" "42"
+"skyname" "sky_black"
+}
+{
+"origin" "4 5 6"
+"classname" "logic_relay"
+"targetname" "relay"
+"message" "a,b,c,d,e"
+"OnTrigger" "door\x1bOpen\x1b\x1b0.5\x1b-1"
+"instance:inst;OnUser1" "door\x1bClose\x1bparam\x1b0\x1b1"
+}
+{
+"classname" "info_target"
+}
+\x00"""
+
+
+@pytest.mark.parametrize('ent_data, message', [
+    (b'{\n"classname" "worldspawn"\n{\n', 'nesting'),
+    (b'}\n', 'closing brackets'),
+    (b'"key" "value"\n', 'outside brackets'),
+    (b'{\n"classname" "info_target"\n}\n', 'worldspawn'),
+    (b'{\n"classname" "worldspawn"\n\x00', "didn't end"),
+])
+def test_ent_lump_errors(ent_codec, ent_data: bytes, message: str) -> None:
+    """Test invalid entity lumps."""
+    parse, build = ent_codec
+    with pytest.raises(ValueError, match=message):
+        parse(VMF(), ent_data)
+
+
+def test_ent_lump_roundtrip(bsp_path: Path, ent_codec) -> None:
+    """Parsing and writing the entity lump should preserve the data."""
+    bsp = BSP(bsp_path)
+    vmf = bsp.read_ent_data()
+    assert vmf.map_ver == int(vmf.spawn['mapversion'])
+    ent_data = bsp.write_ent_data(vmf)
+    # Worldspawn's classname is moved first, otherwise this is identical.
+    assert sorted(ent_data.splitlines()) == sorted(
+        bsp.lumps[BSP_LUMPS.ENTITIES].data.splitlines()
+    )
+    bsp.lumps[BSP_LUMPS.ENTITIES].data = ent_data
+    assert bsp.write_ent_data(bsp.read_ent_data()) == ent_data
@@ -0,0 +1,246 @@
+"""Test the FGD parser and binary format."""
+import io
+import os
+from pathlib import Path
+
+import pytest
+
+from srctools import fgd as fgd_mod, Vec
+from srctools.fgd import FGD, EntityDef, HelperSize
+from srctools.filesys import VirtualFileSystem, RawFileSystem
+
+
+FGD_TEXT = '''\
+@mapsize(-16384, 16384)
+@MaterialExclusion
+    [
+    "debug"
+    ]
+@AutoVisgroup = "Brushes"
+    [
+    "Func"
+        [
+        "func_brush"
+        ]
+    ]
+@BaseClass = Targetname
+    [
+    targetname(target_source) : "Name"
+    input Kill(void) : "Remove."
+    ]
+@PointClass base(Targetname) size(-8 -8 -8, 8 8 8) = info_target : "A target."
+    [
+    spawnflags(flags) =
+        [
+        1 : "Transmit" : 0
+        ]
+    ]
+@SolidClass base(Targetname) = func_brush : "A brush."
+    [
+    solidity[engine](integer) : "Solid" : 0
+    solidity(choices) : "Solid" : 0 =
+        [
+        0 : "Toggle"
+        1 : "Never"
+        ]
+    output OnUser1(void) : "Fired."
+    ]
+'''
+
+
+def parse_fgd() -> FGD:
+    """Parse the sample FGD."""
+    fsys = VirtualFileSystem({'test.fgd': FGD_TEXT})
+    return FGD.parse('test.fgd', fsys)
+
+
+def roundtrip(fgd: FGD, with_help: bool=False) -> FGD:
+    """Serialise then unserialise a FGD."""
+    buf = io.BytesIO()
+    fgd.serialise(buf, with_help)
+    buf.seek(0)
+    return FGD.unserialise(buf)
+
+
+def export_ent(ent: EntityDef) -> str:
+    """Produce the text form of an entity, for comparisons."""
+    buf = io.StringIO()
+    ent.export(buf)
+    return buf.getvalue()
+
+
+def test_binary_roundtrip() -> None:
+    """Test the binary format decodes entities lazily."""
+    orig = parse_fgd()
+    fgd = roundtrip(orig)
+
+    assert fgd.map_size_min == -16384
+    assert fgd.map_size_max == 16384
+    assert len(fgd) == 3
+    assert 'info_target' in fgd.entities
+    assert list(fgd.entities) == list(orig.entities)
+    # Nothing has been decoded yet.
+    assert not any(isinstance(ent, EntityDef) for ent in fgd.entities._ents.values())
+
+    ent = fgd['FUNC_BRUSH']
+    assert ent.classname == 'func_brush'
+    assert [base.classname for base in ent.bases] == ['Targetname']
+    # The base was decoded too, and is shared.
+    assert fgd['info_target'].bases[0] is ent.bases[0]
+    for ent in orig:
+        # Help text isn't stored.
+        read = fgd[ent.classname]
+        assert read.type is ent.type
+        assert read.keyvalues.keys() == ent.keyvalues.keys()
+        assert len(read.inputs) == len(ent.inputs)
+        assert len(read.outputs) == len(ent.outputs)
+        assert read.helpers == ent.helpers
+        assert read.kv_order == ent.kv_order
+        assert read.desc == ''
+        for name, tags_map in ent.keyvalues.items():
+            assert read.keyvalues[name].keys() == tags_map.keys()
+    assert fgd['info_target'].helpers == [HelperSize(
+        Vec(-8, -8, -8), Vec(8, 8, 8),
+    )]
+    assert fgd.mat_exclusions == orig.mat_exclusions
+    assert fgd.auto_visgroups.keys() == orig.auto_visgroups.keys()
+    visgroup = fgd.auto_visgroups['func']
+    assert visgroup.name == 'Func'
+    assert visgroup.parent == 'Brushes'
+    assert visgroup.ents == {'func_brush'}
+    solidity = fgd['func_brush'].keyvalues['solidity']
+    assert solidity[frozenset({'ENGINE'})].type.value == 'integer'
+    assert solidity[frozenset()].val_list == [
+        ('0', 'Toggle', frozenset()),
+        ('1', 'Never', frozenset()),
+    ]
+    with pytest.raises(KeyError):
+        fgd['info_null']
+
+
+def test_binary_copy() -> None:
+    """Copies of a binary FGD are independent."""
+    buf = io.BytesIO()
+    parse_fgd().serialise(buf)
+    buf.seek(0)
+    fgd = FGD.unserialise(buf)
+    target = fgd['info_target']
+    dup = fgd_mod.deepcopy(fgd)
+    assert dup['info_target'] is not target
+    assert export_ent(dup['info_target']) == export_ent(target)
+    dup['func_brush'].keyvalues.clear()
+    del dup.entities['targetname']
+    assert fgd['func_brush'].keyvalues
+    assert 'targetname' in fgd.entities
+
+
+def test_binary_help() -> None:
+    """Help text can optionally be included."""
+    orig = parse_fgd()
+    fgd = roundtrip(orig, with_help=True)
+    for ent in orig:
+        read = fgd[ent.classname]
+        assert read.desc == ent.desc
+        assert read.keyvalues == ent.keyvalues
+    assert fgd['info_target'].desc == 'A target.'
+    [kill_map] = fgd['targetname'].inputs.values()
+    [kill] = kill_map.values()
+    assert kill.desc == 'Remove.'
+
+
+def test_binary_unknown_version() -> None:
+    """Other format versions are rejected."""
+    buf = io.BytesIO()
+    parse_fgd().serialise(buf)
+    data = bytearray(buf.getvalue())
+    data[3] = fgd_mod.BIN_FORMAT_VERSION - 1
+    with pytest.raises(TypeError):
+        FGD.unserialise(io.BytesIO(data))
+    with pytest.raises(ValueError):
+        FGD.unserialise(io.BytesIO(b'VMF' + data[3:]))
+
+
+def test_parse_cache(tmp_path: Path, monkeypatch) -> None:
+    """Parsing can be cached, and is redone when any included file changes."""
+    folder = tmp_path / 'fgd'
+    folder.mkdir()
+    (folder / 'main.fgd').write_text('@include "base.fgd"\n' + FGD_TEXT.split('@BaseClass')[0])
+    (folder / 'base.fgd').write_text('@BaseClass' + FGD_TEXT.split('@BaseClass')[1])
+    cache_file = tmp_path / 'cache' / 'main.fgd.bin'
+    fsys = RawFileSystem(folder)
+
+    orig = FGD.parse('main.fgd', fsys, cache_file=cache_file)
+    assert cache_file.exists()
+    assert len(orig) == 3
+
+    parse_count = 0
+    orig_parse_file = FGD.parse_file
+
+    def parse_file(self, filesys, file, **kwargs) -> None:
+        """Count the number of times the root file is parsed."""
+        nonlocal parse_count
+        if file.path != 'base.fgd':
+            parse_count += 1
+        orig_parse_file(self, filesys, file, **kwargs)
+
+    monkeypatch.setattr(FGD, 'parse_file', parse_file)
+
+    cached = FGD.parse('main.fgd', fsys, cache_file=cache_file)
+    assert parse_count == 0
+    assert cached['info_target'].desc == 'A target.'
+    assert {file.path for file in cached._parse_list} == {'main.fgd', 'base.fgd'}
+    for ent in orig:
+        assert cached[ent.classname].keyvalues == ent.keyvalues
+
+    # A cache with help text can be used if help isn't required,
+    # but not the reverse.
+    FGD.parse('main.fgd', fsys, cache_file=cache_file, cache_help=False)
+    assert parse_count == 0
+    no_help_cache = tmp_path / 'no_help.bin'
+    FGD.parse('main.fgd', fsys, cache_file=no_help_cache, cache_help=False)
+    assert parse_count == 1
+    no_help = FGD.parse('main.fgd', fsys, cache_file=no_help_cache, cache_help=False)
+    assert no_help['info_target'].desc == ''
+    assert parse_count == 1
+    FGD.parse('main.fgd', fsys, cache_file=no_help_cache)
+    assert parse_count == 2
+
+    # Changing an included file invalidates the cache.
+    (folder / 'base.fgd').write_text('@BaseClass = Targetname []\n')
+    os.utime(folder / 'base.fgd', ns=(0, 0))
+    assert len(FGD.parse('main.fgd', fsys, cache_file=cache_file)) == 1
+    assert parse_count == 3
+    assert len(FGD.parse('main.fgd', fsys, cache_file=cache_file)) == 1
+    assert parse_count == 3
+
+    # Or deleting it, even if the root file appears unchanged.
+    main_mtime = (folder / 'main.fgd').stat().st_mtime_ns
+    (folder / 'main.fgd').write_text(FGD_TEXT.split('@BaseClass')[0])
+    os.utime(folder / 'main.fgd', ns=(main_mtime, main_mtime))
+    (folder / 'base.fgd').unlink()
+    reparsed = FGD.parse('main.fgd', fsys, cache_file=cache_file)
+    assert parse_count == 4
+    assert {file.path for file in reparsed._parse_list} == {'main.fgd'}
+
+    # As does using another root file.
+    (folder / 'other.fgd').write_text(FGD_TEXT)
+    FGD.parse('other.fgd', fsys, cache_file=cache_file)
+    assert parse_count == 5
+    cache_file.write_bytes(b'FGDC garbage')
+    assert len(FGD.parse('other.fgd', fsys, cache_file=cache_file)) == 3
+    assert parse_count == 6
+
+
+def test_engine_dbase() -> None:
+    """The engine database is only loaded once, but copied each time."""
+    first = FGD.engine_dbase()
+    assert fgd_mod._ENGINE_FGD is not None
+    second = FGD.engine_dbase()
+    assert first is not second
+    assert first['prop_static'] is not second['prop_static']
+    assert first['prop_static'].classname == 'prop_static'
+    # Accessing copies doesn't decode anything in the original.
+    assert not any(
+        isinstance(ent, EntityDef)
+        for ent in fgd_mod._ENGINE_FGD.entities._ents.values()
+    )
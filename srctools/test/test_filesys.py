@@ -0,0 +1,184 @@
+"""Test the filesystem implementations."""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from srctools.filesys import (
+    RawFileSystem, VirtualFileSystem, FileSystemChain, CacheInfo,
+)
+
+
+@pytest.fixture
+def raw_folder(tmp_path: Path) -> Path:
+    """Create a folder of files."""
+    (tmp_path / 'Materials' / 'Tools').mkdir(parents=True)
+    (tmp_path / 'Materials' / 'Tools' / 'ToolsNodraw.vmt').write_text('nodraw')
+    (tmp_path / 'Materials' / 'Tools' / 'toolsskip.vmt').write_text('skip')
+    (tmp_path / 'readme.txt').write_text('readme')
+    return tmp_path
+
+
+@pytest.mark.parametrize('index', [False, True], ids=['plain', 'indexed'])
+def test_raw_exact(raw_folder: Path, index: bool) -> None:
+    """Test behaviour common to indexed and regular raw filesystems."""
+    fsys = RawFileSystem(raw_folder, index=index)
+    with fsys:
+        assert 'readme.txt' in fsys
+        assert 'Materials/Tools/ToolsNodraw.vmt' in fsys
+        assert 'Materials/Tools' not in fsys
+        assert 'missing.txt' not in fsys
+        assert 'Materials/missing/file.txt' not in fsys
+        with pytest.raises(FileNotFoundError):
+            fsys['missing.txt']
+        file = fsys['Materials/Tools/ToolsNodraw.vmt']
+        with file.open_str() as f:
+            assert f.read() == 'nodraw'
+        assert file.cache_key() == (raw_folder / 'Materials/Tools/ToolsNodraw.vmt').stat().st_mtime_ns
+        with pytest.raises(ValueError):
+            fsys['../outside.txt']
+
+
+def test_raw_index(raw_folder: Path) -> None:
+    """Indexed filesystems are case-insensitive, and detect changes."""
+    fsys = RawFileSystem(raw_folder, index=True)
+    with fsys:
+        assert 'materials/tools/toolsnodraw.vmt' in fsys
+        assert 'README.TXT' in fsys
+        assert 'materials\\Tools\\toolsskip.vmt' in fsys
+        file = fsys['MATERIALS/tools/TOOLSSKIP.vmt']
+        assert file.path == 'MATERIALS/tools/TOOLSSKIP.vmt'
+        with file.open_bin() as f:
+            assert f.read() == b'skip'
+        with fsys.open_str('materials/tools/toolsnodraw.vmt') as f:
+            assert f.read() == 'nodraw'
+
+        # Changes aren't detected while open.
+        (raw_folder / 'Materials' / 'Tools' / 'new.vmt').write_text('new')
+        (raw_folder / 'Materials' / 'Tools' / 'toolsskip.vmt').unlink()
+        assert 'materials/tools/new.vmt' not in fsys
+    # Ensure the modification time differs.
+    os.utime(raw_folder / 'Materials' / 'Tools', ns=(0, 0))
+
+    with fsys:
+        assert 'materials/tools/new.vmt' in fsys
+        assert 'materials/tools/toolsskip.vmt' not in fsys
+
+
+@pytest.mark.skipif(
+    os.path.normcase('A') == 'a',
+    reason='Requires a case-sensitive filesystem.',
+)
+def test_raw_index_exact_case(tmp_path: Path) -> None:
+    """If names differ only in case, exact matches take priority."""
+    (tmp_path / 'file.txt').write_text('lower')
+    (tmp_path / 'FILE.txt').write_text('upper')
+    with RawFileSystem(tmp_path, index=True) as fsys:
+        with fsys.open_str('FILE.txt') as f:
+            assert f.read() == 'upper'
+        with fsys.open_str('file.txt') as f:
+            assert f.read() == 'lower'
+
+
+def test_chain_cache() -> None:
+    """Test the resolution cache for chains."""
+    first = VirtualFileSystem({'a.txt': 'first a', 'b.txt': 'first b'})
+    second = VirtualFileSystem({'a.txt': 'second a', 'c.txt': 'second c'})
+    chain = FileSystemChain(first, second, cache_size=3)
+    with chain:
+        assert chain.cache_info() == CacheInfo(0, 0, 3, 0)
+        with chain.open_str('a.txt') as f:
+            assert f.read() == 'first a'
+        file = chain['c.txt']
+        assert FileSystemChain.get_system(file) is second
+        assert chain['c.txt'] is file
+        assert 'missing.txt' not in chain
+        assert 'missing.txt' not in chain
+        assert chain.cache_info() == CacheInfo(2, 3, 3, 3)
+        # Bounded, so the least recently used name is discarded.
+        assert 'b.txt' in chain
+        assert chain.cache_info().currsize == 3
+        assert 'a.txt' in chain
+        assert chain.cache_info().misses == 5
+
+        # Adding a system means cached results could be wrong.
+        third = VirtualFileSystem({'missing.txt': 'now present'})
+        chain.add_sys(third, priority=True)
+        assert chain.cache_info().currsize == 0
+        with chain.open_str('missing.txt') as f:
+            assert f.read() == 'now present'
+        chain.clear_cache()
+        assert chain.cache_info().currsize == 0
+
+
+def test_chain_cache_nested(raw_folder: Path) -> None:
+    """Changes to child systems clear the caches of all parents."""
+    raw = RawFileSystem(raw_folder, index=True)
+    inner = FileSystemChain(raw)
+    outer = FileSystemChain(inner)
+    with outer:
+        assert 'new.txt' not in outer
+        assert 'new.txt' not in inner
+        (raw_folder / 'new.txt').write_text('new')
+        os.utime(raw_folder, ns=(0, 0))
+        assert 'new.txt' not in outer
+        # Simulate the raw system being reopened elsewhere.
+        raw._check_index()
+        assert inner.cache_info().currsize == 0
+        assert outer.cache_info().currsize == 0
+        assert 'new.txt' in outer
+    # Reopening also clears the cache.
+    (raw_folder / 'new.txt').unlink()
+    os.utime(raw_folder, ns=(1, 1))
+    with outer:
+        assert 'new.txt' not in outer
+
+
+def test_chain_cache_cleared_during_lookup(monkeypatch: pytest.MonkeyPatch) -> None:
+    """A lookup which overlaps with clearing the cache is not stored."""
+    child = VirtualFileSystem({'a.txt': 'a'})
+    chain = FileSystemChain(child)
+    orig_get_file = VirtualFileSystem._get_file
+
+    def get_file(self: VirtualFileSystem, name: str):
+        """Simulate another thread clearing the cache."""
+        chain.clear_cache()
+        return orig_get_file(self, name)
+
+    monkeypatch.setattr(VirtualFileSystem, '_get_file', get_file)
+    with chain:
+        assert 'a.txt' in chain
+        assert chain.cache_info().currsize == 0
+        monkeypatch.undo()
+        assert 'a.txt' in chain
+        assert chain.cache_info().currsize == 1
+
+
+def test_chain_cache_threads() -> None:
+    """The cache can be used from several threads at once."""
+    names = ['file_{}.txt'.format(i) for i in range(64)]
+    chain = FileSystemChain(
+        VirtualFileSystem({name: name for name in names[::2]}),
+        cache_size=16,
+    )
+
+    def lookup(name: str) -> bool:
+        """Check a file exists, occasionally clearing the cache."""
+        if name == names[-1]:
+            chain.clear_cache()
+        return name in chain
+
+    with chain, ThreadPoolExecutor(8) as pool:
+        for _ in range(20):
+            assert list(pool.map(lookup, names)) == [i % 2 == 0 for i in range(64)]
+    assert chain.cache_info().currsize <= 16
+
+
+def test_chain_cache_disabled() -> None:
+    """With a size of zero, nothing is cached."""
+    chain = FileSystemChain(VirtualFileSystem({'a.txt': 'a'}), cache_size=0)
+    with chain:
+        assert 'a.txt' in chain
+        assert 'b.txt' not in chain
+        assert chain.cache_info() == CacheInfo(0, 2, 0, 0)
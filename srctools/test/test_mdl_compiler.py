@@ -0,0 +1,122 @@
+"""Test the model compiler, using a stand-in for StudioMDL."""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from srctools.compiler.mdl_compiler import ModelCompiler
+from srctools.filesys import FileSystemChain
+from srctools.game import Game
+from srctools.packlist import PackList
+
+
+pytestmark = pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='The fake StudioMDL is run as a script.',
+)
+
+GAMEINFO = '''\
+"GameInfo"
+    {
+    "game" "Test"
+    "FileSystem"
+        {
+        "SteamAppId" "1"
+        "SearchPaths"
+            {
+            "Game" "|gameinfo_path|."
+            }
+        }
+    }
+'''
+
+# Writes the "model" to the game folder, and records when it ran.
+STUDIOMDL = '''\
+#!{python}
+import sys, time
+from pathlib import Path
+game = Path(sys.argv[sys.argv.index('-game') + 1])
+qc = Path(sys.argv[-1]).read_text()
+name, contents = qc.split('\\n', 1)
+if contents == 'fail':
+    print('Compile failed!')
+    sys.exit(1)
+start = time.monotonic()
+time.sleep(0.25)
+(game / 'models' / name).with_suffix('.mdl').write_text(contents)
+(game / 'models' / name).with_suffix('.vvd').write_text('vertices')
+with open(game / 'times.txt', 'a') as f:
+    f.write('{{}} {{}}\\n'.format(start, time.monotonic()))
+'''
+
+
+@pytest.fixture
+def game(tmp_path: Path) -> Game:
+    """Create a game folder, with the fake StudioMDL."""
+    (tmp_path / 'gameinfo.txt').write_text(GAMEINFO)
+    studiomdl = tmp_path / 'studiomdl'
+    studiomdl.write_text(STUDIOMDL.format(python=sys.executable))
+    studiomdl.chmod(0o755)
+    return Game(tmp_path)
+
+
+def compile_func(key: str, folder: Path, mdl_name: str, args: str) -> str:
+    """Write the QC, which the fake StudioMDL reads."""
+    (folder / 'model.qc').write_text(mdl_name + '\n' + key)
+    return args + key
+
+
+def test_parallel_compile(game: Game) -> None:
+    """Models can be compiled in parallel, then packed once done."""
+    pack = PackList(FileSystemChain())
+    compiler = ModelCompiler(game, game.path / 'studiomdl', pack, 'test_map', 'compiled', max_workers=4)
+    names = []
+    with compiler:
+        for key in ['a', 'b', 'c', 'd']:
+            name, result = compiler.get_model(key, compile_func, 'result_', wait=False)
+            assert result == 'result_' + key
+            names.append(name)
+        # Reusing a model doesn't compile it again.
+        assert compiler.get_model('a', compile_func, 'other', wait=False) == (names[0], 'result_a')
+        assert len(set(names)) == 4
+        # Nothing is packed until they finish.
+        assert not any(pack._files)
+    assert compiler.use_count() == 4
+    for key, name in zip('abcd', names):
+        assert pack._files[name].data == key.encode()
+        assert pack._files[name[:-4] + '.vvd'].data == b'vertices'
+
+    # Check the runs overlapped.
+    times = sorted(
+        tuple(map(float, line.split()))
+        for line in (game.path / 'times.txt').read_text().splitlines()
+    )
+    assert len(times) == 4
+    assert any(
+        start < prev_end
+        for (prev_start, prev_end), (start, end) in zip(times, times[1:])
+    )
+
+    # The models are reused in the next compile.
+    pack = PackList(FileSystemChain())
+    with ModelCompiler(game, game.path / 'studiomdl', pack, 'test_map', 'compiled') as compiler:
+        assert compiler.get_model('b', compile_func, 'new_') == (names[1], 'result_b')
+        assert pack._files[names[1]].data == b'b'
+    assert len((game.path / 'times.txt').read_text().splitlines()) == 4
+
+
+def test_compile_failure(game: Game) -> None:
+    """Failed compiles are raised when the results are required."""
+    pack = PackList(FileSystemChain())
+    compiler = ModelCompiler(game, game.path / 'studiomdl', pack, 'test_map', 'compiled', max_workers=2)
+    with pytest.raises(subprocess.CalledProcessError):
+        with compiler:
+            compiler.get_model('fail', compile_func, '', wait=False)
+            name, result = compiler.get_model('works', compile_func, '', wait=True)
+            assert pack._files[name].data == b'works'
+    assert not (compiler.model_folder_abs / 'manifest.bin').exists()
+    with pytest.raises(subprocess.CalledProcessError):
+        with compiler:
+            compiler.get_model('fail', compile_func, '')
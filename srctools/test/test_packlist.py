@@ -0,0 +1,358 @@
+"""Test the packlist dependency resolution."""
+import io
+import os
+import struct
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Tuple
+
+import pytest
+
+from srctools.bsp import BSP, BSP_LUMPS
+from srctools.filesys import (
+    FileSystem, FileSystemChain, VirtualFileSystem, RawFileSystem,
+)
+from srctools import packlist as packlist_mod
+from srctools.packlist import (
+    PackList, FileType, EvalStats, COMPRESSION_POLICY_LZMA,
+)
+
+
+FILES = {
+    'materials/base/wall.vmt': '''\
+"LightmappedGeneric"
+    {
+    "$basetexture" "base/wall"
+    "$bumpmap" "base/wall_normal"
+    "$envmap" "env_cubemap"
+    }
+''',
+    'materials/base/water.vmt': '''\
+"Water"
+    {
+    "$normalmap" "base/water_normal"
+    "$bottommaterial" "base/wall"
+    "$reflecttexture" "_rt_WaterReflection"
+    }
+''',
+    'materials/patched/wall.vmt': '''\
+"Patch"
+    {
+    "include" "materials/base/wall.vmt"
+    "insert"
+        {
+        "$detail" "base/detail"
+        }
+    }
+''',
+    'materials/base/broken.vmt': '"LightmappedGeneric" { "$basetexture" ',
+    'materials/base/wall.vtf': '',
+    'materials/base/wall.hdr.vtf': '',
+    'materials/base/wall_normal.vtf': '',
+    'materials/base/water_normal.vtf': '',
+    'materials/base/detail.vtf': '',
+}
+
+
+def make_mdl(cdmaterial: str, texture: str) -> bytes:
+    """Build a minimal model, with a single mesh using one texture."""
+    # The header is 392 bytes long, followed by the cdmaterials offset,
+    # the texture, skin table, body part, model, mesh, then the strings.
+    cdmat_off = 392
+    tex_off = cdmat_off + 4
+    skin_off = tex_off + 64
+    body_off = skin_off + 2
+    cdmat_str = body_off + 16 + 148 + 116
+    tex_str = cdmat_str + len(cdmaterial) + 1
+    surf_str = tex_str + len(texture) + 1
+    return b''.join([
+        b'IDST', struct.pack('<i4x64si', 49, b'test.mdl', 0),
+        bytes(4 * 18),  # Eye, illum pos and bounding boxes.
+        bytes(4 * 11),  # Flags, bones, animations and sequences.
+        struct.pack(
+            '<13i', 0, 0,
+            1, tex_off,  # Textures
+            1, cdmat_off,  # $cdmaterials
+            1, 1, skin_off,  # Skins
+            1, body_off,  # Body parts
+            0, 0,  # Attachments
+        ),
+        bytes(4 * 15),
+        struct.pack('<5I', surf_str, 0, 0, 0, 0),
+        bytes(4 * 12),
+        bytes(16),
+        struct.pack('<i', cdmat_str),
+        struct.pack('<iii52x', tex_str - tex_off, 0, 0),
+        struct.pack('<H', 0),
+        struct.pack('<4i', 0, 1, 0, 16),  # Body part, with one model.
+        struct.pack('<64sif9i40x', b'body', 0, 0.0, 1, 148, 0, 0, 0, 0, 0, 0, 0),
+        struct.pack('<9i3f68x', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0.0, 0.0, 0.0),  # Mesh
+        cdmaterial.encode('ascii') + b'\0',
+        texture.encode('ascii') + b'\0',
+        b'metal\0',
+    ])
+
+
+def make_packlist(fsys: FileSystem=None) -> PackList:
+    """Create a packlist containing some materials."""
+    if fsys is None:
+        fsys = VirtualFileSystem(FILES)
+    packlist = PackList(FileSystemChain(fsys))
+    packlist.pack_file('materials/patched/wall.vmt')
+    packlist.pack_file('base/water', FileType.MATERIAL)
+    packlist.pack_file('base/broken', FileType.MATERIAL)
+    packlist.pack_file('base/missing', FileType.MATERIAL, optional=True)
+    return packlist
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_eval_dependencies(max_workers: int) -> None:
+    """Test materials and textures are found."""
+    packlist = make_packlist()
+    stats = packlist.eval_dependencies(max_workers=max_workers)
+    assert [(file.filename, file.type) for file in packlist] == [
+        ('materials/patched/wall.vmt', FileType.MATERIAL),
+        ('materials/base/water.vmt', FileType.MATERIAL),
+        ('materials/base/broken.vmt', FileType.MATERIAL),
+        ('materials/base/missing.vmt', FileType.MATERIAL),
+        # From the patch.
+        ('materials/base/wall.vmt', FileType.MATERIAL),
+        ('materials/base/wall.vtf', FileType.TEXTURE),
+        ('materials/base/wall_normal.vtf', FileType.TEXTURE),
+        ('materials/base/detail.vtf', FileType.TEXTURE),
+        # From the water.
+        ('materials/base/water_normal.vtf', FileType.TEXTURE),
+        # From the textures.
+        ('materials/base/wall.hdr.vtf', FileType.TEXTURE),
+    ]
+    assert packlist['materials/base/missing.vmt'].optional
+    assert packlist['materials/base/wall.hdr.vtf'].optional
+    assert not packlist['materials/base/wall.vtf'].optional
+    assert stats.keys() == {FileType.MATERIAL, FileType.TEXTURE}
+    assert stats[FileType.MATERIAL].count == 5
+    assert stats[FileType.TEXTURE].count == 5
+    assert isinstance(stats[FileType.TEXTURE], EvalStats)
+
+    # Everything was analysed, so nothing more is done.
+    assert packlist.eval_dependencies() == {}
+
+
+def test_eval_dependencies_executor() -> None:
+    """An existing executor can be used, and is not shut down."""
+    packlist = make_packlist()
+    with ThreadPoolExecutor(2) as executor:
+        packlist.eval_dependencies(executor=executor)
+        assert executor.submit(int, '42').result() == 42
+    assert 'materials/base/water_normal.vtf' in packlist
+
+
+def test_model_data_dependencies() -> None:
+    """Models packed with data have their materials packed too."""
+    packlist = PackList(FileSystemChain(VirtualFileSystem(FILES)))
+    packlist.pack_file('models/test.mdl', FileType.MODEL, data=make_mdl('base', 'wall'))
+    packlist.eval_dependencies()
+    assert 'materials/base/wall.vmt' in packlist
+    assert 'materials/base/wall.vtf' in packlist
+    assert 'materials/base/wall_normal.vtf' in packlist
+
+
+def test_dependency_cache(tmp_path: Path) -> None:
+    """Dependencies can be cached between runs."""
+    folder = tmp_path / 'game'
+    for filename, data in FILES.items():
+        (folder / filename).parent.mkdir(parents=True, exist_ok=True)
+        (folder / filename).write_text(data)
+    cache_file = tmp_path / 'deps.vdf'
+
+    def run() -> Tuple[PackList, Dict[FileType, EvalStats]]:
+        """Evaluate a packlist using the cache."""
+        packlist = make_packlist(RawFileSystem(folder))
+        return packlist, packlist.eval_dependencies(cache_file=cache_file)
+
+    orig, stats = run()
+    assert stats[FileType.MATERIAL].cached == 0
+    assert cache_file.exists()
+
+    cached, stats = run()
+    # The broken and missing materials aren't cached.
+    assert stats[FileType.MATERIAL] == EvalStats(5, stats[FileType.MATERIAL].time, 3)
+    assert [file.filename for file in cached] == [file.filename for file in orig]
+
+    # Modifying a patch parent means the patched material is reparsed.
+    (folder / 'materials/base/wall.vmt').write_text(FILES['materials/base/wall.vmt'].replace(
+        'base/wall_normal', 'base/wall_bump',
+    ))
+    os.utime(folder / 'materials/base/wall.vmt', ns=(0, 0))
+    changed, stats = run()
+    assert stats[FileType.MATERIAL].cached == 1
+    assert 'materials/base/wall_bump.vtf' in changed
+    assert 'materials/base/wall_normal.vtf' not in changed
+
+    cache_file.write_text('"version" "1"\n"Materials" { "materials/a.vmt" { "files" { "bad" "a" } } }')
+    packlist, stats = run()
+    assert stats[FileType.MATERIAL].cached == 0
+    assert [file.filename for file in packlist] == [file.filename for file in changed]
+
+
+@pytest.mark.parametrize('incremental', [False, True], ids=['full', 'incremental'])
+@pytest.mark.parametrize('lazy', [False, True], ids=['eager', 'lazy'])
+def test_pack_into_zip_stream(tmp_path: Path, bsp_path: Path, lazy: bool, incremental: bool) -> None:
+    """Streaming the packfile produces the same files, copying existing entries."""
+    with BSP(bsp_path) as bsp:
+        with bsp.packfile() as pak_zip:
+            pak_zip.writestr('readme.txt', 'Packed already. ' * 64, zipfile.ZIP_DEFLATED)
+            pak_zip.writestr('materials/base/water.vmt', 'Overridden')
+        bsp.save()
+
+    fsys = RawFileSystem(tmp_path / 'files')
+    for filename, data in FILES.items():
+        path = tmp_path / 'files' / filename
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(data)
+
+    packlist = make_packlist(fsys)
+    packlist.pack_file('data.txt', data=b'Custom data')
+    with BSP(bsp_path) as bsp:
+        packlist.pack_into_zip(bsp)
+        with bsp.packfile() as pak_zip:
+            expected = {
+                info.filename: pak_zip.read(info)
+                for info in pak_zip.infolist()
+            }
+    assert expected['materials/base/water.vmt'] == FILES['materials/base/water.vmt'].encode()
+    assert expected['data.txt'] == b'Custom data'
+
+    with BSP(bsp_path, lazy=lazy) as bsp:
+        packlist.pack_into_zip(bsp, stream=True, compression={'txt': zipfile.ZIP_DEFLATED})
+        orig_inode = bsp_path.stat().st_ino
+        bsp.save(incremental=incremental)
+        # Incremental saves write into the original file.
+        assert (bsp_path.stat().st_ino == orig_inode) == incremental
+        # The stream is kept if the data can't be remapped.
+        assert (bsp.lumps[BSP_LUMPS.PAKFILE]._stream is not None) != lazy
+        with bsp.packfile() as pak_zip:
+            assert pak_zip.namelist() == list(expected)
+
+    with BSP(bsp_path) as bsp, bsp.packfile() as pak_zip:
+        assert pak_zip.testzip() is None
+        assert {
+            info.filename: pak_zip.read(info)
+            for info in pak_zip.infolist()
+        } == expected
+        # Existing entries kept their compression.
+        assert pak_zip.getinfo('readme.txt').compress_type == zipfile.ZIP_DEFLATED
+        assert pak_zip.getinfo('data.txt').compress_type == zipfile.ZIP_DEFLATED
+        assert pak_zip.getinfo('materials/base/water.vmt').compress_type == zipfile.ZIP_STORED
+        pak_lump = bsp.lumps[BSP_LUMPS.PAKFILE]
+        assert pak_lump._offset + pak_lump._length == bsp_path.stat().st_size
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_pack_into_zip_compression(bsp_path: Path, max_workers: int) -> None:
+    """Files are compressed according to the policy, in a consistent order."""
+    files = {
+        'materials/base/wall.vmt': '"LightmappedGeneric" {}' * 200,
+        'materials/base/wall.vtf': 'VTF\0' * 200,
+        'models/prop.dx90.vtx': 'VTX' * 200,
+        'scripts/game_sounds.txt': 'sounds' * 200,
+    }
+    packlist = PackList(FileSystemChain(VirtualFileSystem(files)))
+    for filename in files:
+        packlist.pack_file(filename)
+    packlist.pack_file('readme.txt', data=b'Custom data')
+
+    with BSP(bsp_path) as bsp:
+        with bsp.packfile() as pak_zip:
+            # This will be recompressed.
+            pak_zip.writestr('old.txt', 'Old file')
+        packlist.pack_into_zip(
+            bsp,
+            compression=COMPRESSION_POLICY_LZMA,
+            max_workers=max_workers,
+        )
+        with bsp.packfile() as pak_zip:
+            assert pak_zip.testzip() is None
+            assert [
+                (info.filename, info.compress_type)
+                for info in pak_zip.infolist()
+            ] == [
+                ('materials/maps/rot_main/cubemapdefault.vtf', zipfile.ZIP_STORED),
+                ('materials/maps/rot_main/cubemapdefault.hdr.vtf', zipfile.ZIP_STORED),
+                ('old.txt', zipfile.ZIP_LZMA),
+                ('materials/base/wall.vmt', zipfile.ZIP_LZMA),
+                ('materials/base/wall.vtf', zipfile.ZIP_STORED),
+                ('models/prop.dx90.vtx', zipfile.ZIP_STORED),
+                ('scripts/game_sounds.txt', zipfile.ZIP_LZMA),
+                ('readme.txt', zipfile.ZIP_LZMA),
+            ]
+            for filename, data in files.items():
+                assert pak_zip.read(filename) == data.encode()
+            assert pak_zip.read('old.txt') == b'Old file'
+            assert pak_zip.read('readme.txt') == b'Custom data'
+
+
+def test_pack_into_zip_stored(bsp_path: Path, monkeypatch) -> None:
+    """If nothing needs compressing, no threads are started."""
+    def no_pool(max_workers=None) -> None:
+        """Threads shouldn't be required."""
+        raise AssertionError('Thread pool created!')
+
+    monkeypatch.setattr(packlist_mod, 'ThreadPoolExecutor', no_pool)
+    packlist = PackList(FileSystemChain(VirtualFileSystem({'readme.txt': 'Readme'})))
+    packlist.pack_file('readme.txt')
+    with BSP(bsp_path) as bsp:
+        packlist.pack_into_zip(bsp)
+        with bsp.packfile() as pak_zip:
+            assert pak_zip.read('readme.txt') == b'Readme'
+
+
+def test_pack_into_zip_reproducible(bsp_path: Path, monkeypatch) -> None:
+    """Packing is independent of order and time, and duplicates are compressed once."""
+    files = {
+        'materials/a.vmt': 'Material' * 100,
+        'materials/b.vmt': 'Material' * 100,
+        'materials/c.vtf': 'Material' * 100,
+        'scripts/z.txt': 'Different',
+    }
+    compressed = []
+    orig_compress = packlist_mod._compress_entry
+
+    def compress_entry(info, source, level) -> bytes:
+        """Record which files were compressed."""
+        compressed.append(info.filename)
+        return orig_compress(info, source, level)
+
+    monkeypatch.setattr(packlist_mod, '_compress_entry', compress_entry)
+
+    results = []
+    for order, max_workers in [(sorted(files), 1), (sorted(files, reverse=True), 4)]:
+        packlist = PackList(FileSystemChain(VirtualFileSystem(files)))
+        for filename in order:
+            packlist.pack_file(filename)
+        with BSP(bsp_path) as bsp:
+            packlist.pack_into_zip(
+                bsp,
+                compression=COMPRESSION_POLICY_LZMA,
+                max_workers=max_workers,
+                dedup=True,
+                reproducible=True,
+            )
+            results.append(bsp.lumps[BSP_LUMPS.PAKFILE].data)
+
+    assert results[0] == results[1]
+    # B is the same as A, and C is stored.
+    assert compressed == ['materials/a.vmt', 'scripts/z.txt'] * 2
+    with zipfile.ZipFile(io.BytesIO(results[0])) as pak_zip:
+        assert pak_zip.testzip() is None
+        assert pak_zip.namelist() == [
+            'materials/a.vmt',
+            'materials/b.vmt',
+            'materials/c.vtf',
+            'materials/maps/rot_main/cubemapdefault.hdr.vtf',
+            'materials/maps/rot_main/cubemapdefault.vtf',
+            'scripts/z.txt',
+        ]
+        for info in pak_zip.infolist():
+            assert info.date_time == (1980, 1, 1, 0, 0, 0)
+        assert pak_zip.read('materials/b.vmt') == files['materials/b.vmt'].encode()
@@ -0,0 +1,217 @@
+"""Test parts of the propcombine compiler."""
+import os
+import random
+from pathlib import Path
+
+import pytest
+
+from srctools import Vec, Angle, Matrix, VMF
+from srctools.bsp import StaticProp
+from srctools.compiler import propcombine
+from srctools.compiler.propcombine import (
+    QC, MAX_GROUP, ConvexVolume,
+    load_qcs, load_cache, save_cache,
+    group_props_auto, group_props_ent, bsp_collision, bsp_collision_bulk,
+)
+
+
+QC_TEXT = '''\
+$modelname "props/{name}.mdl"
+$scale 2
+$body body "{name}_ref.smd"
+$collisionmodel "{name}_phy.smd" {{
+    $concave
+}}
+'''
+
+
+def test_load_qcs_cache(tmp_path: Path, monkeypatch) -> None:
+    """QCs are only parsed again once modified."""
+    folder = tmp_path / 'content'
+    (folder / 'sub').mkdir(parents=True)
+    (folder / 'crate.qc').write_text(QC_TEXT.format(name='crate'))
+    (folder / 'sub' / 'barrel.qc').write_text(QC_TEXT.format(name='barrel'))
+    (folder / 'sub' / 'ragdoll.qc').write_text(
+        QC_TEXT.format(name='ragdoll') + '$ikchain "foot" "bip_foot"\n'
+    )
+
+    parsed = []
+    orig_parse = propcombine.parse_qc
+
+    def parse_qc(qc_loc: Path, qc_path: Path):
+        """Record which QCs are parsed."""
+        parsed.append(qc_path.name)
+        return orig_parse(qc_loc, qc_path)
+
+    monkeypatch.setattr(propcombine, 'parse_qc', parse_qc)
+
+    qc_map = {}
+    cache = {}
+    load_qcs(qc_map, folder, cache, {})
+    assert sorted(parsed) == ['barrel.qc', 'crate.qc', 'ragdoll.qc']
+    assert qc_map.keys() == {'models/props/crate.mdl', 'models/props/barrel.mdl'}
+    crate = qc_map['models/props/crate.mdl']
+    assert crate == QC(
+        str(folder / 'crate.qc').replace('\\', '/'),
+        str(folder / 'crate_ref.smd').replace('\\', '/'),
+        str(folder / 'crate_phy.smd').replace('\\', '/'),
+        2.0, 2.0,
+    )
+    # Dynamic models are cached too.
+    assert len(cache) == 3
+
+    cache_file = tmp_path / 'cache.bin'
+    save_cache(cache_file, cache, {'models/props/crate.mdl': (1, ('metal',))})
+    prev_qc_cache, prev_mdl_cache = load_cache(cache_file)
+    assert prev_qc_cache == cache
+    assert prev_mdl_cache == {'models/props/crate.mdl': (1, ('metal',))}
+
+    parsed.clear()
+    (folder / 'crate.qc').write_text(QC_TEXT.format(name='box'))
+    os.utime(folder / 'crate.qc', ns=(0, 0))
+    (folder / 'sub' / 'barrel.qc').unlink()
+    qc_map = {}
+    cache = {}
+    load_qcs(qc_map, folder, cache, prev_qc_cache)
+    assert parsed == ['crate.qc']
+    assert qc_map.keys() == {'models/props/box.mdl'}
+    # Deleted files are removed.
+    assert len(cache) == 2
+
+
+def test_load_cache_invalid(tmp_path: Path, monkeypatch) -> None:
+    """Missing, invalid or outdated caches are ignored."""
+    cache_file = tmp_path / 'cache.bin'
+    assert load_cache(cache_file) == ({}, {})
+    cache_file.write_bytes(b'not a pickle')
+    assert load_cache(cache_file) == ({}, {})
+    save_cache(cache_file, {'a.qc': ((1, 2), None)}, {})
+    assert load_cache(cache_file) == ({'a.qc': ((1, 2), None)}, {})
+    monkeypatch.setattr(propcombine, 'CACHE_VERSION', propcombine.CACHE_VERSION + 1)
+    assert load_cache(cache_file) == ({}, {})
+
+
+def group_props_scan(props, rejected, dist: float, min_cluster: int):
+    """Group props by checking every remaining prop, in order."""
+    todo = list(props)
+    while todo:
+        center = todo.pop(0)
+        cluster = [center]
+        for prop in todo:
+            if (center.origin - prop.origin).mag_sq() <= 4 * dist * dist:
+                cluster.append(prop)
+                if len(cluster) > MAX_GROUP:
+                    break
+        if len(cluster) < min_cluster:
+            rejected.append(center)
+            continue
+        bbox_min, bbox_max = Vec.bbox(prop.origin for prop in cluster)
+        center_pos = (bbox_min + bbox_max) / 2
+        cluster_list = sorted([
+            (prop, (center_pos - prop.origin).mag_sq())
+            for prop in cluster
+            if (center_pos - prop.origin).mag_sq() <= dist * dist
+        ], key=lambda t: t[1])
+        selected = [prop for prop, off in cluster_list[:MAX_GROUP]]
+        todo = [prop for prop in todo if prop not in selected]
+        if len(selected) >= min_cluster:
+            yield selected
+        else:
+            rejected.extend(selected)
+
+
+@pytest.mark.parametrize('dist, min_cluster', [(64.0, 2), (200.0, 3), (0.0, 2)])
+def test_group_props_auto(dist: float, min_cluster: int) -> None:
+    """The grid produces the same clusters as checking every prop."""
+    rand = random.Random(42)
+    props = [
+        StaticProp(
+            'models/props/grass.mdl',
+            Vec(rand.randint(-1024, 1024), rand.randint(-1024, 1024), rand.choice([0, 32])),
+            Vec(), 1.0, [], 6,
+        ) for _ in range(600)
+    ]
+    # Some props at the same location.
+    props += [
+        StaticProp('models/props/grass.mdl', Vec(48, 48, 0), Vec(), 1.0, [], 6)
+        for _ in range(30)
+    ]
+    rand.shuffle(props)
+    other = StaticProp('models/props/rock.mdl', Vec(), Vec(), 1.0, [], 6)
+
+    expected_rejected = []
+    expected = list(group_props_scan(props, expected_rejected, dist, min_cluster))
+    expected_rejected.append(other)
+    rejected = []
+    groups = list(group_props_auto({1: props, 2: [other]}, rejected, dist, min_cluster))
+    assert groups == expected
+    assert rejected == expected_rejected
+    assert len(groups) > 1
+
+
+def test_bsp_collision_bulk() -> None:
+    """Bulk classification matches checking each point against each volume."""
+    rand = random.Random(1234)
+    volumes = [
+        ConvexVolume.from_box(
+            Vec(rand.uniform(-512, 512), rand.uniform(-512, 512), rand.uniform(-64, 64)),
+            Matrix.from_angle(Angle(rand.choice([0, 15, 45]), rand.uniform(0, 360), 0)),
+            Vec(-rand.uniform(1, 256), -rand.uniform(1, 256), -rand.uniform(1, 64)),
+            Vec(rand.uniform(1, 256), rand.uniform(1, 256), rand.uniform(1, 64)),
+        ) for _ in range(40)
+    ]
+    points = [
+        Vec(rand.uniform(-768, 768), rand.uniform(-768, 768), rand.uniform(-128, 128))
+        for _ in range(2000)
+    ]
+    # Points right on the edges of a box.
+    first = volumes[0]
+    for pos, norm in first.planes:
+        points.append(pos - 0.09 * norm)
+        points.append(pos + 0.09 * norm)
+        points.append(pos + 0.11 * norm)
+
+    result = bsp_collision_bulk(points, volumes)
+    assert result == [
+        [ind for ind, point in enumerate(points) if bsp_collision(point, volume.planes)]
+        for volume in volumes
+    ]
+    assert any(result)
+    assert bsp_collision_bulk([], volumes) == [[]] * len(volumes)
+
+
+def test_group_props_ent() -> None:
+    """Props are grouped by the propcombine sets containing them."""
+    vmf = VMF()
+    for ind, (name, origin, angles) in enumerate([
+        ('first', '0 0 0', '0 45 0'),
+        ('first', '256 0 0', '0 0 0'),
+        ('second', '0 512 0', '0 0 0'),
+        ('', '0 -512 0', '0 0 0'),
+    ]):
+        vmf.create_ent(
+            'comp_propcombine_set', hammerid=ind + 1,
+            name=name, origin=origin, angles=angles,
+            mins='-64 -64 -64', maxs='64 64 64',
+        )
+    props = [
+        StaticProp('models/props/crate.mdl', Vec(x, y, 0), Vec(), 1.0, [], 6)
+        for x, y in [
+            (0, 0), (60, 60), (256, 32), (-32, -32),
+            (0, 512), (32, 512), (1024, 0),
+            (0, -512),
+        ]
+    ]
+    unsolid = StaticProp('models/props/crate.mdl', Vec(0, 512), Vec(), 1.0, [], 0)
+    key = (frozenset(), 6)
+    prop_groups = {key: props.copy(), (frozenset(), 0): [unsolid], None: []}
+
+    rejected = []
+    groups = list(group_props_ent(
+        prop_groups, rejected,
+        lambda mdl: (None, None),
+        list(vmf.by_class['comp_propcombine_set']), 2,
+    ))
+    # (60, 60) is outside the rotated box, but inside its bounding box.
+    assert groups == [[props[0], props[2], props[3]], [props[4], props[5]]]
+    assert rejected == [unsolid, props[1], props[6], props[7]]
@@ -0,0 +1,207 @@
+"""Test the SMD parser and array-based meshes."""
+import io
+import os
+from pathlib import Path
+
+import pytest
+
+from srctools import Vec, Angle, Matrix
+from srctools.smd import Mesh, ArrayMesh, ParseError
+
+
+SMD_TEXT = b'''\
+version 1
+nodes
+0 "root" -1
+1 "child" 0
+end
+skeleton
+time 0
+0 0.000000 0.000000 0.000000  0.000000 0.000000 0.000000
+1 1.000000 0.000000 0.000000  0.000000 0.000000 0.000000
+end
+triangles
+metal/wall
+0\t1.5 -2.25 3.0\t0.0 0.0 1.0\t0.0 1.0 0
+0\t-4.0 5.0 -6.125\t0.0 1.0 0.0\t0.5 0.25 1 1 0.25
+1\t7.0 8.0 9.0\t1.0 0.0 0.0\t1.0 0.0 0
+dev/dev_measuregeneric01
+0\t0.0 0.0 0.0\t0.0 0.0 -1.0\t0.0 0.0 0
+0\t16.0 0.0 0.0\t0.0 0.0 -1.0\t1.0 0.0 0
+0\t0.0 16.0 0.0\t0.0 0.0 -1.0\t0.0 1.0 0
+metal/wall
+1\t2.0 3.0 4.0\t0.6 0.8 0.0\t0.125 0.75 0
+1\t3.0 4.0 5.0\t0.6 0.8 0.0\t0.125 0.75 0
+1\t4.0 5.0 6.0\t0.6 0.8 0.0\t0.125 0.75 0
+end
+'''
+
+
+def parse() -> Mesh:
+    """Parse the sample mesh."""
+    return Mesh.parse_smd(io.BytesIO(SMD_TEXT))
+
+
+def export(mesh: Mesh) -> bytes:
+    """Export a mesh to bytes, for comparisons."""
+    buf = io.BytesIO()
+    mesh.export(buf)
+    return buf.getvalue()
+
+
+def test_array_roundtrip() -> None:
+    """Converting to and from arrays is lossless."""
+    mesh = parse()
+    arr = ArrayMesh.from_mesh(mesh)
+    assert len(arr) == 3
+    assert arr.materials == ['wall', 'dev_measuregeneric01']
+    assert list(arr.tri_mats) == [0, 1, 0]
+    assert list(arr.positions[:6]) == [1.5, -2.25, 3.0, -4.0, 5.0, -6.125]
+    assert list(arr.uvs[:4]) == [0.0, 1.0, 0.5, 0.25]
+    # The second vertex has two weights.
+    assert list(arr.link_offsets[:4]) == [0, 1, 3, 4]
+    assert [arr.bone_list[ind].name for ind in arr.link_bones[:4]] == ['root', 'child', 'root', 'child']
+    assert list(arr.link_weights[:4]) == [1.0, 0.25, 0.75, 1.0]
+
+    result = arr.to_mesh()
+    assert export(result) == export(mesh)
+    for orig_tri, new_tri in zip(mesh.triangles, result.triangles):
+        assert orig_tri.mat == new_tri.mat
+        for orig_vert, new_vert in zip(orig_tri, new_tri):
+            assert tuple(orig_vert.pos) == tuple(new_vert.pos)
+            assert tuple(orig_vert.norm) == tuple(new_vert.norm)
+            assert orig_vert.links == new_vert.links
+    assert arr.bbox() == (Vec(-4.0, -2.25, -6.125), Vec(16.0, 16.0, 9.0))
+
+
+@pytest.mark.parametrize('rotation, offset, scale', [
+    (None, Vec(), 1.0),
+    (Angle(0, 90, 0), Vec(), 1.0),
+    (Matrix.from_angle(Angle(45, 30, 15)), Vec(64, -32, 8), 2.5),
+    (Angle(0, 0, 90), Vec(0, 0, 128), 0.5),
+], ids=['identity', 'yaw', 'all', 'roll'])
+def test_array_append(rotation, offset: Vec, scale: float) -> None:
+    """Appending and transforming arrays matches the regular mesh."""
+    mesh = Mesh.blank('static_prop')
+    mesh.append_model(parse(), rotation, offset, scale)
+    mesh.append_model(Mesh.build_bbox('static_prop', 'phy', Vec(-8, -8, 0), Vec(8, 8, 32)), rotation)
+
+    arr = ArrayMesh.blank('static_prop')
+    arr.append_model(ArrayMesh.from_mesh(parse()), rotation, offset, scale)
+    bbox = ArrayMesh.from_mesh(Mesh.build_bbox('static_prop', 'phy', Vec(-8, -8, 0), Vec(8, 8, 32)))
+    arr.append_model(bbox, rotation)
+    assert len(arr) == 3 + 12
+    assert export(arr.to_mesh()) == export(mesh)
+
+    # Transforming in place matches too.
+    mesh = parse()
+    for tri in mesh.triangles:
+        for vert in tri:
+            vert.norm @= Matrix.from_angle(Angle(0, 90, 0))
+            vert.pos *= scale
+            vert.pos.localise(offset, Angle(0, 90, 0))
+    arr = ArrayMesh.from_mesh(parse())
+    copy = arr.copy()
+    arr.transform(Angle(0, 90, 0), offset, scale)
+    assert export(arr.to_mesh()) == export(mesh)
+    assert export(copy.to_mesh()) == export(parse())
+
+
+def test_array_rename_materials() -> None:
+    """Materials can be swapped, like for skins."""
+    arr = ArrayMesh.from_mesh(parse())
+    arr.rename_materials({'wall': 'floor'})
+    assert [tri.mat for tri in arr.to_mesh().triangles] == ['floor', 'dev_measuregeneric01', 'floor']
+
+
+def test_array_parse() -> None:
+    """Parsing directly into arrays matches converting a parsed mesh."""
+    mesh = parse()
+    orig = ArrayMesh.from_mesh(mesh)
+    arr = ArrayMesh.parse_smd(io.BytesIO(SMD_TEXT))
+    assert arr.bone_list == orig.bone_list
+    assert arr.materials == orig.materials
+    for attr in [
+        'tri_mats', 'positions', 'normals', 'uvs',
+        'link_offsets', 'link_bones', 'link_weights',
+    ]:
+        assert getattr(arr, attr) == getattr(orig, attr), attr
+    assert export(arr) == export(mesh)
+    assert export(ArrayMesh.blank('root')) == export(Mesh.blank('root'))
+
+
+def test_parse_section_order() -> None:
+    """The triangles section can come before the skeleton."""
+    nodes, rest = SMD_TEXT.split(b'skeleton\n')
+    skeleton, triangles = rest.split(b'triangles\n')
+    data = nodes + b'triangles\n' + triangles + b'skeleton\n' + skeleton
+    mesh = Mesh.parse_smd(io.BytesIO(data))
+    assert export(mesh) == export(parse())
+    arr = ArrayMesh.parse_smd(io.BytesIO(data))
+    assert export(arr) == export(parse())
+    assert arr.animation.keys() == mesh.animation.keys() == {0}
+
+
+@pytest.mark.parametrize('line, message', [
+    (b'0\t1.5 -2.25 3.0\t0.0 0.0 1.0\t0.0 1.0 0', 'Incomplete triangles'),
+    (b'0\t1.5 -2.25 3.0\t0.0 0.0 1.0\t0.0 1.0 0\n0\t1 2 3\t0 0 1\t0 1\n0\t1 2 3\t0 0 1\t0 1', 'No end'),
+    (b'0\t1.5 -2.25 3.0\t0.0 0.0 1.0\t0.0 1.0 0\n0\t1 2 3\t0 0 1\t0 1\n0\t1 2 3\t0 0 1\tu 1\nend', 'texture UV'),
+    (b'0\t1.5 -2.25 3.0\t0.0 0.0 1.0\t0.0 1.0 0\n0\t1 2 3\t0 x 1\t0 1\n0\t1 2 3\t0 0 1\t0 1\nend', 'normal or position'),
+    (b'0\t1.5 -2.25 3.0\t0.0 0.0 1.0\t0.0 1.0 0\n0\t1 2 3\t0 0 1\t0 1\n2\t1 2 3\t0 0 1\t0 1\nend', 'Invalid bone'),
+    (b'0\t1.5 -2.25 3.0\t0.0 0.0 1.0\t0.0 1.0 0\n0\t1 2 3\t0 0 1\t0 1\n0\t1 2 3\t0 0 1\t0 1 2 1 0.5\nend', 'Extra weight'),
+])
+def test_array_parse_errors(line: bytes, message: str) -> None:
+    """Invalid triangles produce the same errors as the regular parser."""
+    data = SMD_TEXT.split(b'triangles')[0] + b'triangles\nmetal/wall\n' + line + b'\n'
+    with pytest.raises(ParseError, match=message):
+        Mesh.parse_smd(io.BytesIO(data))
+    with pytest.raises(ParseError, match=message):
+        ArrayMesh.parse_smd(io.BytesIO(data))
+
+
+def test_array_parse_cache(tmp_path: Path, monkeypatch) -> None:
+    """Parsed meshes can be cached, and are parsed again once modified."""
+    smd = tmp_path / 'model.smd'
+    smd.write_bytes(SMD_TEXT)
+    cache = tmp_path / 'cache'
+
+    parse_count = 0
+    orig_parse = ArrayMesh.parse_smd.__func__
+
+    def parse_smd(cls, file) -> ArrayMesh:
+        """Count the number of times the file is parsed."""
+        nonlocal parse_count
+        parse_count += 1
+        return orig_parse(cls, file)
+
+    monkeypatch.setattr(ArrayMesh, 'parse_smd', classmethod(parse_smd))
+
+    assert export(ArrayMesh.parse_file(smd)) == export(parse())
+    assert parse_count == 1
+    assert not cache.exists()
+    first = ArrayMesh.parse_file(smd, cache)
+    assert parse_count == 2
+    assert len(list(cache.iterdir())) == 1
+    second = ArrayMesh.parse_file(smd, cache)
+    assert parse_count == 2
+    assert second is not first
+    assert export(second) == export(first)
+    assert second.bones['child'].parent is second.bones['root']
+    assert second.bone_list == [second.bones['root'], second.bones['child']]
+    [frame] = [
+        frame for frame in second.animation[0]
+        if frame.bone is second.bones['child']
+    ]
+    assert frame.position == Vec(1, 0, 0)
+
+    smd.write_bytes(SMD_TEXT.split(b'triangles')[0])
+    os.utime(smd, ns=(0, 0))
+    assert len(ArrayMesh.parse_file(smd, cache)) == 0
+    assert parse_count == 3
+    assert len(ArrayMesh.parse_file(smd, cache)) == 0
+    assert parse_count == 3
+
+    [cache_file] = cache.iterdir()
+    cache_file.write_bytes(b'garbage')
+    assert len(ArrayMesh.parse_file(smd, cache)) == 0
+    assert parse_count == 4
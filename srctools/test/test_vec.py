@@ -1039,3 +1039,12 @@ def test_cross_product_axes(py_c_vec):
     assert_vec(Vec.cross(Vec(y=1), Vec(x=1)), 0, 0, -1)
     assert_vec(Vec.cross(Vec(z=1), Vec(x=1)), 0, 1, 0)
     assert_vec(Vec.cross(Vec(z=1), Vec(y=1)), -1, 0, 0)
+
+
+def test_to_matrix_identity() -> None:
+    """to_matrix(None) produces the identity, of the Matrix type in use."""
+    mat = vec_mod.to_matrix(None)
+    assert type(mat) is vec_mod.Matrix
+    vec = vec_mod.Vec(1, 2, 3)
+    vec @= mat
+    assert vec == vec_mod.Vec(1, 2, 3)
@@ -1,5 +1,7 @@
 """Tests for the VMF library."""
-from srctools.vmf import Entity, VMF
+import io
+
+from srctools.vmf import Entity, EntityKeys, VMF
 from pytest import raises
 
 
@@ -85,3 +87,61 @@ def test_fixup_substitution() -> None:
     ent.fixup['$a_var_with*_[]_regex'] = 'ignored'
     assert ent.fixup.substitute('V = $a_var_with*_[]_regex') == 'V = ignored'
 
+
+
+def test_entity_keys() -> None:
+    """Test keyvalues are case-insensitive, but keep the original case."""
+    vmf = VMF()
+    ent = vmf.create_ent('info_target', TargetName='first', origin='0 0 0')
+    assert isinstance(ent.keys, EntityKeys)
+    assert ent['targetname'] == 'first'
+    assert ent['TARGETNAME'] == 'first'
+    assert ent['missing'] == ''
+    assert ent['missing', 'default'] == 'default'
+    assert ent.get('ORIGIN') == '0 0 0'
+    assert 'targetNAME' in ent
+    assert 'missing' not in ent
+
+    ent['targetname'] = 'second'
+    ent['SpawnFlags'] = 4
+    ent['startDisabled'] = True
+    assert list(ent.keys) == ['TargetName', 'origin', 'classname', 'SpawnFlags', 'startDisabled']
+    assert list(ent.keys.values()) == ['second', '0 0 0', 'info_target', '4', '1']
+    assert list(ent.keys.items()) == list(zip(ent.keys.keys(), ent.keys.values()))
+    assert ent.keys == {
+        'classname': 'info_target', 'TargetName': 'second', 'origin': '0 0 0',
+        'SpawnFlags': '4', 'startDisabled': '1',
+    }
+    assert vmf.by_target['second'] == {ent}
+    assert not vmf.by_target['first']
+
+    buf = io.StringIO()
+    ent.export(buf)
+    assert '"TargetName" "second"' in buf.getvalue()
+    assert '"SpawnFlags" "4"' in buf.getvalue()
+
+    # The mapping can also be used directly, like a dict.
+    assert ent.keys['spawnflags'] == '4'
+    with raises(KeyError):
+        ent.keys['missing']
+    assert ent.keys.get('missing') is None
+    assert ent.keys.pop('STARTDISABLED') == '1'
+    assert ent.keys.pop('startdisabled', 'default') == 'default'
+    del ent.keys['SPAWNFLAGS']
+    assert 'spawnflags' not in ent.keys
+    assert len(ent.keys) == 3
+
+    del ent['TARGETNAME']
+    assert 'targetname' not in ent
+    assert vmf.by_target[None] == {ent}
+    del ent['missing']
+
+    copy = ent.copy()
+    copy['origin'] = '1 2 3'
+    assert ent['origin'] == '0 0 0'
+    assert copy.keys == {'classname': 'info_target', 'origin': '1 2 3'}
+
+    ent.keys = {'Model': 'models/error.mdl', 'model': 'models/other.mdl'}
+    assert ent.keys == {'Model': 'models/other.mdl'}
+    ent.clear_keys()
+    assert len(ent.keys) == 0
@@ -0,0 +1,386 @@
+"""Test the VPK reader and directory index."""
+import hashlib
+import io
+import mmap
+import os
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from srctools.filesys import VPKFileSystem
+from srctools import vpk as vpk_mod
+from srctools.vpk import VPK, VPKIndex, ViewFile, get_index_filename
+
+
+FILES = {
+    'materials/Tools/ToolsNodraw.vmt': b'LightmappedGeneric\n{\n}\n',
+    'materials/tools/toolsskip.vmt': b'UnlitGeneric {}' * 200,
+    'models/props/cube.mdl': bytes(range(256)) * 16,
+    'readme.txt': b'A VPK for testing.',
+    'scripts/empty.txt': b'',
+    'noext': b'No extension.',
+}  # type: Dict[str, bytes]
+
+
+@pytest.fixture
+def vpk_path(tmp_path: Path) -> Path:
+    """Write a small VPK to a temporary location."""
+    path = tmp_path / 'pak01_dir.vpk'
+    with VPK(path, mode='w', dir_data_limit=64) as vpk:
+        for filename, data in FILES.items():
+            vpk.add_file(filename, data)
+    return path
+
+
+def test_read(vpk_path: Path) -> None:
+    """Test reading back the files from the VPK."""
+    vpk = VPK(vpk_path)
+    assert len(vpk) == len(FILES)
+    assert sorted(vpk.filenames()) == sorted(FILES)
+    for filename, data in FILES.items():
+        assert vpk[filename].read() == data
+    assert vpk.verify_all()
+
+
+def test_add_files(tmp_path: Path) -> None:
+    """Test writing files in a batch."""
+    src = tmp_path / 'source.bin'
+    src.write_bytes(b'From disk. ' * 20)
+    path = tmp_path / 'pak01_dir.vpk'
+    with VPK(path, mode='w', dir_data_limit=16) as vpk:
+        vpk.add_files([
+            ('first.bin', b'A' * 100),
+            ('copy/first.bin', b'A' * 100),
+            ('second.bin', b'B' * 100),
+            ('small.txt', b'Tiny'),
+            ('disk.bin', src),
+            ('third.bin', b'C' * 200),
+        ], max_arch_size=200, max_workers=2)
+        first, copy, second = vpk['first.bin'], vpk['copy/first.bin'], vpk['second.bin']
+        # Identical data is only stored once.
+        assert (copy.arch_index, copy.offset) == (first.arch_index, first.offset)
+        assert (first.arch_index, first.offset) == (0, 0)
+        assert (second.arch_index, second.offset) == (0, 84)
+        assert vpk['small.txt'].arch_index is None
+        # Archive 0 is full, so these have to go into the next archives.
+        assert (vpk['disk.bin'].arch_index, vpk['disk.bin'].offset) == (1, 0)
+        assert (vpk['third.bin'].arch_index, vpk['third.bin'].offset) == (2, 0)
+
+        # Existing files are detected before anything is written.
+        with pytest.raises(FileExistsError):
+            vpk.add_files([('new.bin', b'data'), ('first.bin', b'data')])
+        assert 'new.bin' not in vpk
+        # Files after an error are not added.
+        with pytest.raises(FileNotFoundError):
+            vpk.add_files([
+                ('new.bin', b'data'),
+                ('missing.bin', tmp_path / 'missing.bin'),
+                ('after.bin', b'data'),
+            ], max_workers=1)
+        assert vpk['new.bin'].read() == b'data'
+        assert 'missing.bin' not in vpk
+        assert 'after.bin' not in vpk
+
+    assert (tmp_path / 'pak01_000.vpk').stat().st_size == 168
+    vpk = VPK(path)
+    assert vpk['first.bin'].read() == b'A' * 100
+    assert vpk['copy/first.bin'].read() == b'A' * 100
+    assert vpk['small.txt'].read() == b'Tiny'
+    assert vpk['disk.bin'].read() == b'From disk. ' * 20
+    assert vpk['third.bin'].read() == b'C' * 200
+    assert vpk.verify_all()
+    vpk.close()
+
+
+def test_add_folder(tmp_path: Path) -> None:
+    """Test adding a folder of files."""
+    folder = tmp_path / 'content'
+    (folder / 'sub').mkdir(parents=True)
+    (folder / 'root.txt').write_bytes(b'Root file')
+    (folder / 'sub' / 'nested.txt').write_bytes(b'Nested file')
+    path = tmp_path / 'pak01_dir.vpk'
+    with VPK(path, mode='w', dir_data_limit=0) as vpk:
+        vpk.add_folder(str(folder), prefix='scripts')
+    vpk = VPK(path)
+    assert sorted(vpk.filenames()) == ['scripts/root.txt', 'scripts/sub/nested.txt']
+    assert vpk['scripts/sub/nested.txt'].read() == b'Nested file'
+    vpk.close()
+
+
+def check_v2_checksums(path: Path) -> int:
+    """Independently verify the MD5 sections of a V2 VPK.
+
+    This returns the number of archive chunks.
+    """
+    data = path.read_bytes()
+    sig, version, tree_size, data_size, arch_md5_size, other_size, sig_size = struct.unpack_from('<7I', data)
+    assert version == 2
+    assert other_size == 48
+    assert sig_size == 0
+    tree_start = 28
+    arch_md5_start = tree_start + tree_size + data_size
+    other_start = arch_md5_start + arch_md5_size
+    assert len(data) == other_start + 48
+
+    arch_md5 = data[arch_md5_start:other_start]
+    for arch_index, offset, length, md5 in struct.iter_unpack('<III16s', arch_md5):
+        arch_path = path.with_name('pak01_{:03}.vpk'.format(arch_index))
+        with open(arch_path, 'rb') as f:
+            f.seek(offset)
+            assert hashlib.md5(f.read(length)).digest() == md5, (arch_index, offset)
+
+    assert data[other_start:other_start + 16] == hashlib.md5(data[tree_start:tree_start + tree_size]).digest()
+    assert data[other_start + 16:other_start + 32] == hashlib.md5(arch_md5).digest()
+    assert data[other_start + 32:] == hashlib.md5(data[:other_start + 32]).digest()
+    return len(arch_md5) // 28
+
+
+def test_write_v2(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test writing V2 VPKs, and the checksums."""
+    monkeypatch.setattr(vpk_mod, 'ARCHIVE_MD5_CHUNK', 64)
+    path = tmp_path / 'pak01_dir.vpk'
+    with VPK(path, mode='w', version=2, dir_data_limit=8) as vpk:
+        vpk.add_files([
+            ('first.bin', bytes(range(200))),
+            ('second.bin', b'second' * 30),
+        ], max_arch_size=250)
+        vpk.add_file('third.bin', b'third' * 9, arch_index=1)
+    # Archive 0 has 192 bytes, archive 1 has 172 + 37 bytes.
+    assert check_v2_checksums(path) == 3 + 4
+
+    with VPK(path, mode='a', dir_data_limit=8) as vpk:
+        assert vpk.version == 2
+        assert vpk['first.bin'].read() == bytes(range(200))
+        assert vpk['third.bin'].read() == b'third' * 9
+        vpk.add_file('fourth.bin', b'fourth' * 20, arch_index=0)
+    # 112 more bytes in archive 0.
+    assert check_v2_checksums(path) == 5 + 4
+
+    # Convert a V1 VPK, all the data needs to be read.
+    with VPK(path, mode='a') as vpk:
+        vpk.version = 1
+    assert struct.unpack_from('<I', path.read_bytes(), 4)[0] == 1
+    with VPK(path, mode='a') as vpk:
+        vpk.version = 2
+    assert check_v2_checksums(path) == 5 + 4
+
+    vpk = VPK(path)
+    assert vpk.version == 2
+    assert vpk['fourth.bin'].read() == b'fourth' * 20
+    assert vpk.verify_all()
+    vpk.close()
+
+
+def test_archive_pool(tmp_path: Path) -> None:
+    """Archives are kept open, up to the limit."""
+    path = tmp_path / 'pak01_dir.vpk'
+    with VPK(path, mode='w', dir_data_limit=0) as vpk:
+        for i in range(3):
+            vpk.add_file('file{}.txt'.format(i), b'Archive %d' % i, arch_index=i)
+
+    vpk = VPK(path, max_open_archives=2)
+    assert vpk['file0.txt'].read() == b'Archive 0'
+    assert vpk['file1.txt'].read() == b'Archive 1'
+    assert list(vpk._archives) == [0, 1]
+    assert vpk['file0.txt'].read() == b'Archive 0'
+    assert list(vpk._archives) == [1, 0]
+    with vpk['file2.txt'].read_view() as view:
+        assert view == b'Archive 2'
+        # Zero-copy, a view into the archive.
+        assert isinstance(view.obj, mmap.mmap)
+        assert list(vpk._archives) == [0, 2]
+        # Closing while the view is in use keeps the mapping valid.
+        vpk.close()
+        assert vpk._archives == {}
+        assert view.tobytes() == b'Archive 2'
+    assert vpk.verify_all()
+    vpk.close()
+
+
+def test_archive_pool_threads(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Archives closed by other threads don't break reads in progress."""
+    path = tmp_path / 'pak01_dir.vpk'
+    with VPK(path, mode='w', dir_data_limit=0) as vpk:
+        vpk.add_file('file.txt', b'Archive data', arch_index=0)
+
+    vpk = VPK(path)
+    orig_get_archive = VPK._get_archive
+
+    def get_archive(self: VPK, index: int) -> mmap.mmap:
+        """Try to close the archive from another thread, as soon as it's returned."""
+        arch_map = orig_get_archive(self, index)
+        thread = threading.Thread(target=self.close)
+        thread.start()
+        # If the lock is held, this times out and the close happens later.
+        thread.join(0.1)
+        threads.append(thread)
+        return arch_map
+
+    threads = []
+    monkeypatch.setattr(VPK, '_get_archive', get_archive)
+    assert vpk['file.txt'].read() == b'Archive data'
+    with vpk['file.txt'].read_view() as view:
+        assert view == b'Archive data'
+    for thread in threads:
+        thread.join()
+    assert len(threads) == 2
+
+
+def test_view_file() -> None:
+    """Test the file object used to read directly from archives."""
+    view = memoryview(b'0123456789')
+    with ViewFile(view) as f:
+        assert f.readable() and f.seekable() and not f.writable()
+        assert f.read(3) == b'012'
+        assert f.tell() == 3
+        assert f.seek(-2, io.SEEK_END) == 8
+        assert f.read() == b'89'
+        assert f.read(5) == b''
+        f.seek(2)
+        buf = bytearray(4)
+        assert f.readinto(buf) == 4
+        assert buf == b'2345'
+        assert f.seek(3, io.SEEK_CUR) == 9
+        assert f.readinto(buf) == 1
+        assert f.getbuffer() == view
+    with pytest.raises(ValueError):
+        f.read()
+    with io.TextIOWrapper(ViewFile(memoryview(b'line 1\r\nline 2'))) as f:
+        assert f.readlines() == ['line 1\n', 'line 2']
+
+
+@pytest.mark.parametrize('processes', [False, True], ids=['threads', 'processes'])
+def test_verify_all(vpk_path: Path, monkeypatch: pytest.MonkeyPatch, processes: bool) -> None:
+    """Test verifying the files in parallel."""
+    # Use small batches, so there are several.
+    monkeypatch.setattr(vpk_mod, 'BATCH_SIZE', 256)
+    vpk = VPK(vpk_path)
+    calls = []
+    executor = ProcessPoolExecutor(2) if processes else None
+    try:
+        report = vpk.verify_all(
+            executor=executor, max_workers=2,
+            progress=lambda done, total: calls.append((done, total)),
+        )
+        assert report
+        assert [res.filename for res in report] == sorted(FILES)
+        assert calls[-1] == (len(FILES), len(FILES))
+        assert len(calls) > 1
+
+        # Corrupt one file.
+        cube = vpk['models/props/cube.mdl']
+        with open(vpk_path.with_name('pak01_000.vpk'), 'r+b') as f:
+            f.seek(cube.offset + 10)
+            f.write(b'\xff\xff')
+        report = vpk.verify_all(executor=executor)
+        assert not report
+        assert report.failures == [vpk_mod.FileResult('models/props/cube.mdl', False)]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def test_extract_all(vpk_path: Path, tmp_path: Path) -> None:
+    """Test extracting all the files."""
+    dest = tmp_path / 'extracted'
+    calls = []
+    vpk = VPK(vpk_path)
+    report = vpk.extract_all(str(dest), progress=lambda done, total: calls.append(total))
+    assert report
+    assert len(report) == len(FILES)
+    assert calls[-1] == len(FILES)
+    for filename, data in FILES.items():
+        assert (dest / filename).read_bytes() == data
+
+    # Missing archives are reported for each file.
+    os.remove(vpk_path.with_name('pak01_000.vpk'))
+    report = vpk.extract_all(str(dest))
+    assert not report
+    assert {res.filename for res in report.failures} == {
+        filename for filename, data in FILES.items()
+        if len(data) > 64
+    }
+    assert all(isinstance(res.error, FileNotFoundError) for res in report.failures)
+
+
+def test_index(vpk_path: Path, tmp_path: Path) -> None:
+    """The index should match the information in the VPK."""
+    index_path = tmp_path / 'index' / get_index_filename(vpk_path)
+    vpk = VPK(vpk_path)
+    with VPKIndex(vpk_path, index_path) as index:
+        assert len(index) == len(FILES)
+        assert sorted(entry.path for entry in index) == sorted(FILES)
+        for filename, data in FILES.items():
+            entry = index.lookup(filename.upper().replace('/', '\\'))
+            assert entry is not None, filename
+            assert entry.path == filename
+            info = vpk[filename]
+            assert entry.crc == info.crc
+            assert entry.arch_index == info.arch_index
+            assert entry.offset == info.offset
+            assert entry.arch_len == info.arch_len
+            assert entry.preload_len == len(info.start_data)
+            assert index.file_info(entry).read() == data
+        assert 'materials/tools/missing.vmt' not in index
+        assert index.lookup('materials/tools/toolsnodraw.vtf') is None
+        assert index.lookup('materiäls/tools/toolsnodraw.vmt') is None
+    assert index_path.is_file()
+
+
+def test_index_cache(vpk_path: Path, tmp_path: Path) -> None:
+    """The index file is reused, until the VPK is modified."""
+    index_path = tmp_path / 'pak01.vpkidx'
+    VPKIndex(vpk_path, index_path).close()
+    # Make it detectable if the index is rebuilt.
+    os.utime(index_path, ns=(0, 0))
+    with VPKIndex(vpk_path, index_path) as index:
+        assert index._index_map is not None
+        assert 'readme.txt' in index
+    assert index_path.stat().st_mtime_ns == 0
+
+    with VPK(vpk_path, mode='a') as vpk:
+        vpk.add_file('new_file.txt', b'New data')
+
+    with VPKIndex(vpk_path, index_path) as index:
+        assert index._index_map is None
+        assert len(index) == len(FILES) + 1
+        entry = index.lookup('NEW_FILE.txt')
+        assert entry is not None
+        assert index.file_info(entry).read() == b'New data'
+    assert index_path.stat().st_mtime_ns != 0
+
+    # Corrupt index files are also rebuilt.
+    index_path.write_bytes(b'VPKI\x01\x00')
+    with VPKIndex(vpk_path, index_path) as index:
+        assert len(index) == len(FILES) + 1
+
+
+@pytest.mark.parametrize('cached', [False, True], ids=['memory', 'cached'])
+def test_filesystem(vpk_path: Path, tmp_path: Path, cached: bool) -> None:
+    """Test accessing VPKs through the filesystem."""
+    fsys = VPKFileSystem(vpk_path, tmp_path / 'pak01.vpkidx' if cached else None)
+    with fsys:
+        assert 'materials/tools/toolsnodraw.vmt' in fsys
+        assert 'MATERIALS\\TOOLS\\TOOLSSKIP.VMT' in fsys
+        assert 'materials/tools/missing.vmt' not in fsys
+        with pytest.raises(FileNotFoundError):
+            fsys['materials/tools/missing.vmt']
+        file = fsys['Models/Props/Cube.mdl']
+        assert file.path == 'models/props/cube.mdl'
+        with file.open_bin() as f:
+            assert f.read() == FILES['models/props/cube.mdl']
+        with fsys.open_str('readme.txt') as f:
+            assert f.read() == 'A VPK for testing.'
+        assert file.cache_key() == fsys._get_data(file).crc
+        # Only the files we looked at have been parsed.
+        assert len(fsys._name_to_file) == 2
+
+        assert sorted(file.path for file in fsys.walk_folder('materials')) == [
+            'materials/Tools/ToolsNodraw.vmt',
+            'materials/tools/toolsskip.vmt',
+        ]
+        assert len(list(fsys)) == len(FILES)
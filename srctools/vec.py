@@ -101,7 +101,8 @@ def to_matrix(value: Union['Angle', 'Matrix', 'Vec', Tuple3, None]) -> 'Matrix':
     Vectors will be treated as angles, and None as the identity.
     """
     if value is None:
-        return Py_Matrix()
+        # Use the global, so this matches the compiled version if available.
+        return Matrix()
     elif isinstance(value, Matrix):
         return value
     elif isinstance(value, Angle):
@@ -1623,14 +1623,12 @@ class Entity:
         comments: str='',
     ):
         self.map = vmf_file
-        self.keys = {
+        self._keys = EntityKeys()
+        for k, v in keys.items():
             # Ensure all values are strings. This allows passing ints and Vecs
             # normally.
             # If bool (special case), swap to 1/0.
-            k: str(int(v) if isinstance(v, bool) else v)
-            for k, v in
-            keys.items()
-        }  # type: Dict[str, str]
+            self._keys[k] = str(int(v) if isinstance(v, bool) else v)
         self.fixup = EntityFixup(fixup)
         self.outputs = outputs or []  # type: List[Output]
         self.solids = solids or []  # type: List[Solid]
@@ -1645,6 +1643,18 @@ class Entity:
         self.logical_pos = logical_pos or '[0 {}]'.format(self.id)
         self.comments = comments
 
+    @property
+    def keys(self) -> 'EntityKeys':
+        """The keyvalues of the entity, which are case-insensitive.
+
+        Assigning a dict replaces all the keyvalues.
+        """
+        return self._keys
+
+    @keys.setter
+    def keys(self, keys: Mapping[str, str]) -> None:
+        self._keys = EntityKeys(keys)
+
     def copy(
         self,
         des_id: int=-1,
@@ -1653,10 +1663,8 @@ class Entity:
         keep_vis=True,
     ) -> 'Entity':
         """Duplicate this entity entirely, including solids and outputs."""
-        new_keys = {}
+        new_keys = dict(self._keys.items())
         new_fixup = self.fixup.copy_values()
-        for key, value in self.keys.items():
-            new_keys[key] = value
 
         new_solids = [
             solid.copy(vmf_file=vmf_file, side_mapping=side_mapping)
@@ -1792,7 +1800,7 @@ class Entity:
         buffer.write('{}{}\n'.format(ind, ent_name))
         buffer.write(ind + '{\n')
         buffer.write('{}\t"id" "{}"\n'.format(ind, str(self.id)))
-        for key, value in sorted(self.keys.items(), key=operator.itemgetter(0)):
+        for key, value in sorted(self._keys.items(), key=operator.itemgetter(0)):
             buffer.write('{}\t"{}" "{!s}"\n'.format(ind, key, value))
 
         self.fixup.export(buffer, ind)
@@ -1915,12 +1923,7 @@ class Entity:
         else:
             default = ''
 
-        key = key.casefold()
-        for k in self.keys:
-            if k.casefold() == key:
-                return self.keys[k]
-        else:
-            return default
+        return self._keys.get(key, default)
 
     def __setitem__(
         self,
@@ -1936,15 +1939,8 @@ class Entity:
         if isinstance(val, bool):
             val = '1' if val else '0'
         key_fold = key.casefold()
-        for k in self.keys:
-            if k.casefold() == key_fold:
-                # Check case-insensitively for this key first
-                orig_val = self.keys.get(k)
-                self.keys[k] = str(val)
-                break
-        else:
-            orig_val = self.keys.get(key)
-            self.keys[key] = str(val)
+        orig_val = self._keys.get(key_fold)
+        self._keys[key] = str(val)
 
         # Update the by_class/target dicts with our new value
         if key_fold == 'classname':
@@ -1961,21 +1957,19 @@ class Entity:
         if key == 'targetname':
             with suppress(KeyError):
                 self.map.by_target[
-                    self.keys.get('targetname', None)
+                    self._keys.get('targetname', None)
                 ].remove(self)
             self.map.by_target[None].add(self)
 
         if key == 'classname':
             with suppress(KeyError):
                 self.map.by_class[
-                    self.keys.get('classname', None)
+                    self._keys.get('classname', None)
                 ].remove(self)
             self.map.by_class[None].add(self)
 
-        for k in self.keys:
-            if k.casefold() == key:
-                del self.keys[k]
-                break
+        with suppress(KeyError):
+            del self._keys[key]
 
     def get(self, key: str, default: Union[str, T]='') -> Union[str, T]:
         """Allow using [] syntax to search for keyvalues.
@@ -1987,30 +1981,20 @@ class Entity:
         - A tuple can be passed for the default to be set, inside the
           [] syntax.
         """
-        key = key.casefold()
-        for k in self.keys:
-            if k.casefold() == key:
-                return self.keys[k]
-        else:
-            return default
+        return self._keys.get(key, default)
 
     def clear_keys(self) -> None:
         """Remove all keyvalues from an item."""
         # Delete these so the .by_class/name values are cleared.
         del self['targetname']
         del self['classname']
-        self.keys.clear()
+        self._keys.clear()
         # Clear $fixup as well.
         self.fixup.clear()
 
     def __contains__(self, key: str) -> bool:
         """Determine if a value exists for the given key."""
-        key = key.casefold()
-        for k in self.keys:
-            if k.casefold() == key:
-                return True
-        else:
-            return False
+        return key in self._keys
 
     get_key = __contains__
 
@@ -2307,6 +2291,86 @@ class EntityFixup(MutableMapping[str, str]):
         return Vec.from_str(self.get(key), x, y, z)
 
 
+class EntityKeys(MutableMapping[str, str]):
+    """The keyvalues of an entity.
+
+    This treats keys case-insensitively, keeping the first case used for
+    each key when exporting. Unlike EntityFixup, missing keys raise KeyError
+    like a regular dict.
+    """
+    __slots__ = ['_keys']
+
+    def __init__(self, keys: Mapping[str, str]=EmptyMapping) -> None:
+        # Each key is stored as a (key, value) tuple, indexed by the
+        # casefolded key. The original key is kept for exporting.
+        self._keys = {}  # type: Dict[str, Tuple[str, str]]
+        for key, value in keys.items():
+            self[key] = value
+
+    def __len__(self) -> int:
+        """Return the number of keyvalues."""
+        return len(self._keys)
+
+    def __getitem__(self, key: str) -> str:
+        """Retrieve the value of a key, ignoring case."""
+        return self._keys[key.casefold()][1]
+
+    def get(self, key: str, default: T=None) -> Union[str, T]:
+        """Retrieve the value of a key, or the default if not present."""
+        try:
+            return self._keys[key.casefold()][1]
+        except KeyError:
+            return default
+
+    def __contains__(self, key: object) -> bool:
+        """Check if a key is present, ignoring case."""
+        return isinstance(key, str) and key.casefold() in self._keys
+
+    def __setitem__(self, key: str, value: str) -> None:
+        """Set a key. If already present, the original case is kept."""
+        folded = key.casefold()
+        try:
+            key = self._keys[folded][0]
+        except KeyError:
+            pass
+        self._keys[folded] = (key, value)
+
+    def __delitem__(self, key: str) -> None:
+        """Remove a key, ignoring case."""
+        del self._keys[key.casefold()]
+
+    def clear(self) -> None:
+        """Remove all keyvalues."""
+        self._keys.clear()
+
+    def copy(self) -> 'EntityKeys':
+        """Duplicate the keyvalues."""
+        copy = EntityKeys.__new__(EntityKeys)
+        copy._keys = self._keys.copy()
+        return copy
+
+    def keys(self) -> Iterator[str]:
+        """Iterate over all keys."""
+        for key, value in self._keys.values():
+            yield key
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over all keys."""
+        return self.keys()
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        """Iterate over all key-value pairs."""
+        return iter(self._keys.values())
+
+    def values(self) -> Iterator[str]:
+        """Iterate over all values."""
+        for key, value in self._keys.values():
+            yield value
+
+    def __repr__(self) -> str:
+        return '{}({!r})'.format(self.__class__.__name__, dict(self._keys.values()))
+
+
 class EntityGroup:
     """Represents the 'group' blocks in entities.
 
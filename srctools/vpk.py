@@ -1,15 +1,23 @@
-"""Classes for reading and writing Valve's VPK format, version 1."""
+"""Classes for reading and writing Valve's VPK format, versions 1 and 2."""
+import io
 import os
+import mmap
+import hashlib
 import struct
 import operator
+import threading
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Executor, Future, as_completed
 from enum import Enum
 from types import TracebackType
 from typing import (
     Union, Dict, Optional, List, Tuple, Iterator, BinaryIO, IO,
-    Type,
+    Type, NamedTuple, Iterable, Deque, Callable, Any,
 )
 
-from srctools.binformat import checksum, EMPTY_CHECKSUM, struct_read
+from srctools import AtomicWriter
+from srctools.binformat import checksum, EMPTY_CHECKSUM
 
 
 VPK_SIG = 0x55aa1234  # First byte of the file..
@@ -17,6 +25,27 @@ DIR_ARCH_INDEX = 0x7fff  # File index used for the _dir file.
 
 FileName = Union[str, Tuple[str, str], Tuple[str, str, str]]
 
+# The number of archives each VPK keeps mapped by default.
+MAX_OPEN_ARCHIVES = 16
+# Buffer size used when writing archives.
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+# V2 VPKs store the MD5 of each chunk of this size in the archives.
+ARCHIVE_MD5_CHUNK = 1024 * 1024
+# verify_all() and extract_all() split archives into batches of this size.
+BATCH_SIZE = 32 * 1024 * 1024
+
+# Either the data for a file, or a path to read it from.
+FileSource = Union[bytes, str, os.PathLike]
+
+# The header, and the metadata for each file in the directory tree.
+_HEADER = struct.Struct('<III')
+_HEADER_V2 = struct.Struct('<4I')
+_DIR_ENTRY = struct.Struct('<IHHIIH')
+# V2 archive checksums - archive index, offset, length, MD5.
+_ARCHIVE_MD5 = struct.Struct('<III16s')
+# The tree, archive MD5 section and whole file checksums.
+_OTHER_MD5_SIZE = 48
+
 
 class OpenModes(Enum):
     """Modes for opening VPK files."""
@@ -55,6 +84,69 @@ def iter_nullstr(file: BinaryIO) -> Iterator[str]:
             chars.extend(char)
 
 
+def _read_nullstr(data: bytes, pos: int) -> Tuple[bytes, int]:
+    """Read a null-terminated string from a buffer.
+
+    This returns the raw string, and the position after the terminator.
+    """
+    end = data.find(b'\x00', pos)
+    if end == -1:
+        raise Exception('Reached EOF without null-terminator in {!r}!'.format(
+            bytes(data[pos:pos + 64])
+        ))
+    return data[pos:end], end + 1
+
+
+def _iter_dir_tree(data: bytes, pos: int, tree_end: int) -> Iterator[Tuple[
+    str, str, str,
+    int, int, int, Optional[int], int, int,
+]]:
+    """Parse the directory tree from an in-memory copy of the directory file.
+
+    data can be bytes or a mmap, pos is the start of the tree and tree_end
+    the end. This yields (ext, dir, file, crc, preload_offset, preload_len,
+    arch_index, offset, arch_len) tuples, where preload_offset is the location
+    of the data saved into the directory itself.
+    """
+    unpack_entry = _DIR_ENTRY.unpack_from
+    entry_size = _DIR_ENTRY.size
+    # These are in a tree of extension, directory, file. '' terminates a part.
+    while True:
+        ext, pos = _read_nullstr(data, pos)
+        if not ext:
+            return
+        ext = '' if ext == b' ' else ext.decode('ascii')
+        while True:
+            directory, pos = _read_nullstr(data, pos)
+            if not directory:
+                break
+            directory = '' if directory == b' ' else directory.decode('ascii')
+            while True:
+                file, pos = _read_nullstr(data, pos)
+                if not file:
+                    break
+                file = '' if file == b' ' else file.decode('ascii')
+                crc, index_len, arch_ind, offset, arch_len, end = unpack_entry(data, pos)
+                pos += entry_size
+                if arch_ind == DIR_ARCH_INDEX:
+                    arch_ind = None
+
+                if arch_len == 0:
+                    offset = 0
+
+                if end != 0xffff:
+                    raise Exception('"{}" has bad terminator! {}'.format(
+                        _join_file_parts(directory, file, ext),
+                        (crc, index_len, arch_ind, offset, arch_len, end),
+                    ))
+                yield ext, directory, file, crc, pos, index_len, arch_ind, offset, arch_len
+                pos += index_len
+
+        # 1 for the ending b'' section
+        if pos + 1 == tree_end:
+            return
+
+
 def _write_nullstring(file: IO[bytes], string: str) -> None:
     """Write a null-terminated ASCII string back to the file."""
     if string:
@@ -117,6 +209,247 @@ def _join_file_parts(path: str, filename: str, ext: str) -> str:
     return (path + '/' if path else '') + filename + ('.' + ext if ext else '')
 
 
+class ArchiveMD5(NamedTuple):
+    """The checksum of a chunk of an archive, stored in V2 VPKs."""
+    arch_index: int
+    offset: int
+    length: int
+    md5: bytes
+
+
+class _ArchiveHasher:
+    """Incrementally computes the checksums for each chunk of an archive."""
+    def __init__(self, arch_index: int, chunks: Iterable[ArchiveMD5]=()) -> None:
+        self.arch_index = arch_index
+        self._hasher = hashlib.md5()
+        self._chunk_len = 0
+        # Reuse checksums for complete chunks at the start of the file.
+        self.chunks = []  # type: List[ArchiveMD5]
+        for chunk in chunks:
+            if chunk.offset != self.end or chunk.length != ARCHIVE_MD5_CHUNK:
+                break
+            self.chunks.append(chunk)
+
+    @property
+    def end(self) -> int:
+        """The amount of data which has been hashed so far."""
+        return len(self.chunks) * ARCHIVE_MD5_CHUNK + self._chunk_len
+
+    def update(self, data: bytes) -> None:
+        """Add data onto the end of the archive."""
+        view = memoryview(data)
+        while view:
+            size = min(len(view), ARCHIVE_MD5_CHUNK - self._chunk_len)
+            self._hasher.update(view[:size])
+            self._chunk_len += size
+            view = view[size:]
+            if self._chunk_len == ARCHIVE_MD5_CHUNK:
+                self.chunks.append(ArchiveMD5(
+                    self.arch_index,
+                    len(self.chunks) * ARCHIVE_MD5_CHUNK,
+                    ARCHIVE_MD5_CHUNK,
+                    self._hasher.digest(),
+                ))
+                self._hasher = hashlib.md5()
+                self._chunk_len = 0
+
+    def checksums(self) -> List[ArchiveMD5]:
+        """Return the checksums for the whole archive, including a final partial chunk."""
+        if self._chunk_len:
+            return self.chunks + [ArchiveMD5(
+                self.arch_index,
+                len(self.chunks) * ARCHIVE_MD5_CHUNK,
+                self._chunk_len,
+                self._hasher.digest(),
+            )]
+        return list(self.chunks)
+
+
+class FileResult(NamedTuple):
+    """The result of verifying or extracting a single file."""
+    filename: str
+    ok: bool
+    error: Optional[BaseException] = None
+
+
+class BatchReport:
+    """The per-file results of VPK.verify_all() or VPK.extract_all().
+
+    This is true only if every file succeeded.
+    """
+    def __init__(self, results: Iterable[FileResult]) -> None:
+        self.results = sorted(results, key=operator.attrgetter('filename'))
+
+    def __repr__(self) -> str:
+        return '<BatchReport: {}/{} succeeded>'.format(
+            len(self.results) - len(self.failures),
+            len(self.results),
+        )
+
+    def __bool__(self) -> bool:
+        return all(result.ok for result in self.results)
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def __iter__(self) -> Iterator[FileResult]:
+        return iter(self.results)
+
+    @property
+    def failures(self) -> List[FileResult]:
+        """The files which failed."""
+        return [result for result in self.results if not result.ok]
+
+
+# Batches are processed in a thread or process pool, so only pass simple
+# values: filename, offset, length, start data, and CRC or destination path.
+_BatchEntry = Tuple[str, int, int, bytes, Any]
+
+
+def _verify_batch(arch_path: Optional[str], batch: List[_BatchEntry]) -> List[FileResult]:
+    """Check the checksums for a batch of files, read in order from an archive."""
+    if arch_path is None:
+        # Only stored in the directory.
+        return [
+            FileResult(name, checksum(start_data) == crc)
+            for name, offset, length, start_data, crc in batch
+        ]
+    try:
+        f = open(arch_path, 'rb')
+    except OSError as exc:
+        return [FileResult(entry[0], False, exc) for entry in batch]
+    results = []
+    with f:
+        for name, offset, length, start_data, crc in batch:
+            f.seek(offset)
+            results.append(FileResult(
+                name,
+                checksum(f.read(length), checksum(start_data)) == crc,
+            ))
+    return results
+
+
+def _extract_batch(arch_path: Optional[str], batch: List[_BatchEntry]) -> List[FileResult]:
+    """Write out a batch of files, read in order from an archive."""
+    try:
+        f = open(arch_path, 'rb') if arch_path is not None else None
+    except OSError as exc:
+        return [FileResult(entry[0], False, exc) for entry in batch]
+    results = []
+    try:
+        for name, offset, length, start_data, dest in batch:
+            try:
+                with open(dest, 'wb') as dest_file:
+                    dest_file.write(start_data)
+                    if length:
+                        f.seek(offset)
+                        dest_file.write(f.read(length))
+            except OSError as exc:
+                results.append(FileResult(name, False, exc))
+            else:
+                results.append(FileResult(name, True))
+    finally:
+        if f is not None:
+            f.close()
+    return results
+
+
+def _load_file(source: FileSource) -> Tuple[bytes, int]:
+    """Read a file if required, then compute the checksum.
+
+    This is run in a thread pool - reading and checksumming release the GIL.
+    """
+    if isinstance(source, bytes):
+        data = source
+    elif isinstance(source, (bytearray, memoryview)):
+        data = bytes(source)
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+    return data, checksum(data)
+
+
+def _close_mapping(arch_map: mmap.mmap) -> None:
+    """Close an archive mapping.
+
+    If views into the archive are still in use, the mapping is instead left
+    to be closed once those are released.
+    """
+    try:
+        arch_map.close()
+    except BufferError:
+        pass
+
+
+class ViewFile(io.BufferedIOBase):
+    """A read-only file object reading from a memoryview, without copying.
+
+    When closed, the view is released.
+    """
+    def __init__(self, view: memoryview) -> None:
+        super().__init__()
+        self._view = view.cast('B')
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        """Release the view."""
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+    def getbuffer(self) -> memoryview:
+        """Return a view of the entire contents of the file."""
+        self._checkClosed()
+        return self._view[:]
+
+    def tell(self) -> int:
+        self._checkClosed()
+        return self._pos
+
+    def seek(self, pos: int, whence: int=io.SEEK_SET) -> int:
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            if pos < 0:
+                raise ValueError('Negative seek position {}'.format(pos))
+        elif whence == io.SEEK_CUR:
+            pos = max(self._pos + pos, 0)
+        elif whence == io.SEEK_END:
+            pos = max(len(self._view) + pos, 0)
+        else:
+            raise ValueError('Invalid whence ({!r})'.format(whence))
+        self._pos = pos
+        return pos
+
+    def read(self, size: Optional[int]=-1) -> bytes:
+        self._checkClosed()
+        start = min(self._pos, len(self._view))
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(start + size, len(self._view))
+        self._pos = end
+        return self._view[start:end].tobytes()
+
+    read1 = read
+
+    def readinto(self, buffer) -> int:
+        self._checkClosed()
+        start = min(self._pos, len(self._view))
+        with memoryview(buffer) as dest, dest.cast('B') as dest:
+            size = min(len(dest), len(self._view) - start)
+            dest[:size] = self._view[start:start + size]
+        self._pos = start + size
+        return size
+
+    readinto1 = readinto
+
+
 class FileInfo:
     """Represents a file stored inside a VPK."""
 
@@ -186,12 +519,31 @@ class FileInfo:
             if self.arch_index is None:
                 return self.start_data + self.vpk.footer_data[self.offset: self.offset + self.arch_len]
             else:
-                arch_file = get_arch_filename(self.vpk.file_prefix, self.arch_index)
-                with open(os.path.join(self.vpk.folder, arch_file), 'rb') as data:
-                    data.seek(self.offset)
-                    return self.start_data + data.read(self.arch_len)
+                return self.start_data + self.vpk._read_archive(
+                    self.arch_index, self.offset, self.arch_len,
+                )
         else:
             return self.start_data
+
+    def read_view(self) -> memoryview:
+        """Return the contents of this file, without copying if possible.
+
+        If the file is stored entirely in an archive, this is a view into the
+        memory-mapped archive. Otherwise, it's a view of the read data.
+        The view should be released when done, so the archive can be closed.
+        """
+        if not self.arch_len:
+            return memoryview(self.start_data)
+        if self.arch_index is None or self.start_data:
+            return memoryview(self.read())
+        return self.vpk._view_archive(self.arch_index, self.offset, self.arch_len)
+
+    def open_bin(self) -> BinaryIO:
+        """Return a read-only file-like object for the contents of this file.
+
+        This reads directly from the archive, without copying the data.
+        """
+        return ViewFile(self.read_view())  # type: ignore
             
     def verify(self) -> bool:
         """Check this file matches the checksum."""
@@ -203,13 +555,8 @@ class FileInfo:
                     chk
                  )
             else:
-                arch_file = get_arch_filename(self.vpk.file_prefix, self.arch_index)
-                with open(os.path.join(self.vpk.folder, arch_file), 'rb') as data:
-                    data.seek(self.offset)
-                    chk = checksum(
-                        data.read(self.arch_len),
-                        chk,
-                    )
+                with self.read_view() as view:
+                    chk = checksum(view[len(self.start_data):], chk)
         return chk == self.crc
            
     def write(self, data: bytes, arch_index: Optional[int]=None) -> None:
@@ -237,8 +584,12 @@ class FileInfo:
         if self.arch_len:
             self.arch_index = arch_index
             arch_file = get_arch_filename(self.vpk.file_prefix, arch_index)
+            # The mapping doesn't include the new data, discard it.
+            self.vpk._close_archive(arch_index)
             with open(os.path.join(self.vpk.folder, arch_file), 'ab') as file:
                 self.offset = file.seek(0, os.SEEK_END)
+                if self.vpk.version >= 2:
+                    self.vpk._hash_archive(arch_index, self.offset, arch_data)
                 file.write(arch_data)
         else:
             # Only stored in the main index
@@ -255,6 +606,7 @@ class VPK:
         mode: Union[OpenModes, str]='r',
         dir_data_limit: Optional[int]=1024,
         version: int=1,
+        max_open_archives: int=MAX_OPEN_ARCHIVES,
     ) -> None:
         """Create a VPK file.
         
@@ -267,6 +619,8 @@ class VPK:
             dir_data_limit: The maximum amount of data for files saved to the dir file.
                None = no limit, and 0=save all to a data file.
             version: The desired version if the file is not read.
+            max_open_archives: The number of archive files which are kept
+               memory-mapped for reading, reusing the least recently used.
         """
         if version not in (1, 2):
             raise ValueError("Invalid version ({}) - must be 1 or 2!".format(version))
@@ -284,9 +638,111 @@ class VPK:
 
         self.version = version
         self.header_len = 0
+
+        self.max_open_archives = max_open_archives
+        # Archive index -> mapped file, in least-recently-used order.
+        self._archives = OrderedDict()  # type: OrderedDict[int, mmap.mmap]
+        self._archive_lock = threading.Lock()
+        # For V2, the checksums read from the file, and those being updated
+        # as data is written.
+        self._archive_md5 = {}  # type: Dict[int, List[ArchiveMD5]]
+        self._archive_hashers = {}  # type: Dict[int, _ArchiveHasher]
         
         self.load_dirfile()
+
+    @classmethod
+    def _unparsed(
+        cls,
+        dir_file: str,
+        version: int,
+        header_len: int,
+        footer_data: bytes,
+    ) -> 'VPK':
+        """Create a read-only VPK without parsing the directory.
+
+        This is used by VPKIndex, which creates FileInfo objects itself.
+        """
+        vpk = cls.__new__(cls)
+        vpk.folder = vpk.file_prefix = ''
+        vpk.path = dir_file
+        vpk._fileinfo = {}
+        vpk.mode = OpenModes.READ
+        vpk.dir_limit = None
+        vpk.footer_data = footer_data
+        vpk.version = version
+        vpk.header_len = header_len
+        vpk.max_open_archives = MAX_OPEN_ARCHIVES
+        vpk._archives = OrderedDict()
+        vpk._archive_lock = threading.Lock()
+        vpk._archive_md5 = {}
+        vpk._archive_hashers = {}
+        return vpk
         
+    def _get_archive(self, index: int) -> mmap.mmap:
+        """Return the memory-mapped archive file with this index.
+
+        Recently used archives are kept open, to avoid reopening them for
+        each file read. This must be called with the archive lock held, and
+        the mapping must only be used while it is held, since another thread
+        may close it.
+        """
+        try:
+            arch_map = self._archives[index]
+        except KeyError:
+            pass
+        else:
+            self._archives.move_to_end(index)
+            return arch_map
+
+        arch_file = get_arch_filename(self.file_prefix, index)
+        with open(os.path.join(self.folder, arch_file), 'rb') as f:
+            arch_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._archives[index] = arch_map
+        while len(self._archives) > max(self.max_open_archives, 1):
+            _close_mapping(self._archives.popitem(last=False)[1])
+        return arch_map
+
+    def _read_archive(self, index: int, offset: int, length: int) -> bytes:
+        """Read data from the archive file with this index."""
+        with self._archive_lock:
+            return self._get_archive(index)[offset: offset + length]
+
+    def _view_archive(self, index: int, offset: int, length: int) -> memoryview:
+        """Return a view of data in the archive file with this index.
+
+        While the view exists, the mapping is kept open even if evicted.
+        """
+        with self._archive_lock:
+            view = memoryview(self._get_archive(index))
+            try:
+                return view[offset: offset + length]
+            finally:
+                view.release()
+
+    def _read_range(self, index: int, offset: int, length: int) -> bytes:
+        """Read data directly from an archive file, bypassing the pool."""
+        arch_file = get_arch_filename(self.file_prefix, index)
+        with open(os.path.join(self.folder, arch_file), 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def _close_archive(self, index: int) -> None:
+        """Close the mapping for this archive, if it is open."""
+        with self._archive_lock:
+            arch_map = self._archives.pop(index, None)
+            if arch_map is not None:
+                _close_mapping(arch_map)
+
+    def close(self) -> None:
+        """Close all the archive files which are open.
+
+        Files can still be read afterward, which reopens the archives.
+        """
+        with self._archive_lock:
+            for arch_map in self._archives.values():
+                _close_mapping(arch_map)
+            self._archives.clear()
+
     def _check_writable(self) -> None:
         """Verify that this is writable."""
         if not self.mode.writable:
@@ -316,7 +772,6 @@ class VPK:
         if self.mode is OpenModes.WRITE:
             # Erase the directory file, we ignore current contents.
             open(self.path, 'wb').close()
-            self.version = 1
             return
 
         try:
@@ -325,71 +780,93 @@ class VPK:
             if self.mode is OpenModes.APPEND:
                 # No directory file - generate a blank file.
                 open(self.path, 'wb').close()
-                self.version = 1
                 return
             else:
                 raise  # In read mode, don't overwrite and error when reading.
 
         with dirfile:
-            vpk_sig, version, tree_length = struct_read('<III', dirfile)
-            
-            if vpk_sig != VPK_SIG:
-                raise ValueError('Bad VPK directory signature!')
-            
-            if version not in (1, 2):
-                raise ValueError("Bad VPK version {}!".format(self.version))
-
-            self.version = version
-
-            if version >= 2:
-                (
-                    data_size,
-                    ext_md5_size,
-                    dir_md5_size,
-                    sig_size,
-                ) = struct_read('<4I', dirfile)
-                
-            self.header_len = dirfile.tell() + tree_length
-            
-            self._fileinfo.clear()
-            
-            # Read directory contents
-            # These are in a tree of extension, directory, file. '' terminates a part.
-            for ext in iter_nullstr(dirfile):
-                ext_dict = self._fileinfo.setdefault(ext, {})
-                for directory in iter_nullstr(dirfile):
-                    dir_dict = ext_dict.setdefault(directory, {})
-                    for file in iter_nullstr(dirfile):
-                        crc, index_len, arch_ind, offset, arch_len, end = struct_read('<IHHIIH', dirfile)
-                        if arch_ind == DIR_ARCH_INDEX:
-                            arch_ind = None
-                            
-                        if arch_len == 0:
-                            offset = 0
-                        
-                        if end != 0xffff:
-                            raise Exception('"{}" has bad terminator! {}'.format(
-                                _join_file_parts(directory, file, ext),
-                                (crc, index_len, arch_ind, offset, arch_len, end),
-                            ))
-                        dir_dict[file] = FileInfo(
-                            self,
-                            directory,
-                            file,
-                            ext,
-                            crc=crc,
-                            offset=offset,
-                            start_data=dirfile.read(index_len),
-                            arch_len=arch_len,
-                            arch_index=arch_ind,
-                        )
-                
-                # 1 for the ending b'' section
-                if dirfile.tell() + 1 == self.header_len:
-                    dirfile.read(1)  # Skip null byte.
-                    break
+            data = dirfile.read()
+
+        vpk_sig, version, tree_length = _HEADER.unpack_from(data, 0)
+
+        if vpk_sig != VPK_SIG:
+            raise ValueError('Bad VPK directory signature!')
+
+        if version not in (1, 2):
+            raise ValueError("Bad VPK version {}!".format(self.version))
+
+        self.version = version
+        pos = _HEADER.size
+
+        if version >= 2:
+            (
+                data_size,
+                ext_md5_size,
+                dir_md5_size,
+                sig_size,
+            ) = _HEADER_V2.unpack_from(data, pos)
+            pos += _HEADER_V2.size
+
+        self.header_len = pos + tree_length
+
+        self._fileinfo.clear()
 
-            self.footer_data = dirfile.read()
+        # Parse the whole tree in memory, instead of reading byte by byte.
+        for (
+            ext, directory, file, crc,
+            preload_off, preload_len, arch_ind, offset, arch_len,
+        ) in _iter_dir_tree(data, pos, self.header_len):
+            self._fileinfo.setdefault(ext, {}).setdefault(directory, {})[file] = FileInfo(
+                self,
+                directory,
+                file,
+                ext,
+                crc=crc,
+                offset=offset,
+                start_data=data[preload_off:preload_off + preload_len],
+                arch_len=arch_len,
+                arch_index=arch_ind,
+            )
+
+        self._archive_md5.clear()
+        self._archive_hashers.clear()
+        if version >= 2:
+            # The data section, then the archive checksums. The other MD5
+            # and signature sections need to be regenerated when writing.
+            self.footer_data = data[self.header_len:self.header_len + data_size]
+            pos = self.header_len + data_size
+            for chunk in _ARCHIVE_MD5.iter_unpack(data[pos:pos + ext_md5_size]):
+                chunk = ArchiveMD5._make(chunk)
+                self._archive_md5.setdefault(chunk.arch_index, []).append(chunk)
+        else:
+            self.footer_data = data[self.header_len:]
+
+    def _hash_archive(self, index: int, offset: int, data: bytes) -> None:
+        """Update the V2 checksums for data about to be appended to an archive."""
+        self._sync_archive_hash(index, offset).update(data)
+
+    def _sync_archive_hash(self, index: int, size: int) -> _ArchiveHasher:
+        """Return the checksums for an archive, which must currently be this size.
+
+        If data was written without being hashed, it is read from the file.
+        """
+        try:
+            hasher = self._archive_hashers[index]
+        except KeyError:
+            hasher = _ArchiveHasher(index, self._archive_md5.get(index, ()))
+        if hasher.end > size:  # The archive was changed, start again.
+            hasher = _ArchiveHasher(index)
+        self._archive_hashers[index] = hasher
+        if hasher.end < size:
+            arch_file = get_arch_filename(self.file_prefix, index)
+            with open(os.path.join(self.folder, arch_file), 'rb') as f:
+                f.seek(hasher.end)
+                while hasher.end < size:
+                    chunk = f.read(min(ARCHIVE_MD5_CHUNK, size - hasher.end))
+                    if not chunk:
+                        raise ValueError('Archive "{}" is shorter than expected!'.format(arch_file))
+                    hasher.update(chunk)
+        return hasher
 
     def write_dirfile(self) -> None:
         """Write the directory file with the changes.
@@ -398,52 +875,78 @@ class VPK:
         """
         self._check_writable()
 
-        if self.version > 1:
-            raise NotImplementedError("Can't write V2 VPKs!")
-        
-        # We don't know how big the directory section is, so we first write the directory,
-        # then come back and overwrite the length value.
+        # Build the directory tree first, so we know the length and checksum.
+        tree = io.BytesIO()
+        key_getter = operator.itemgetter(0)
+        arch_indexes = set()
+
+        # Write in sorted order - not required, but this ensures multiple
+        # saves are deterministic.
+        for ext, folders in sorted(self._fileinfo.items(), key=key_getter):
+            _write_nullstring(tree, ext)
+            for folder, files in sorted(folders.items(), key=key_getter):
+                _write_nullstring(tree, folder)
+                for filename, info in sorted(files.items(), key=key_getter):
+                    _write_nullstring(tree, filename)
+                    if info.arch_index is None:
+                        arch_ind = DIR_ARCH_INDEX
+                    else:
+                        arch_ind = info.arch_index
+                        if info.arch_len:
+                            arch_indexes.add(arch_ind)
+                    tree.write(_DIR_ENTRY.pack(
+                        info.crc,
+                        len(info.start_data),
+                        arch_ind,
+                        info.offset,
+                        info.arch_len,
+                        0xffff,
+                    ))
+                    tree.write(info.start_data)
+                    # Each block is terminated by an empty null-terminated
+                    # string -> one null byte.
+                tree.write(b'\x00')
+            tree.write(b'\x00')
+        tree.write(b'\x00')
+        tree_data = tree.getvalue()
+
+        if self.version < 2:
+            with open(self.path, 'wb') as file:
+                file.write(_HEADER.pack(VPK_SIG, self.version, len(tree_data)))
+                file.write(tree_data)
+                file.write(self.footer_data)
+            return
+
+        # For V2, the archive checksums have been computed while writing, but
+        # we need to check they're up to date.
+        archive_md5 = io.BytesIO()
+        for arch_index in sorted(arch_indexes):
+            arch_file = get_arch_filename(self.file_prefix, arch_index)
+            size = os.stat(os.path.join(self.folder, arch_file)).st_size
+            for chunk in self._sync_archive_hash(arch_index, size).checksums():
+                archive_md5.write(_ARCHIVE_MD5.pack(*chunk))
+        archive_md5_data = archive_md5.getvalue()
+
+        # The whole file checksum covers everything before it.
+        whole_md5 = hashlib.md5()
         with open(self.path, 'wb') as file:
-            file.write(struct.pack('<III', VPK_SIG, self.version, 0))
-            header_len = file.tell()
-            key_getter = operator.itemgetter(0)
-
-            # Write in sorted order - not required, but this ensures multiple
-            # saves are deterministic.
-            for ext, folders in sorted(self._fileinfo.items(), key=key_getter):
-                _write_nullstring(file, ext)
-                for folder, files in sorted(folders.items(), key=key_getter):
-                    _write_nullstring(file, folder)
-                    for filename, info in sorted(files.items(), key=key_getter):
-                        _write_nullstring(file, filename)
-                        if info.arch_index is None:
-                            arch_ind = DIR_ARCH_INDEX
-                        else:
-                            arch_ind = info.arch_index
-                        file.write(struct.pack(
-                            '<IHHIIH',
-                            info.crc,
-                            len(info.start_data),
-                            arch_ind,
-                            info.offset,
-                            info.arch_len,
-                            0xffff,
-                        ))
-                        file.write(info.start_data)
-                        # Each block is terminated by an empty null-terminated
-                        # string -> one null byte.
-                    file.write(b'\x00')
-                file.write(b'\x00')
-            file.write(b'\x00')
-
-            # Calculate the length of the header..
-            dir_len = file.tell() - header_len
-                
-            file.write(self.footer_data)
-                
-            # Write the directory size now we know it.
-            file.seek(struct.calcsize('<II'))  # Skip signature and version
-            file.write(struct.pack('<I', dir_len))
+            for section in [
+                _HEADER.pack(VPK_SIG, self.version, len(tree_data)),
+                _HEADER_V2.pack(
+                    len(self.footer_data),
+                    len(archive_md5_data),
+                    _OTHER_MD5_SIZE,
+                    0,  # We don't sign the file.
+                ),
+                tree_data,
+                self.footer_data,
+                archive_md5_data,
+                hashlib.md5(tree_data).digest(),
+                hashlib.md5(archive_md5_data).digest(),
+            ]:
+                whole_md5.update(section)
+                file.write(section)
+            file.write(whole_md5.digest())
                 
     def __enter__(self) -> 'VPK':
         return self
@@ -455,6 +958,7 @@ class VPK:
         exc_trace: TracebackType,
     ) -> None:
         """When exiting a context sucessfully, the index will be saved."""
+        self.close()
         if exc_type is None and self.mode.writable:
             self.write_dirfile()
        
@@ -527,14 +1031,27 @@ class VPK:
         except KeyError:
             return False
 
-    def extract_all(self, dest_dir: str) -> None:
-        """Extract the contents of this VPK to a directory."""
+    def extract_all(
+        self,
+        dest_dir: str,
+        *,
+        max_workers: Optional[int]=None,
+        executor: Optional[Executor]=None,
+        progress: Optional[Callable[[int, int], Any]]=None,
+    ) -> BatchReport:
+        """Extract the contents of this VPK to a directory.
+
+        See verify_all() for the other parameters.
+        """
+        # Create the folders first, so the batches don't need to.
         for ext, folders in self._fileinfo.items():
-            for folder, files in folders.items():
+            for folder in folders:
                 os.makedirs(os.path.join(dest_dir, folder), exist_ok=True)
-                for file, info in files.items():
-                    with open(os.path.join(dest_dir, info.filename), 'wb') as f:
-                        f.write(info.read())
+        return self._run_batches(
+            _extract_batch,
+            lambda info: os.path.join(dest_dir, info.filename),
+            max_workers, executor, progress,
+        )
 
     def new_file(self, filename: FileName, root: Optional[str] = None) -> FileInfo:
         """Create the given file, making it empty by default.
@@ -590,16 +1107,143 @@ class VPK:
         """
         self.new_file(filename, root).write(data, arch_index)
 
-    def add_folder(self, folder: str, prefix: str='') -> None:
+    def add_files(
+        self,
+        files: Iterable[Tuple[FileName, FileSource]],
+        root: Optional[str] = None,
+        arch_index: int = 0,
+        max_arch_size: Optional[int] = None,
+        max_workers: Optional[int] = None,
+    ) -> None:
+        """Add many files to the VPK at once.
+
+        files is an iterable of (filename, source) pairs, where source is
+        either the bytes for the file, or a path to read the data from.
+        Files are read and checksummed using a pool of max_workers threads,
+        then written in order to the pak01_xxx files starting at arch_index.
+        Identical files are only stored once in the archives - if the checksum
+        matches a previous file, the data is compared to confirm. If
+        max_arch_size is set, once an archive would exceed that size the
+        next index is used instead.
+
+        FileExistsError will be raised if a file is already present, before
+        anything is written. If reading a file fails, the files before it
+        are kept.
+        """
+        self._check_writable()
+
+        # Create all the files first, so we can fail before writing anything.
+        infos = []  # type: List[Tuple[FileInfo, FileSource]]
+        done = 0
+        if max_workers is None:
+            # Matches ThreadPoolExecutor's default.
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+
+        # Size and checksum -> archive index and offset of data with that hash.
+        written = {}  # type: Dict[Tuple[int, int], List[Tuple[int, int]]]
+        arch_file = None  # type: Optional[BinaryIO]
+        arch_size = 0
+
+        try:
+            for filename, source in files:
+                infos.append((self.new_file(filename, root), source))
+
+            with ThreadPoolExecutor(max_workers) as pool:
+                # Only read a limited number of files in advance, so we don't
+                # load every file into memory at once.
+                pending = deque()  # type: Deque[Tuple[FileInfo, Future]]
+                info_iter = iter(infos)
+                while True:
+                    for info, source in info_iter:
+                        pending.append((info, pool.submit(_load_file, source)))
+                        if len(pending) >= 4 * max_workers:
+                            break
+                    if not pending:
+                        break
+                    info, future = pending.popleft()
+                    data, crc = future.result()
+
+                    info.crc = crc
+                    info.start_data = data[:self.dir_limit]
+                    arch_len = info.arch_len = len(data) - len(info.start_data)
+                    if not arch_len:
+                        # Only stored in the main index.
+                        info.arch_index = None
+                        info.offset = 0
+                        done += 1
+                        continue
+
+                    arch_data = memoryview(data)[len(info.start_data):]
+                    # Check for identical data, comparing the actual bytes
+                    # if the checksum matches.
+                    matches = written.setdefault((arch_len, crc), [])
+                    if matches:
+                        if arch_file is not None:
+                            arch_file.flush()
+                        arch_bytes = arch_data.tobytes()
+                        dup_loc = next((
+                            loc for loc in matches
+                            if self._read_range(*loc, arch_len) == arch_bytes
+                        ), None)
+                        if dup_loc is not None:
+                            info.arch_index, info.offset = dup_loc
+                            done += 1
+                            continue
+
+                    while True:
+                        if arch_file is None:
+                            # The mapping doesn't include the new data, discard it.
+                            self._close_archive(arch_index)
+                            arch_file = open(
+                                os.path.join(self.folder, get_arch_filename(self.file_prefix, arch_index)),
+                                'ab',
+                                buffering=WRITE_BUFFER_SIZE,
+                            )
+                            arch_size = arch_file.seek(0, os.SEEK_END)
+                        if max_arch_size is None or not arch_size or arch_size + arch_len <= max_arch_size:
+                            break
+                        # It doesn't fit, move onto the next archive.
+                        arch_file.close()
+                        arch_file = None
+                        arch_index += 1
+
+                    info.arch_index = arch_index
+                    info.offset = arch_size
+                    if self.version >= 2:
+                        # Data still in the buffer has already been hashed,
+                        # so this only needs to read what was on disk.
+                        self._hash_archive(arch_index, arch_size, arch_data)
+                    arch_file.write(arch_data)
+                    arch_size += arch_len
+                    matches.append((arch_index, info.offset))
+                    done += 1
+        except BaseException:
+            # Remove the files we didn't finish writing.
+            for info, source in infos[done:]:
+                del self._fileinfo[info.ext][info.dir][info._filename]
+            raise
+        finally:
+            if arch_file is not None:
+                arch_file.close()
+
+    def add_folder(
+        self,
+        folder: str,
+        prefix: str='',
+        arch_index: int = 0,
+        max_arch_size: Optional[int] = None,
+    ) -> None:
         """Write all files in a folder to the VPK. 
         
         If prefix is set, the folders will be written to that subfolder.
+        The other parameters are passed to add_files().
         """
         self._check_writable()
 
         if prefix:
             prefix = prefix.replace('\\', '/')
-        
+
+        files = []  # type: List[Tuple[FileName, FileSource]]
         for subfolder, _, filenames, in os.walk(folder):
             # Prefix + subfolder relative to the folder.
             # normpath removes '.' and similar values from the beginning
@@ -610,12 +1254,370 @@ class VPK:
                 )
             )
             for filename in filenames:
-                with open(os.path.join(subfolder, filename), 'rb') as f:
-                    self.add_file((vpk_path, filename), f.read())
+                files.append(((vpk_path, filename), os.path.join(subfolder, filename)))
+        self.add_files(files, arch_index=arch_index, max_arch_size=max_arch_size)
                     
-    def verify_all(self) -> bool:
-        """Check all files have a correct checksum."""
-        return all(file.verify() for file in self)
+    def verify_all(
+        self,
+        *,
+        max_workers: Optional[int]=None,
+        executor: Optional[Executor]=None,
+        progress: Optional[Callable[[int, int], Any]]=None,
+    ) -> BatchReport:
+        """Check all files have a correct checksum.
+
+        The files in each archive are split into batches, which are read in
+        order and checked using the executor, or a thread pool with
+        max_workers threads if not provided. A process pool can also be
+        used. progress is called with the number of files completed and the
+        total after each batch. The report returned is true if all files
+        were correct.
+        """
+        return self._run_batches(
+            _verify_batch,
+            operator.attrgetter('crc'),
+            max_workers, executor, progress,
+        )
+
+    def _run_batches(
+        self,
+        func: Callable[[Optional[str], List[_BatchEntry]], List[FileResult]],
+        get_param: Callable[[FileInfo], Any],
+        max_workers: Optional[int],
+        executor: Optional[Executor],
+        progress: Optional[Callable[[int, int], Any]],
+    ) -> BatchReport:
+        """Group files by archive, then process batches of them in parallel."""
+        by_archive = {}  # type: Dict[Optional[int], List[Tuple[int, int, bytes, FileInfo]]]
+        for info in self:
+            if not info.arch_len:
+                by_archive.setdefault(None, []).append((0, 0, info.start_data, info))
+            elif info.arch_index is None:
+                # Read the footer data now, so the batch doesn't need it.
+                by_archive.setdefault(None, []).append((0, 0, info.read(), info))
+            else:
+                by_archive.setdefault(info.arch_index, []).append(
+                    (info.offset, info.arch_len, info.start_data, info)
+                )
+
+        batches = []  # type: List[Tuple[Optional[str], List[_BatchEntry]]]
+        for arch_index, files in by_archive.items():
+            if arch_index is not None:
+                arch_path = os.path.join(self.folder, get_arch_filename(self.file_prefix, arch_index))
+            else:
+                arch_path = None
+            # Read each archive sequentially.
+            files.sort(key=operator.itemgetter(0))
+            batch = []  # type: List[_BatchEntry]
+            batch_size = 0
+            for offset, length, start_data, info in files:
+                batch.append((info.filename, offset, length, start_data, get_param(info)))
+                batch_size += length + len(start_data)
+                if batch_size >= BATCH_SIZE:
+                    batches.append((arch_path, batch))
+                    batch = []
+                    batch_size = 0
+            if batch:
+                batches.append((arch_path, batch))
+
+        total = sum(len(batch) for arch_path, batch in batches)
+        results = []  # type: List[FileResult]
+        own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers)
+        try:
+            futures = [
+                executor.submit(func, arch_path, batch)
+                for arch_path, batch in batches
+            ]
+            for future in as_completed(futures):
+                results += future.result()
+                if progress is not None:
+                    progress(len(results), total)
+        finally:
+            if own_executor:
+                executor.shutdown()
+        return BatchReport(results)
+
+
+def get_index_filename(dir_file: Union[str, os.PathLike]) -> str:
+    """Generate the filename to use for a VPKIndex cache file.
+
+    This includes a hash of the full path, so the indexes for multiple games
+    can be stored in the same folder.
+    """
+    path = os.path.abspath(dir_file)
+    return '{}_{:08x}.vpkidx'.format(
+        os.path.basename(path)[:-8],
+        zlib.crc32(os.path.normcase(path).encode('utf8')),
+    )
+
+
+class IndexEntry(NamedTuple):
+    """The location of a file, as stored in a VPKIndex."""
+    path: str  # With the original case.
+    crc: int
+    arch_index: Optional[int]  # Or None for the _dir file.
+    offset: int
+    arch_len: int
+    preload_offset: int  # Position of start_data in the _dir file.
+    preload_len: int
+
+
+class VPKIndex:
+    """A persistent index of the files in a VPK, for fast read-only lookups.
+
+    The index maps casefolded filenames to the location of the file, via a
+    hash table stored in a cache file. That is memory-mapped, so opening a VPK
+    does not require parsing the directory or creating a FileInfo for every
+    file. The index is rebuilt whenever the size or modification time of the
+    directory file changes. If index_file is None, the index is kept in memory.
+    """
+    # Magic, index version, dir file size, dir file mtime, VPK version,
+    # VPK header length, entry count, hash table size, name data size.
+    _HEADER = struct.Struct('<4sIQqIIIII')
+    # Name hash, name offset, crc, offset, arch_len, preload offset,
+    # name length, arch index, preload length.
+    _ENTRY = struct.Struct('<IIIIIIHHH')
+    _SLOT = struct.Struct('<I')
+    MAGIC = b'VPKI'
+    VERSION = 1
+
+    def __init__(
+        self,
+        dir_file: Union[str, os.PathLike],
+        index_file: Union[str, os.PathLike, None]=None,
+    ) -> None:
+        """Open the index for a directory file, building it if required."""
+        self.path = os.fspath(dir_file)
+        self.index_file = os.fspath(index_file) if index_file is not None else None
+        self._vpk = None  # type: Optional[VPK]
+        self._index_map = None  # type: Optional[mmap.mmap]
+
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._dir_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            data = self._load(stat.st_size, stat.st_mtime_ns)
+            if data is None:
+                data = self._build(stat.st_size, stat.st_mtime_ns)
+                if self.index_file is not None:
+                    try:
+                        with AtomicWriter(self.index_file, is_bytes=True) as f:
+                            f.write(data)
+                    except OSError:
+                        pass  # It's only a cache, we can still use it.
+            (
+                _, _, _, _,
+                self.version, self.header_len,
+                self._count, table_size, names_size,
+            ) = self._HEADER.unpack_from(data, 0)
+        except BaseException:
+            self.close()
+            raise
+
+        self._data = data
+        self._mask = table_size - 1
+        self._table_off = self._HEADER.size
+        self._entry_off = self._table_off + table_size * self._SLOT.size
+        self._names_off = self._entry_off + self._count * self._ENTRY.size
+
+    def _load(self, dir_size: int, dir_mtime: int) -> Optional[mmap.mmap]:
+        """Map the existing index file, or return None if it's outdated."""
+        if self.index_file is None:
+            return None
+        try:
+            with open(self.index_file, 'rb') as f:
+                index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # Missing or empty.
+            return None
+        try:
+            (
+                magic, version, size, mtime,
+                vpk_version, header_len,
+                count, table_size, names_size,
+            ) = self._HEADER.unpack_from(index_map, 0)
+        except struct.error:
+            index_map.close()
+            return None
+        if (
+            magic != self.MAGIC or version != self.VERSION
+            or size != dir_size or mtime != dir_mtime
+            or len(index_map) != (
+                self._HEADER.size + table_size * self._SLOT.size
+                + count * self._ENTRY.size + names_size
+            )
+        ):
+            index_map.close()
+            return None
+        self._index_map = index_map
+        return index_map
+
+    def _build(self, dir_size: int, dir_mtime: int) -> bytes:
+        """Parse the directory file, and produce the index data."""
+        data = self._dir_map
+        vpk_sig, version, tree_length = _HEADER.unpack_from(data, 0)
+        if vpk_sig != VPK_SIG:
+            raise ValueError('Bad VPK directory signature!')
+        if version not in (1, 2):
+            raise ValueError("Bad VPK version {}!".format(version))
+        pos = _HEADER.size
+        if version >= 2:
+            pos += _HEADER_V2.size
+        header_len = pos + tree_length
+
+        entries = []
+        names = bytearray()
+        table_size = 8
+        for (
+            ext, directory, file, crc,
+            preload_off, preload_len, arch_ind, offset, arch_len,
+        ) in _iter_dir_tree(data, pos, header_len):
+            name = _join_file_parts(directory, file, ext).encode('ascii')
+            entries.append((
+                zlib.crc32(name.lower()), len(names), crc, offset, arch_len,
+                preload_off, len(name),
+                DIR_ARCH_INDEX if arch_ind is None else arch_ind,
+                preload_len,
+            ))
+            names += name
+
+        # Keep the load factor below 1/2, so probe sequences stay short.
+        while table_size < 2 * len(entries):
+            table_size *= 2
+        mask = table_size - 1
+        table = [0] * table_size
+        for ind, entry in enumerate(entries, 1):
+            slot = entry[0] & mask
+            while table[slot]:
+                slot = (slot + 1) & mask
+            table[slot] = ind  # 0 marks an empty slot.
+
+        pack_entry = self._ENTRY.pack
+        return b''.join([
+            self._HEADER.pack(
+                self.MAGIC, self.VERSION, dir_size, dir_mtime,
+                version, header_len, len(entries), table_size, len(names),
+            ),
+            struct.pack('<{}I'.format(table_size), *table),
+            b''.join([pack_entry(*entry) for entry in entries]),
+            names,
+        ])
+
+    def close(self) -> None:
+        """Close the index, directory and archive files."""
+        self._data = b''
+        self._count = 0
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_map = None
+        if self._vpk is not None:
+            self._vpk.close()
+        self._dir_map.close()
+
+    def __enter__(self) -> 'VPKIndex':
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Type[BaseException],
+        exc_value: BaseException,
+        exc_trace: TracebackType,
+    ) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        """Returns the number of files in the VPK."""
+        return self._count
+
+    def _entry(self, ind: int) -> IndexEntry:
+        """Decode an entry in the table."""
+        (
+            name_hash, name_off, crc, offset, arch_len,
+            preload_off, name_len, arch_ind, preload_len,
+        ) = self._ENTRY.unpack_from(self._data, self._entry_off + ind * self._ENTRY.size)
+        name_off += self._names_off
+        return IndexEntry(
+            self._data[name_off: name_off + name_len].decode('ascii'),
+            crc,
+            None if arch_ind == DIR_ARCH_INDEX else arch_ind,
+            offset,
+            arch_len,
+            preload_off,
+            preload_len,
+        )
+
+    def _find(self, name: str) -> int:
+        """Locate the entry for a filename, or return -1 if not present."""
+        try:
+            key = name.casefold().replace('\\', '/').encode('ascii')
+        except UnicodeEncodeError:
+            return -1  # VPK filenames are ASCII, so this can't be present.
+        data = self._data
+        name_hash = zlib.crc32(key)
+        slot = name_hash & self._mask
+        while True:
+            [ind] = self._SLOT.unpack_from(data, self._table_off + slot * 4)
+            if not ind:
+                return -1
+            ind -= 1
+            entry_off = self._entry_off + ind * self._ENTRY.size
+            ent_hash, name_off = struct.unpack_from('<II', data, entry_off)
+            if ent_hash == name_hash:
+                name_off += self._names_off
+                [name_len] = struct.unpack_from('<H', data, entry_off + 24)
+                if data[name_off: name_off + name_len].lower() == key:
+                    return ind
+            slot = (slot + 1) & self._mask
+
+    def __contains__(self, name: str) -> bool:
+        """Check if the specified filename is present in the VPK."""
+        return self._find(name) != -1
+
+    def lookup(self, name: str) -> Optional[IndexEntry]:
+        """Find the entry for the specified filename, or return None."""
+        ind = self._find(name)
+        if ind == -1:
+            return None
+        return self._entry(ind)
+
+    def __iter__(self) -> Iterator[IndexEntry]:
+        """Yield all the entries in the index."""
+        for ind in range(self._count):
+            yield self._entry(ind)
+
+    @property
+    def vpk(self) -> VPK:
+        """A read-only VPK object, used for the FileInfo objects we create.
+
+        Unlike VPK(), this does not parse the directory tree.
+        """
+        if self._vpk is None:
+            self._vpk = VPK._unparsed(
+                self.path,
+                self.version,
+                self.header_len,
+                self._dir_map[self.header_len:],
+            )
+        return self._vpk
+
+    def file_info(self, entry: IndexEntry) -> FileInfo:
+        """Create the FileInfo for an entry, allowing the file to be read."""
+        directory, filename, ext = _get_file_parts(entry.path)
+        return FileInfo(
+            self.vpk,
+            directory,
+            filename,
+            ext,
+            crc=entry.crc,
+            start_data=self._dir_map[
+                entry.preload_offset: entry.preload_offset + entry.preload_len
+            ],
+            offset=entry.offset,
+            arch_len=entry.arch_len,
+            arch_index=entry.arch_index,
+        )
 
 
 def script_write(args: List[str]) -> None:
@@ -632,8 +1634,6 @@ def script_write(args: List[str]) -> None:
     else:
         arch_len = 100 * 1024 * 1024
         
-    current_arch = 1
-    
     vpk_folder, vpk_name = os.path.split(vpk_name_base)
     for filename in os.listdir(vpk_folder):
         if filename.startswith(vpk_name + '_'):
@@ -641,23 +1641,15 @@ def script_write(args: List[str]) -> None:
             os.remove(os.path.join(vpk_folder, filename))
     
     with VPK(vpk_name_base + '_dir.vpk', mode='w') as vpk:
-        arch_filename = get_arch_filename(vpk_name_base, current_arch)
-    
+        files = []  # type: List[Tuple[FileName, FileSource]]
         for subfolder, _, filenames, in os.walk(folder):
             # normpath removes '.' and similar values from the beginning
             vpk_path = os.path.normpath(os.path.relpath(subfolder, folder))
             print(vpk_path + '/')
             for filename in filenames:
                 print('\t' + filename)
-                with open(os.path.join(subfolder, filename), 'rb') as f:
-                    vpk.add_file(
-                        (vpk_path, filename), 
-                        f.read(), 
-                        arch_index=current_arch,
-                    )
-                if os.path.exists(arch_filename) and os.stat(arch_filename).st_size > arch_len:
-                    current_arch += 1
-                    arch_filename = get_arch_filename(vpk_name_base, current_arch)
+                files.append(((vpk_path, filename), os.path.join(subfolder, filename)))
+        vpk.add_files(files, arch_index=1, max_arch_size=arch_len)
                 
                 
 if __name__ == '__main__':